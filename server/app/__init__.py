@@ -2,24 +2,62 @@
 """
 This defines the application module that essentially creates a new flask app object
 """
+import importlib
 import os
-from datetime import datetime
 
 import jinja2
-import redis
 from celery import Celery
 from flask import Flask, g
-from flask_login import LoginManager, current_user
+from flask_login import LoginManager, current_user, user_loaded_from_request, user_logged_in, \
+    user_logged_out
 from flask_mail import Mail
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import orm
 import logging
 
 from config import config, Config
+from app.redis_store import RedisStore
+from app.startup import StartupProfiler
+from app.sessions import TokenAwareSessionInterface, RedisSessionInterface, regenerate_session
+
+
+
+class CroesusSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy extension whose engines are configured with the pool, health check and
+    statement timeout settings of app.database and time the checkouts of their pools, and whose
+    sessions send their reads to the read replicas, see app.replicas
+    """
+
+    def create_session(self, options):
+        """
+        Overriding to create sessions routing their statements between the primary and the replicas
+        """
+        from app.replicas import RoutingSession
+
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        """
+        Overriding to apply the pool settings of the configuration, see app.database, and to use a
+        pool recording the time every checkout waited, see app.metrics. The engines of SQLite
+        databases keep the pools Flask-SQLAlchemy chooses for them
+        """
+        from app.database import engine_options
+
+        if info is None:
+            raise RuntimeError("SQLALCHEMY_DATABASE_URI is not configured, set DATABASE_URL")
+        engine_options(app.config, info, options)
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if "poolclass" not in options:
+            from app.metrics import TimedQueuePool
+            options["poolclass"] = TimedQueuePool
+
 
 # initialize objects of flask extensions that will be used and then initialize the application
 # once the flask object has been created and initialized. 1 caveat for this is that when
 #  configuring Celery, the broker will remain constant for all configurations
-db = SQLAlchemy()
+db = CroesusSQLAlchemy()
 mail = Mail()
 login_manager = LoginManager()
 login_manager.session_protection = "strong"
@@ -27,8 +65,7 @@ login_manager.login_view = "auth.login"
 celery = Celery(__name__, broker=os.environ.get("CELERY_BROKER_URL"),
                 backend=os.environ.get("CELERY_RESULT_BACKEND"))
 
-# redis_db = redis.StrictRedis(host=os.environ.get("REDIS_SERVER"),
-#                              port=os.environ.get("REDIS_PORT"), db=os.environ.get("REDIS_DB"))
+redis_db = RedisStore()
 logger = logging.getLogger("Croesus-Server")
 
 
@@ -58,6 +95,19 @@ class CroesusApp(Flask):
         """
         return self.jinja_loader
 
+    def create_jinja_environment(self):
+        """
+        Overriding to bound the environment's cache of compiled templates to JINJA_CACHE_SIZE and
+        to keep their bytecode in the configured bytecode cache, see app.template_cache
+        :return: jinja environment
+        """
+        from app.template_cache import create_bytecode_cache
+
+        self.jinja_options = dict(self.jinja_options,
+                                  cache_size=self.config.get("JINJA_CACHE_SIZE", 400),
+                                  bytecode_cache=create_bytecode_cache(self))
+        return Flask.create_jinja_environment(self)
+
     def register_blueprint(self, blueprint, **options):
         """
         Overriding to add the blueprints names to the prefix loader's mapping
@@ -65,53 +115,157 @@ class CroesusApp(Flask):
         :param options: 
         """
         Flask.register_blueprint(self, blueprint, **options)
-        self.jinja_loader.loaders[1].mapping[blueprint.name] = blueprint.jinja_loader
+        # blueprints without a template folder have no loader
+        if blueprint.jinja_loader is not None:
+            self.jinja_loader.loaders[1].mapping[blueprint.name] = blueprint.jinja_loader
 
 
-def create_app(config_name):
+def create_app(config_name, profiler=None):
     """
     Creates a new flask app instance with the given configuration
     :param config_name: configuration to use when creating the application 
+    :param profiler: startup profiler timing every extension and blueprint, see app.startup
     :return: a new WSGI Flask app
     :rtype: Flask
     """
+    profiler = profiler or StartupProfiler(enabled=False)
     app = CroesusApp()
 
     # configure the application with the given configuration name, testing, development,
     # production
-
-    app.config.from_object(config[config_name])
-    config[config_name].init_app(app)
-
-    # configure celery
-    celery.conf.update(app.config)
-
-    # initialize the db
-    db.init_app(app)
-
-    # redis_db.set(name="host", value=os.environ.get("REDIS_SERVER"))
-    # redis_db.set(name="port", value=os.environ.get("REDIS_PORT"))
-    # redis_db.set(name="db", value=os.environ.get("REDIS_DB"))
-
-    # initialize the login manager
-    login_manager.init_app(app)
-
-    # initialize flask mail
-    mail.init_app(app)
+    with profiler.step("config", config_name):
+        app.config.from_object(config[config_name])
+        config[config_name].init_app(app)
+
+    # configure celery, celery beat refreshes the news sources on their own schedules, compacts
+    # the task ledger daily and drains the mail outbox every minute
+    with profiler.step("extension", "celery"):
+        from app.mod_blog.blog_tasks import news_refresh_schedule
+        from app.mod_tasks.ledger import ledger_schedule
+        from app.outbox import outbox_schedule
+        celery.conf.update(app.config)
+        celery.conf.update(CELERYBEAT_SCHEDULE=dict(
+            news_refresh_schedule(app.config["NEWS_SOURCES"]),
+            **dict(ledger_schedule(), **outbox_schedule())))
+
+    # initialize the db and its read replicas, which are binds of the db
+    with profiler.step("extension", "db"):
+        from app.replicas import replica_router
+        replica_router.init_app(app)
+        db.init_app(app)
+
+    # initialize the shared redis connection pool
+    with profiler.step("extension", "redis"):
+        redis_db.init_app(app)
+
+    # initialize the login manager, requests authenticated with a bearer token do not use the
+    # session, so it is not saved for them, and the session id changes when a user logs in or out
+    with profiler.step("extension", "login_manager"):
+        login_manager.init_app(app)
+        if app.config.get("SESSION_TYPE") == "redis":
+            app.session_interface = RedisSessionInterface(
+                redis_db.get_client(app), key_prefix=app.config["SESSION_KEY_PREFIX"])
+        else:
+            app.session_interface = TokenAwareSessionInterface()
+        user_loaded_from_request.connect(mark_token_login, app)
+        user_logged_in.connect(regenerate_session, app)
+        user_logged_out.connect(regenerate_session, app)
+
+    # initialize flask mail, the outbox emails are queued in and the precompiled email templates
+    with profiler.step("extension", "mail"):
+        mail.init_app(app)
+        from app.outbox import mail_outbox
+        mail_outbox.init_app(app)
+        from app.email_templates import email_templates
+        email_templates.init_app(app)
+
+    # initialize the write-behind tracker for the users' last seen timestamps
+    with profiler.step("extension", "last_seen_tracker"):
+        from app.mod_auth.last_seen import last_seen_tracker
+        last_seen_tracker.init_app(app)
+
+    # initialize the cache in front of the login manager's user loader
+    with profiler.step("extension", "user_cache"):
+        from app.mod_auth.user_cache import user_cache
+        user_cache.init_app(app)
+
+    # initialize the password hashing service
+    with profiler.step("extension", "password_hasher"):
+        from app.mod_auth.hashing import password_hasher
+        password_hasher.init_app(app)
+
+    # initialize the token service, this builds the token serializers once per application
+    with profiler.step("extension", "token_service"):
+        from app.mod_auth.tokens import token_service
+        token_service.init_app(app)
+
+    # initialize the cache of fetched news
+    with profiler.step("extension", "news_cache"):
+        from app.mod_blog.news_cache import news_cache
+        news_cache.init_app(app)
+
+    # initialize the crawler of the news sources. The crawler and its HTML parsers are only used
+    # by the celery workers, with LAZY_IMPORTS web processes never load them
+    if not app.config.get("LAZY_IMPORTS"):
+        with profiler.step("extension", "news_crawler"):
+            from app.mod_blog.crawler import get_crawler
+            get_crawler(app)
+
+    # initialize the http cache, ETags and conditional requests for every response and the cache
+    # of the responses of views decorated with cached_response
+    with profiler.step("extension", "http_cache"):
+        from app.http_cache import http_cache
+        http_cache.init_app(app)
+
+    # initialize the rate limiter of the authentication endpoints
+    with profiler.step("extension", "rate_limiter"):
+        from app.rate_limit import rate_limiter
+        rate_limiter.init_app(app)
+
+    # initialize the instrumentation of the SQL queries, their statistics by endpoint and the
+    # report of the slowest ones
+    with profiler.step("extension", "query_stats"):
+        from app.query_stats import query_stats
+        query_stats.init_app(app)
+
+    # initialize the metrics of the requests, the database pool, the tasks and the caches and their
+    # endpoint
+    with profiler.step("extension", "metrics"):
+        from app.metrics import metrics
+        metrics.init_app(app)
+
+    # initialize the sampling profiler, sessions are started per worker with a signal or the admin
+    # endpoint
+    with profiler.step("extension", "sampling_profiler"):
+        from app.sampling_profiler import sampling_profiler
+        sampling_profiler.init_app(app)
+
+    # initialize the progress channel of background tasks
+    with profiler.step("extension", "task_progress"):
+        from app.mod_tasks.progress import task_progress
+        task_progress.init_app(app)
+
+    # initialize the ledger recording every background task
+    with profiler.step("extension", "task_ledger"):
+        from app.mod_tasks.ledger import task_ledger
+        task_ledger.init_app(app)
 
     error_handlers(app)
-    register_app_blueprints(app)
-    app_request_handlers(app, db)
-    app_logger_handler(app, config_name)
+    register_app_blueprints(app, profiler)
     app_request_handlers(app, db)
-    app_logger_handler(app, config_name)
+    with profiler.step("logging", config_name):
+        app_logger_handler(app, config_name)
 
-    register_app_blueprints(app)
+    return app
 
-    # this will reduce the load time for templates and increase the application performance
-    app.jinja_env.cache = {}
 
-    return app
+def mark_token_login(app, user=None):
+    """
+    Flags the current request as authenticated with a bearer token
+    :param app: the current flask app
+    :param user: the user loaded from the request
+    """
+    g.login_via_token = True
 
 
 def app_request_handlers(app, db_):
@@ -126,25 +280,18 @@ def app_request_handlers(app, db_):
     def before_request():
         """
         Before submitting the request, change the currently logged in user 'last seen' status to now
-        this will update the database last_seen column and every time the user makes a request (refreshes the
-        page), the last seen will be updated. this is called before any request is ma
+        every time the user makes a request (refreshes the page), the last seen will be updated. The
+        database last_seen column is updated in batches by the last seen tracker
         """
         g.user = current_user
         if current_user.is_authenticated:
-            current_user.last_seen = datetime.now()
-            db.session.add(g.user)
-            db_.session.add(current_user)
-            db_.session.commit()
-
-            # @app.after_request
-            # def after_request(response):
-            #     for query in get_debug_queries():
-            #         if query.duration >= DATABASE_QUERY_TIMEOUT:
-            #             app.logger.warning(
-            #                 "SLOW QUERY: %s\nParameters: %s\nDuration: %fs\nContext: %s\n" %
-            #                 (query.statement, query.parameters, query.duration,
-            #                  query.context))
-            #     return response
+            # the timestamp is buffered and written in bulk by the last seen tracker, instead of
+            # committing a row update on every single request
+            from app.mod_auth.last_seen import last_seen_tracker
+            last_seen_tracker.touch(current_user._get_current_object())
+
+    # the queries of every request are counted, timed and fingerprinted by the query statistics,
+    # which also log the slow queries and the likely N+1 queries, see app.query_stats
 
 
 def app_logger_handler(app, config_name):
@@ -205,19 +352,18 @@ def error_handlers(app):
         :return: a template instructing user they have sent a request that does not exist on
          the server
         """
+        return error, 404
 
 
-def register_app_blueprints(app_):
+def register_app_blueprints(app_, profiler=None):
     """
     Registers the application blueprints
     :param app: the current flask app
-        return error, 404
-        """
-    from app.mod_dashboard import dashboard
-    from app.mod_home import home
-    from app.mod_blog import blog
-    from app.mod_auth import auth
-    app_.register_blueprint(auth)
-    app_.register_blueprint(home)
-    app_.register_blueprint(dashboard)
-    app_.register_blueprint(blog)
+    :param profiler: startup profiler timing the import and registration of every blueprint
+    """
+    profiler = profiler or StartupProfiler(enabled=False)
+
+    for name in ("auth", "home", "dashboard", "blog", "tasks", "admin"):
+        with profiler.step("blueprint", name):
+            module = importlib.import_module("app.mod_" + name)
+            app_.register_blueprint(getattr(module, name))
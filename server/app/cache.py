@@ -0,0 +1,99 @@
+"""
+In process caching utilities
+
+Provides a thread safe, size bounded LRU cache whose entries expire after a time to live. This is
+used wherever a per worker cache is enough and a round trip to a shared store would cost more than
+the lookup it saves.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Least recently used cache with a time to live for every entry
+    :cvar maxsize: maximum number of entries kept, the least recently used entry is evicted once
+     this is exceeded
+    :cvar ttl: default number of seconds an entry stays valid
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Gets an entry from the cache, counting the lookup as a hit or a miss
+        :param key: key of the entry
+        :param default: value returned when the key is not cached or has expired
+        :return: cached value or default
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > self.timer():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        """
+        Adds an entry to the cache, evicting the least recently used entries if the cache is full
+        :param key: key of the entry
+        :param value: value to cache
+        :param ttl: seconds this entry is valid for, defaults to the cache's ttl
+        """
+        expires_at = self.timer() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """
+        Removes an entry from the cache
+        :param key: key of the entry
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """
+        Removes all entries and resets the counters
+        """
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """
+        Statistics for sizing this cache
+        :return: dictionary with the size, hit, miss and eviction counts
+        :rtype: dict
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(size=len(self._data), maxsize=self.maxsize, ttl=self.ttl,
+                        hits=self.hits, misses=self.misses, evictions=self.evictions,
+                        hit_ratio=float(self.hits) / lookups if lookups else 0.0)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and entry[1] > self.timer()
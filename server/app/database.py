@@ -0,0 +1,206 @@
+"""
+Database connection pool settings
+
+Every gunicorn worker, and every thread of a worker, checks connections out of its process' pool.
+Each process keeps SQLALCHEMY_POOL_SIZE connections and opens up to SQLALCHEMY_MAX_OVERFLOW more
+under load, a checkout that finds none free waits up to SQLALCHEMY_POOL_TIMEOUT seconds and then
+fails, rather than queueing requests forever. workers x (pool size + overflow) has to stay below
+the server's max_connections.
+
+Connections are tested before they are used with DATABASE_POOL_PRE_PING, which replaces the ones
+the server or a firewall closed, and are replaced after SQLALCHEMY_POOL_RECYCLE seconds anyway.
+Statements running for longer than DATABASE_STATEMENT_TIMEOUT milliseconds are cancelled by the
+server, so that a runaway query can not hold a connection and its locks.
+
+With DATABASE_PGBOUNCER the application connects through PgBouncer in transaction pooling mode,
+where consecutive transactions of a connection may run on different server connections. Session
+settings would leak to other clients, so the statement timeout is set for every transaction with
+SET LOCAL instead of for the session, and PgBouncer, which does the pooling, gets a small pool of
+client connections.
+
+engine_options applies these settings to the options of an engine, see CroesusSQLAlchemy, and
+benchmark measures their effect with threads checking connections out of engines with different
+settings, see manage.py benchmark_pool.
+"""
+import threading
+import time
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import TimeoutError, OperationalError, DBAPIError
+from sqlalchemy.pool import QueuePool
+
+# options of the pool, SQLite engines have no use for them
+POOL_OPTIONS = ("pool_size", "max_overflow", "pool_timeout", "pool_recycle")
+
+
+def engine_options(config, info, options):
+    """
+    Adds the pool, health check and statement timeout settings of the configuration to the options
+    an engine is created with
+    :param config: application configuration
+    :param info: URL of the database, None when none is configured
+    :param options: options of the engine, updated in place
+    :return: the options
+    :rtype: dict
+    """
+    if info is None:
+        # no SQLALCHEMY_DATABASE_URI, there is nothing to configure
+        return options
+    if info.drivername.startswith("sqlite"):
+        for name in POOL_OPTIONS:
+            options.pop(name, None)
+        return options
+
+    options["pool_pre_ping"] = config.get("DATABASE_POOL_PRE_PING", True)
+    connect_args = dict(config.get("DATABASE_CONNECT_OPTIONS") or {}, **options.get(
+        "connect_args", {}))
+
+    timeout = config.get("DATABASE_STATEMENT_TIMEOUT")
+    pgbouncer = config.get("DATABASE_PGBOUNCER", False)
+    if info.drivername.startswith("postgresql") and timeout:
+        if pgbouncer:
+            # PgBouncer refuses the options startup parameter and a session setting would apply to
+            # whichever client gets the server connection next
+            options["execution_options"] = dict(options.get("execution_options", {}),
+                                                local_statement_timeout=int(timeout))
+        else:
+            connect_args["options"] = "{} -c statement_timeout={:d}".format(
+                connect_args.get("options", ""), int(timeout)).strip()
+    if pgbouncer:
+        options["pool_size"] = min(options.get("pool_size", 5), 2)
+
+    if connect_args:
+        options["connect_args"] = connect_args
+    return options
+
+
+@event.listens_for(Engine, "begin")
+def set_local_statement_timeout(connection):
+    """
+    Sets the statement timeout of every transaction of the engines connecting through PgBouncer
+    """
+    timeout = connection.get_execution_options().get("local_statement_timeout")
+    if timeout:
+        connection.execute("SET LOCAL statement_timeout = {:d}".format(timeout))
+
+
+def pool_stats(engine):
+    """
+    Usage of the connection pool of an engine in this process
+    :param engine: engine of the pool
+    :return: dictionary with the pool class, its size, the connections checked in and out and the
+     overflow, None for the numbers pools without a queue do not have
+    :rtype: dict
+    """
+    pool = engine.pool
+    stats = dict(pool=type(pool).__name__, size=None, checked_in=None, checked_out=None,
+                 overflow=None, timeout=None)
+    if isinstance(pool, QueuePool):
+        stats.update(size=pool.size(), checked_in=pool.checkedin(),
+                     checked_out=pool.checkedout(), overflow=pool.overflow(),
+                     timeout=pool.timeout())
+    return stats
+
+
+def load_test(url, threads=20, requests=400, hold=0.01, **options):
+    """
+    Runs requests on threads that each check a connection out of the same engine, run a query and
+    hold the connection for a while, the time a request would
+    :param url: database URL
+    :param threads: number of concurrent threads
+    :param requests: number of requests
+    :param hold: seconds every request holds its connection
+    :param options: options of the engine
+    :return: dictionary with the requests per second, the average and 99th percentile checkout
+     waits, the checkouts that timed out, the connections opened and the failed requests
+    :rtype: dict
+    """
+    engine = create_engine(url, **options)
+    # a postgresql server holds the connection itself, so that statement timeouts apply
+    query = "SELECT pg_sleep({})".format(hold) if engine.dialect.name == "postgresql" else None
+    connects = []
+    event.listen(engine, "connect", lambda *args: connects.append(1))
+    waits, failures, timeouts = [], [], []
+    remaining = [requests]
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            started = time.perf_counter()
+            try:
+                with engine.connect() as connection:
+                    waited = time.perf_counter() - started
+                    if query is not None:
+                        connection.execute(query)
+                    else:
+                        connection.execute("SELECT 1")
+                        time.sleep(hold)
+            except TimeoutError:
+                timeouts.append(1)
+                continue
+            except (OperationalError, DBAPIError):
+                failures.append(1)
+                continue
+            with lock:
+                waits.append(waited)
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    engine.dispose()
+
+    waits.sort()
+    return dict(requests_per_second=len(waits) / elapsed,
+                wait_milliseconds=sum(waits) * 1000 / max(len(waits), 1),
+                p99_wait_milliseconds=waits[int(len(waits) * 0.99)] * 1000 if waits else 0.0,
+                timeouts=len(timeouts), connects=len(connects), failures=len(failures))
+
+
+# settings compared by the benchmark
+SCENARIOS = (
+    ("size 5, no overflow", dict(pool_size=5, max_overflow=0, pool_timeout=30)),
+    ("size 5, overflow 15", dict(pool_size=5, max_overflow=15, pool_timeout=30)),
+    ("size 20", dict(pool_size=20, max_overflow=0, pool_timeout=30)),
+    ("size 5, timeout 0.05s", dict(pool_size=5, max_overflow=0, pool_timeout=0.05)),
+    ("size 20, pre-ping", dict(pool_size=20, max_overflow=0, pool_timeout=30,
+                               pool_pre_ping=True)),
+    ("size 20, recycle 0.1s", dict(pool_size=20, max_overflow=0, pool_timeout=30,
+                                   pool_recycle=0.1)),
+)
+
+
+def benchmark(url, threads=20, requests=400, hold=0.01, scenarios=SCENARIOS):
+    """
+    Load tests an engine with each of the scenarios' settings
+    :param url: database URL, a SQLite file shares its connections between threads, a
+     postgresql database also measures a statement timeout
+    :param threads: number of concurrent threads
+    :param requests: number of requests of each scenario
+    :param hold: seconds every request holds its connection
+    :param scenarios: list of (name, engine options) tuples
+    :return: list of the results of the load test of every scenario, with its name
+    :rtype: list
+    """
+    info = make_url(url)
+    if info.drivername.startswith("postgresql"):
+        # statements are cancelled once they run for half the time the requests hold them
+        scenarios = tuple(scenarios) + (("size 20, statement timeout", dict(
+            pool_size=20, max_overflow=0, pool_timeout=30, connect_args=dict(
+                options="-c statement_timeout={:d}".format(max(1, int(hold * 500)))))),)
+    results = []
+    for name, options in scenarios:
+        options = dict(options, poolclass=QueuePool)
+        if info.drivername.startswith("sqlite"):
+            options["connect_args"] = dict(check_same_thread=False)
+        results.append(dict(load_test(url, threads, requests, hold, **options), name=name))
+    return results
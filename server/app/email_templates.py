@@ -0,0 +1,214 @@
+"""
+Precompiled email templates
+
+Emails are rendered from the same Jinja templates as the pages, through the application's chain of
+loaders. Most of an email does not depend on its recipient though, the confirmation email is the
+whole head of base.html, a score of url_for calls, around a single confirm_url.
+
+EmailTemplates renders a template once per process with placeholders in place of the per recipient
+variables and splits the output around them. Every email is then the static parts joined with the
+escaped values of its recipient, which costs microseconds and needs neither a request context nor
+Jinja. Templates that do more with these variables than print them, e.g. test or filter them, can
+not be split this way and are rendered by Jinja every time.
+
+While templates are reloaded on change, e.g. in development, every email is rendered by Jinja.
+"""
+import re
+import threading
+import time
+
+from flask import current_app, has_request_context, render_template
+from jinja2 import nodes
+from markupsafe import escape
+
+PLACEHOLDER = "\x00{}\x00"
+PLACEHOLDER_PATTERN = re.compile("\x00(\\d+)\x00")
+
+
+class CompiledTemplate(object):
+    """
+    Static parts of a rendered template and the variables printed between them
+    :cvar parts: static parts, one more than there are variables
+    :cvar variables: names of the variables printed after each part but the last
+    :cvar autoescape: whether the values of the variables are HTML escaped
+    """
+
+    def __init__(self, parts, variables, autoescape):
+        self.parts = parts
+        self.variables = variables
+        self.autoescape = autoescape
+
+    def render(self, context):
+        convert = escape if self.autoescape else str
+        output = [self.parts[0]]
+        for variable, part in zip(self.variables, self.parts[1:]):
+            output.append(convert(context[variable]))
+            output.append(part)
+        return "".join(output)
+
+
+class EmailTemplates(object):
+    """
+    Renders email templates, precompiled once per process where possible
+    """
+
+    def __init__(self, app=None):
+        self.base_url = None
+        self._compiled = {}
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Reads the base url of the emails from the application configuration
+        :param app: current flask application
+        """
+        self.base_url = app.config.get("MAIL_BASE_URL")
+        with self._lock:
+            self._compiled = {}
+        app.extensions["email_templates"] = self
+
+    def render(self, template, **context):
+        """
+        Renders an email
+        :param template: name of the template
+        :param context: per recipient variables of the template
+        :return: HTML of the email
+        :rtype: str
+        """
+        compiled = self.compiled(template, context)
+        if compiled is None:
+            return self._render_template(template, context)
+        return compiled.render(context)
+
+    def render_many(self, template, contexts):
+        """
+        Renders the same email for many recipients
+        :param template: name of the template
+        :param contexts: per recipient variables of the template, one dictionary per recipient
+        :return: HTML of the emails, in the order of the contexts
+        :rtype: list
+        """
+        return [self.render(template, **context) for context in contexts]
+
+    def compiled(self, template, context):
+        """
+        Gets the compiled template for the given variables, compiling it on first use
+        :param template: name of the template
+        :param context: per recipient variables of the template
+        :return: compiled template or None if the template has to be rendered by Jinja
+        :rtype: CompiledTemplate
+        """
+        if current_app.jinja_env.auto_reload:
+            return None
+
+        key = (template, frozenset(context))
+        try:
+            return self._compiled[key]
+        except KeyError:
+            pass
+
+        compiled = self._compile(template, sorted(context))
+        with self._lock:
+            self._compiled[key] = compiled
+        return compiled
+
+    def _compile(self, template, variables):
+        if not self._only_printed(template, set(variables)):
+            return None
+
+        placeholders = {variable: PLACEHOLDER.format(index)
+                        for index, variable in enumerate(variables)}
+        # rendered in a request of its own, so that the static parts do not depend on the request
+        # the template happens to be compiled in
+        with current_app.test_request_context(base_url=self.base_url):
+            split = PLACEHOLDER_PATTERN.split(render_template(template, **placeholders))
+
+        environment = current_app.jinja_env
+        autoescape = environment.autoescape(template) if callable(environment.autoescape) \
+            else environment.autoescape
+        return CompiledTemplate(tuple(split[::2]),
+                                tuple(variables[int(index)] for index in split[1::2]),
+                                bool(autoescape))
+
+    @staticmethod
+    def _only_printed(template, variables):
+        """
+        Whether the given variables are only ever printed as they are, by the template and the
+        templates it extends or includes, so that they can be substituted into its output
+        :rtype: bool
+        """
+        environment = current_app.jinja_env
+        pending, seen = [template], set()
+
+        while pending:
+            name = pending.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            source = environment.loader.get_source(environment, name)[0]
+            tree = environment.parse(source)
+
+            printed = set(id(node) for output in tree.find_all(nodes.Output)
+                          for node in output.nodes if isinstance(node, nodes.Name))
+            for node in tree.find_all(nodes.Name):
+                if node.name in variables and id(node) not in printed:
+                    return False
+
+            for reference in tree.find_all((nodes.Extends, nodes.Include)):
+                if not isinstance(reference.template, nodes.Const):
+                    # the template is picked at render time
+                    return False
+                pending.append(reference.template.value)
+        return True
+
+    def _render_template(self, template, context):
+        if has_request_context():
+            return render_template(template, **context)
+
+        # the templates build urls, which needs a request outside of SERVER_NAME setups
+        with current_app.test_request_context(base_url=self.base_url):
+            return render_template(template, **context)
+
+
+def benchmark(template, count=10000, **context):
+    """
+    Compares rendering an email with render_template, as it used to be done, with the precompiled
+    email templates. Has to be called in an application context
+    :param template: name of the template
+    :param count: number of emails rendered by each method
+    :param context: per recipient variables, the index of the email is appended to their values
+    :return: list of dictionaries with the emails per second of each method
+    :rtype: list
+    """
+    templates = EmailTemplates()
+    templates.base_url = current_app.config.get("MAIL_BASE_URL")
+    contexts = [{name: "{}{}".format(value, index) for name, value in context.items()}
+                for index in range(count)]
+
+    def per_call():
+        with current_app.test_request_context(base_url=templates.base_url):
+            for variables in contexts:
+                render_template(template, **variables)
+
+    def precompiled():
+        for variables in contexts:
+            templates.render(template, **variables)
+
+    def precompiled_bulk():
+        templates.render_many(template, contexts)
+
+    results = []
+    for name, function in (("render_template", per_call),
+                           ("precompiled", precompiled),
+                           ("precompiled, render_many", precompiled_bulk)):
+        started = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - started
+        results.append(dict(name=name, emails_per_second=count / elapsed))
+    return results
+
+
+email_templates = EmailTemplates()
@@ -0,0 +1,208 @@
+"""
+HTTP caching of responses
+
+Every successful GET response gets a strong ETag, the SHA-1 of its body, and a conditional GET
+whose If-None-Match matches it is answered with an empty 304. Clients polling an endpoint that has
+not changed, e.g. the news feed, then only pay for the headers.
+
+Views declare how long their responses may be cached with the cached_response decorator, which
+sets their Cache-Control and, if HTTP_CACHE_BACKEND is set, keeps the rendered responses in a
+cache, in process ('memory') or shared by all workers ('redis'). Cached responses are keyed by the
+endpoint, its view and query arguments and the scope of the response, 'public' responses are the
+same for everyone while 'user' responses are cached for each user.
+"""
+import hashlib
+import json
+import pickle
+import time
+from functools import wraps
+
+from flask import current_app, request, make_response
+from flask_login import current_user
+
+from app import redis_db
+from app.cache import LRUCache
+from app.metrics import metrics
+
+# headers of a response that are cached along with its body
+CACHED_HEADERS = ("Content-Type", "ETag", "Cache-Control")
+
+
+class MemoryResponseCacheBackend(object):
+    """
+    Keeps cached responses in an in process LRU cache
+    """
+
+    def __init__(self, maxsize):
+        self.cache = LRUCache(maxsize=maxsize)
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, entry, ttl):
+        self.cache.set(key, entry, ttl=ttl)
+
+    def clear(self):
+        self.cache.clear()
+
+
+class RedisResponseCacheBackend(object):
+    """
+    Keeps cached responses in Redis so that the cache is shared by all workers
+    :cvar key_prefix: prefix of the keys used to store the cached responses
+    """
+    key_prefix = "http-cache:"
+
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, key):
+        payload = self.client.get(self.key_prefix + key)
+        return pickle.loads(payload) if payload is not None else None
+
+    def set(self, key, entry, ttl):
+        self.client.setex(self.key_prefix + key, ttl, pickle.dumps(entry))
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.key_prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+class HttpCache(object):
+    """
+    Adds ETags to responses, answers conditional requests and caches the responses of the views
+    decorated with cached_response. The backend is selected with the HTTP_CACHE_BACKEND
+    configuration, 'memory', 'redis' or None to only use ETags and Cache-Control
+    """
+
+    def __init__(self, app=None):
+        self.etags = True
+        self.backend = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Creates the configured cache backend and adds the ETags to the application's responses
+        :param app: current flask application
+        """
+        self.etags = app.config.get("HTTP_CACHE_ETAGS", True)
+        backend = app.config.get("HTTP_CACHE_BACKEND")
+
+        if backend == "memory":
+            self.backend = MemoryResponseCacheBackend(app.config.get("HTTP_CACHE_SIZE", 1024))
+        elif backend == "redis":
+            self.backend = RedisResponseCacheBackend(redis_db.get_client(app))
+        else:
+            self.backend = None
+
+        app.after_request(self.make_conditional)
+        app.extensions["http_cache"] = self
+
+    def make_conditional(self, response):
+        """
+        Adds a strong ETag to a successful GET response and turns it into a 304 if the client
+        already has it
+        :param response: response of the view
+        :return: response to send
+        """
+        if not self.etags or request.method not in ("GET", "HEAD") or \
+                response.status_code != 200 or response.is_streamed or \
+                response.direct_passthrough:
+            return response
+
+        if "ETag" not in response.headers:
+            response.add_etag()
+        return response.make_conditional(request)
+
+    def respond(self, view, ttl, scope, args, kwargs):
+        """
+        Gets the response of a view from the cache, or calls the view and caches its response
+        :param view: view function
+        :param ttl: seconds the response may be cached
+        :param scope: 'public' or 'user'
+        :return: response
+        """
+        key = self.key(scope)
+        entry = self.backend.get(key) if self.backend is not None else None
+        if self.backend is not None:
+            metrics.cache_lookup("http", entry is not None)
+        if entry is not None:
+            response = current_app.response_class(entry["body"], status=entry["status"],
+                                                  headers=entry["headers"])
+            response.headers["Age"] = str(int(time.time() - entry["stored_at"]))
+            response.headers["X-Cache"] = "HIT"
+            return response
+
+        response = make_response(view(*args, **kwargs))
+        if response.status_code != 200 or response.is_streamed:
+            return response
+
+        # views may set their own Cache-Control, e.g. no-store for a response that must not be
+        # reused
+        if "Cache-Control" not in response.headers:
+            if scope == "user":
+                response.cache_control.private = True
+            else:
+                response.cache_control.public = True
+            response.cache_control.max_age = ttl
+
+        if self.backend is not None and not response.cache_control.no_store:
+            if self.etags and "ETag" not in response.headers:
+                response.add_etag()
+            self.backend.set(key, dict(
+                body=response.get_data(), status=response.status_code, stored_at=time.time(),
+                headers=[(name, response.headers[name]) for name in CACHED_HEADERS
+                         if name in response.headers]), ttl)
+            response.headers["X-Cache"] = "MISS"
+        return response
+
+    @staticmethod
+    def key(scope):
+        """
+        Cache key of the current request's response
+        :param scope: 'public' or 'user', user responses are cached for each user
+        :rtype: str
+        """
+        if scope == "user":
+            owner = "user:{}".format(current_user.get_id()) if current_user.is_authenticated \
+                else "anonymous"
+        else:
+            owner = "public"
+        arguments = json.dumps([owner, request.view_args, sorted(request.args.items(multi=True))],
+                               sort_keys=True, default=str)
+        return "{}:{}".format(request.endpoint,
+                              hashlib.sha1(arguments.encode("utf-8")).hexdigest())
+
+    def clear(self):
+        """
+        Removes all cached responses
+        """
+        if self.backend is not None:
+            self.backend.clear()
+
+
+def cached_response(ttl, scope="public"):
+    """
+    Declares that the GET responses of a view may be cached
+    :param ttl: seconds the responses may be cached, or the name of the configuration holding them
+    :param scope: 'public' for responses that are the same for everyone, 'user' for responses that
+     depend on the current user
+    """
+    if scope not in ("public", "user"):
+        raise ValueError("Unknown cache scope {}".format(scope))
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method not in ("GET", "HEAD"):
+                return view(*args, **kwargs)
+            seconds = current_app.config[ttl] if isinstance(ttl, str) else ttl
+            return http_cache.respond(view, seconds, scope, args, kwargs)
+        return wrapper
+    return decorator
+
+
+http_cache = HttpCache()
@@ -0,0 +1,255 @@
+"""
+Prometheus metrics of the hot paths
+
+Records the latency of every request by endpoint, the requests in flight, the time spent waiting to
+check a connection out of the database pool, the connections checked out of the pools and opened
+by them, the queue time and runtime of every celery task and the hits and misses of the caches, and
+exposes them in the Prometheus text format on METRICS_PATH.
+
+Recording a sample is a dictionary lookup and a few additions, the work is done when the metrics
+are scraped. Under gunicorn every worker is a separate process with its own metrics, so
+PROMETHEUS_MULTIPROC_DIR has to point at a directory shared by the workers, which is emptied when
+the master starts and where every process writes its samples to memory mapped files, see
+gunicorn_config.py. The endpoint then merges the files of all the workers, whichever one answers
+the scrape.
+
+The tasks run in the pool processes of the celery worker, which no web worker can read the samples
+of unless it runs on the same host. The worker has a multiprocess directory of its own instead,
+where its pool processes write, and its main process serves the merged samples on
+CELERY_METRICS_PORT, see celery_worker.py.
+
+prometheus_client is only imported by init_app and only when METRICS_ENABLED is set, every
+recording method does nothing until then.
+"""
+import os
+import time
+
+from celery.signals import before_task_publish, task_prerun, task_postrun
+from flask import request, g, Response
+from sqlalchemy import event
+from sqlalchemy.pool import Pool, QueuePool
+
+# latency buckets in seconds, from a cached response to a slow crawl
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# pool checkout buckets in seconds, checkouts are free unless the pool is exhausted
+CHECKOUT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+
+
+class Metrics(object):
+    """
+    Prometheus metrics of the application
+    :cvar enabled: whether metrics are recorded, METRICS_ENABLED
+    :cvar path: path of the metrics endpoint, METRICS_PATH
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.path = "/metrics"
+        self.registry = None
+        self._connected = False
+        self._started = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Creates the metrics, adds the request hooks and the metrics endpoint to the application and
+        connects to the celery signals
+        :param app: current flask application
+        """
+        self.enabled = app.config.get("METRICS_ENABLED", False)
+        self.path = app.config.get("METRICS_PATH", self.path)
+        app.extensions["metrics"] = self
+        if not self.enabled:
+            return
+
+        if self.registry is None:
+            self._create_metrics()
+
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.teardown_request(self.end_request)
+        app.add_url_rule(self.path, "metrics", self.export)
+
+        if not self._connected:
+            event.listen(Pool, "connect", self.on_connect)
+            event.listen(Pool, "checkout", self.on_checkout)
+            event.listen(Pool, "checkin", self.on_checkin)
+            before_task_publish.connect(self.on_publish, weak=False)
+            task_prerun.connect(self.on_prerun, weak=False)
+            task_postrun.connect(self.on_postrun, weak=False)
+            self._connected = True
+
+    def _create_metrics(self):
+        """
+        Creates the metrics in a registry of their own, so that creating several applications,
+        e.g. in tests, does not register them twice
+        """
+        from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
+
+        self.registry = registry = CollectorRegistry()
+        self.request_latency = Histogram(
+            "http_request_duration_seconds", "Latency of the requests by endpoint",
+            ["method", "endpoint"], buckets=LATENCY_BUCKETS, registry=registry)
+        self.requests = Counter(
+            "http_requests_total", "Requests by endpoint and status",
+            ["method", "endpoint", "status"], registry=registry)
+        self.requests_in_flight = Gauge(
+            "http_requests_in_flight", "Requests being handled",
+            multiprocess_mode="livesum", registry=registry)
+        self.pool_checkout = Histogram(
+            "db_pool_checkout_seconds", "Time waited to check a connection out of the pool",
+            buckets=CHECKOUT_BUCKETS, registry=registry)
+        self.pool_checked_out = Gauge(
+            "db_pool_connections_checked_out", "Connections checked out of the pools",
+            multiprocess_mode="livesum", registry=registry)
+        self.pool_connects = Counter(
+            "db_pool_connections_opened_total", "Connections opened by the pools",
+            registry=registry)
+        self.task_queue_time = Histogram(
+            "celery_task_queue_seconds", "Time tasks waited in the broker before they ran",
+            ["task"], buckets=LATENCY_BUCKETS, registry=registry)
+        self.task_runtime = Histogram(
+            "celery_task_runtime_seconds", "Runtime of the tasks", ["task", "state"],
+            buckets=LATENCY_BUCKETS, registry=registry)
+        self.cache_lookups = Counter(
+            "cache_lookups_total", "Cache lookups by cache and result", ["cache", "result"],
+            registry=registry)
+
+    def start_request(self):
+        g.metrics_started = time.perf_counter()
+        self.requests_in_flight.inc()
+
+    def finish_request(self, response):
+        started = g.get("metrics_started")
+        if started is not None and request.endpoint != "metrics":
+            endpoint = request.endpoint or "unknown"
+            self.request_latency.labels(request.method, endpoint).observe(
+                time.perf_counter() - started)
+            self.requests.labels(request.method, endpoint, str(response.status_code)).inc()
+        return response
+
+    def end_request(self, exception=None):
+        if g.pop("metrics_started", None) is not None:
+            self.requests_in_flight.dec()
+
+    def export(self):
+        """
+        Metrics in the Prometheus text format, those of every worker process in multiprocess mode
+        :return: text response
+        """
+        from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+
+        registry = multiprocess_registry() if multiprocess_dir() else self.registry
+        return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+    def observe_checkout(self, seconds):
+        """
+        Records the time waited for a connection of the database pool
+        :param seconds: seconds waited
+        """
+        if self.registry is not None and self.enabled:
+            self.pool_checkout.observe(seconds)
+
+    def on_connect(self, dbapi_connection, connection_record):
+        if self.enabled:
+            self.pool_connects.inc()
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        if self.enabled:
+            self.pool_checked_out.inc()
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        if self.enabled:
+            self.pool_checked_out.dec()
+
+    def cache_lookup(self, cache, hit):
+        """
+        Records a cache lookup
+        :param cache: name of the cache
+        :param hit: whether the lookup was a hit
+        """
+        if self.registry is not None and self.enabled:
+            self.cache_lookups.labels(cache, "hit" if hit else "miss").inc()
+
+    def on_publish(self, sender=None, headers=None, **kwargs):
+        # the time the task was sent travels with it, its queue time is measured when it starts
+        if headers is not None:
+            headers["sent_at"] = time.time()
+
+    def on_prerun(self, task_id=None, task=None, **kwargs):
+        if not self.enabled:
+            return
+        sent_at = getattr(task.request, "sent_at", None) or \
+            (task.request.headers or {}).get("sent_at")
+        if sent_at is not None:
+            self.task_queue_time.labels(task.name).observe(max(0.0, time.time() - sent_at))
+        self._started[task_id] = time.perf_counter()
+
+    def on_postrun(self, task_id=None, task=None, state=None, **kwargs):
+        started = self._started.pop(task_id, None)
+        if started is not None and self.enabled:
+            self.task_runtime.labels(task.name, state or "UNKNOWN").observe(
+                time.perf_counter() - started)
+
+
+class TimedQueuePool(QueuePool):
+    """
+    Queue pool recording how long every checkout waited for a connection, including the time to
+    open one
+    """
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        finally:
+            metrics.observe_checkout(time.perf_counter() - started)
+
+
+def multiprocess_dir():
+    """
+    Directory shared by the worker processes in multiprocess mode, None otherwise
+    :rtype: str
+    """
+    return os.environ.get("PROMETHEUS_MULTIPROC_DIR") or os.environ.get("prometheus_multiproc_dir")
+
+
+def multiprocess_registry():
+    """
+    Registry merging the samples every process wrote to the multiprocess directory
+    :rtype: prometheus_client.CollectorRegistry
+    """
+    from prometheus_client import CollectorRegistry, multiprocess
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def clear_multiprocess_dir(directory, keep=None):
+    """
+    Removes the samples of the processes of a previous run from a multiprocess directory, they
+    would be added to those of the new processes
+    :param directory: multiprocess directory
+    :param keep: pid of the process whose samples are kept, e.g. the current one
+    """
+    for name in os.listdir(directory):
+        pid = os.path.splitext(name)[0].rpartition("_")[2]
+        if name.endswith(".db") and pid != str(keep):
+            os.remove(os.path.join(directory, name))
+
+
+def serve_worker_metrics(port):
+    """
+    Serves the metrics of the pool processes of a celery worker from its main process, on a port of
+    their own in a daemon thread
+    :param port: port of the metrics endpoint
+    """
+    from prometheus_client import start_http_server
+
+    start_http_server(port, registry=multiprocess_registry())
+
+
+metrics = Metrics()
@@ -0,0 +1,10 @@
+"""
+Module exposing operational reports to the administrators
+
+Every endpoint of this blueprint requires a logged in user account flagged as admin
+"""
+from flask import Blueprint
+
+admin = Blueprint(name="admin", import_name=__name__, url_prefix="/admin/")
+
+from . import views
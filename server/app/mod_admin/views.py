@@ -0,0 +1,72 @@
+"""
+View functions of the administrators' reports
+"""
+from flask import jsonify, request, abort, current_app
+from flask_login import login_required, current_user
+
+from app import db
+from app.database import pool_stats
+from app.query_stats import query_stats
+from app.sampling_profiler import sampling_profiler
+from . import admin
+
+
+@admin.before_request
+@login_required
+def require_admin():
+    """
+    Only lets the administrators through, everybody else gets a 403
+    """
+    if not current_user.admin:
+        abort(403)
+
+
+@admin.route("queries")
+def query_report():
+    """
+    Report of the SQL queries over the statistics window, the endpoints by database time with their
+    most frequent fingerprints and the slowest fingerprints
+    Accessed via route <API_URL>/admin/queries?top=<number of slow queries>
+    :return: JSON response with the query report
+    """
+    top = min(request.args.get("top", query_stats.top, type=int) or query_stats.top, 100)
+    return jsonify(query_stats.report(top=top))
+
+
+@admin.route("profiler", methods=["GET", "POST", "DELETE"])
+def profiler():
+    """
+    Sampling profiler of the worker answering the request. POST starts a session for 'seconds'
+    seconds sampling a 'rate' share of the requests, DELETE ends it and writes its stacks and GET
+    returns the current or last session
+    Accessed via route <API_URL>/admin/profiler
+    :return: JSON response with the session, 409 if a session is already running
+    """
+    if request.method == "POST":
+        seconds = min(request.values.get("seconds", 30, type=float) or 30, 3600)
+        rate = min(max(request.values.get("rate", 1.0, type=float), 0.0), 1.0)
+        session = sampling_profiler.start(seconds=seconds, rate=rate)
+        if session is None:
+            return jsonify(dict(message="A profiling session is already running",
+                                session=sampling_profiler.session)), 409
+        return jsonify(dict(session=session))
+
+    if request.method == "DELETE":
+        return jsonify(dict(session=sampling_profiler.stop()))
+
+    return jsonify(dict(session=sampling_profiler.session))
+
+
+@admin.route("pool")
+def pool():
+    """
+    Usage of the database connection pool of the worker answering the request and its settings
+    Accessed via route <API_URL>/admin/pool
+    :return: JSON response with the pool usage and settings
+    """
+    config = current_app.config
+    settings = {name.lower(): config.get(name) for name in (
+        "SQLALCHEMY_POOL_SIZE", "SQLALCHEMY_MAX_OVERFLOW", "SQLALCHEMY_POOL_TIMEOUT",
+        "SQLALCHEMY_POOL_RECYCLE", "DATABASE_POOL_PRE_PING", "DATABASE_STATEMENT_TIMEOUT",
+        "DATABASE_PGBOUNCER")}
+    return jsonify(dict(pool_stats(db.engine), settings=settings))
@@ -0,0 +1,168 @@
+"""
+Password hashing service
+
+Hashing and checking passwords is CPU bound and would otherwise block the worker handling the
+request for its whole duration. The algorithm and its cost are configurable and the work is
+offloaded to a bounded process pool, so a login storm queues for a fixed number of hashing
+processes instead of starving every worker thread. Hashes created with outdated parameters can be
+detected with needs_rehash() and replaced when the user next logs in.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class PasswordHasher(object):
+    """
+    Hashes and verifies passwords with the configured method and cost
+    :cvar method: werkzeug hash method, e.g. pbkdf2:sha256
+    :cvar iterations: number of iterations for pbkdf2 methods
+    :cvar salt_length: length of the generated salts
+    :cvar pool_size: number of hashing processes, 0 hashes on the calling thread
+    """
+
+    def __init__(self, app=None):
+        self.method = "pbkdf2:sha256"
+        self.iterations = 150000
+        self.salt_length = 8
+        self.pool_size = 0
+        self._executor = None
+        self._executor_pid = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Configures the hashing method, cost and pool size from the application configuration
+        :param app: current flask application
+        """
+        self.method = app.config.get("PASSWORD_HASH_METHOD", self.method)
+        self.iterations = app.config.get("PASSWORD_HASH_ITERATIONS", self.iterations)
+        self.salt_length = app.config.get("PASSWORD_SALT_LENGTH", self.salt_length)
+        self.shutdown()
+        self.pool_size = app.config.get("PASSWORD_HASH_POOL_SIZE", 0)
+        app.extensions["password_hasher"] = self
+
+    @property
+    def method_string(self):
+        """
+        Method as passed to werkzeug, including the iterations for pbkdf2 methods. This is also
+        the prefix of every hash created with the current settings
+        :rtype: str
+        """
+        if self.method.startswith("pbkdf2:"):
+            return "{}:{}".format(self.method, self.iterations)
+        return self.method
+
+    def hash_function(self):
+        """
+        Picklable function hashing a password with the current settings, used to hash on other
+        process pools such as the bulk importer's
+        :return: function taking a password and returning its hash
+        """
+        return partial(generate_password_hash, method=self.method_string,
+                       salt_length=self.salt_length)
+
+    def hash(self, password):
+        """
+        Hashes a password
+        :param password: plain text password
+        :return: password hash
+        :rtype: str
+        """
+        return self._run(self.hash_function(), password)
+
+    def verify(self, password_hash, password):
+        """
+        Checks a password against a hash
+        :param password_hash: stored password hash
+        :param password: plain text password
+        :return: True if the password matches
+        :rtype: bool
+        """
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """
+        Checks whether a hash was created with a method or cost other than the current ones
+        :param password_hash: stored password hash
+        :rtype: bool
+        """
+        return password_hash.split("$", 1)[0] != self.method_string
+
+    def _run(self, function, *args):
+        """
+        Runs the hashing function on the process pool, or on this thread if there is no pool.
+        The number of pending calls is bounded to the size of the pool so that callers wait for
+        a free process instead of queueing an unbounded amount of work
+        """
+        executor = self._get_executor()
+        if executor is None:
+            return function(*args)
+
+        with self._slots:
+            return executor.submit(function, *args).result()
+
+    def _get_executor(self):
+        """
+        Gets the process pool, creating it lazily so that every forked worker gets its own
+        """
+        if self.pool_size <= 0:
+            return None
+        if self._executor is not None and self._executor_pid == os.getpid():
+            return self._executor
+
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.pool_size)
+                self._executor_pid = os.getpid()
+                self._slots = threading.BoundedSemaphore(self.pool_size)
+        return self._executor
+
+    def shutdown(self):
+        """
+        Shuts the process pool down
+        """
+        with self._lock:
+            if self._executor is not None and self._executor_pid == os.getpid():
+                self._executor.shutdown(wait=False)
+            self._executor = None
+            self._executor_pid = None
+
+
+def benchmark(iterations_list, duration=2.0, method="pbkdf2:sha256", salt_length=8):
+    """
+    Measures how many logins, i.e. password checks, a single core can do per second at each cost
+    :param iterations_list: pbkdf2 iteration counts to measure
+    :param duration: seconds spent measuring each cost
+    :param method: hash method
+    :param salt_length: salt length
+    :return: list of dictionaries with the cost, the time per check and the logins per second
+    :rtype: list
+    """
+    results = []
+    for iterations in iterations_list:
+        method_string = "{}:{}".format(method, iterations) if method.startswith("pbkdf2:") \
+            else method
+        password_hash = generate_password_hash("benchmark-password", method=method_string,
+                                               salt_length=salt_length)
+        checks = 0
+        started = time.perf_counter()
+        while time.perf_counter() - started < duration:
+            check_password_hash(password_hash, "benchmark-password")
+            checks += 1
+        elapsed = time.perf_counter() - started
+        results.append(dict(method=method_string, iterations=iterations,
+                            milliseconds=elapsed * 1000 / checks,
+                            logins_per_second=checks / elapsed))
+    return results
+
+
+password_hasher = PasswordHasher()
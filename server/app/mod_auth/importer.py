@@ -0,0 +1,274 @@
+"""
+Bulk import of user accounts
+
+Streams users from a CSV or JSON lines file in bounded chunks and creates their UserProfile and
+UserAccount rows with bulk inserts, using PostgreSQL's COPY when it is available and SQLAlchemy
+Core executemany inserts otherwise. Passwords are hashed on a process pool. Every chunk is
+committed in its own transaction and recorded in a checkpoint file, so an import that fails part
+of the way through can be resumed from the last committed chunk.
+
+Each record needs an email and a password, username, first_name and last_name are optional.
+"""
+import csv
+import io
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import select
+from app import db
+from .hashing import password_hasher
+from .models import UserAccount, UserAccountStatus, UserProfile
+
+
+class ImportReport(object):
+    """
+    Running totals of an import
+    :cvar imported: number of users created
+    :cvar skipped: number of records skipped because they are invalid or the user already exists
+    :cvar chunks: number of chunks committed
+    """
+
+    def __init__(self, start_row=0):
+        self.start_row = start_row
+        self.imported = 0
+        self.skipped = 0
+        self.chunks = 0
+        self.started = time.time()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    @property
+    def rows_per_second(self):
+        elapsed = self.elapsed
+        return (self.imported + self.skipped) / elapsed if elapsed > 0 else 0.0
+
+    def __repr__(self):
+        return "Imported: {}, Skipped: {}, Chunks: {}, Elapsed: {:.1f}s, Rows/s: {:.1f}".format(
+            self.imported, self.skipped, self.chunks, self.elapsed, self.rows_per_second)
+
+
+class UserImporter(object):
+    """
+    Imports users from a CSV or JSON lines file
+    :cvar path: path of the file to import
+    :cvar chunk_size: number of records inserted per transaction
+    :cvar workers: number of processes used to hash passwords, 1 hashes them in this process
+    :cvar use_copy: whether to use COPY on PostgreSQL
+    :cvar confirmed: whether imported users have already confirmed their email
+    """
+
+    def __init__(self, path, chunk_size=1000, workers=None, use_copy=True, confirmed=False,
+                 checkpoint_path=None, log=print):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.workers = workers or os.cpu_count() or 1
+        self.use_copy = use_copy
+        self.confirmed = confirmed
+        self.checkpoint_path = checkpoint_path or path + ".checkpoint"
+        self.log = log
+
+    def read_records(self):
+        """
+        Streams the records of the import file
+        :return: generator of dictionaries, one per user
+        """
+        with open(self.path, newline="", encoding="utf-8") as import_file:
+            if self.path.endswith((".jsonl", ".json")):
+                for line in import_file:
+                    line = line.strip()
+                    if line:
+                        yield json.loads(line)
+            else:
+                for record in csv.DictReader(import_file):
+                    yield record
+
+    def load_checkpoint(self):
+        """
+        Number of records of the import file that have already been committed
+        :rtype: int
+        """
+        if not os.path.exists(self.checkpoint_path):
+            return 0
+        with open(self.checkpoint_path) as checkpoint:
+            state = json.load(checkpoint)
+        if state.get("path") != os.path.abspath(self.path):
+            return 0
+        return state.get("rows", 0)
+
+    def save_checkpoint(self, rows):
+        """
+        Records the number of committed records, the file is replaced atomically
+        :param rows: number of records read from the import file and committed
+        """
+        temporary_path = self.checkpoint_path + ".tmp"
+        with open(temporary_path, "w") as checkpoint:
+            json.dump(dict(path=os.path.abspath(self.path), rows=rows,
+                           updated=datetime.now().isoformat()), checkpoint)
+        os.replace(temporary_path, self.checkpoint_path)
+
+    def run(self, resume=False):
+        """
+        Imports the file
+        :param resume: continue from the last committed chunk recorded in the checkpoint file
+        :return: report of the import
+        :rtype: ImportReport
+        """
+        start_row = self.load_checkpoint() if resume else 0
+        report = ImportReport(start_row)
+        engine = db.engine
+        copy = self.use_copy and engine.dialect.name == "postgresql"
+        status_name = UserAccountStatus.EMAIL_CONFIRMED if self.confirmed \
+            else UserAccountStatus.EMAIL_NON_CONFIRMED
+        status_id = UserAccountStatus.lookup_id(status_name)
+
+        if start_row:
+            self.log("Resuming import after {} records".format(start_row))
+
+        executor = ProcessPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        try:
+            records = islice(self.read_records(), start_row, None)
+            rows_done = start_row
+            while True:
+                chunk = list(islice(records, self.chunk_size))
+                if not chunk:
+                    break
+
+                imported, skipped = self.import_chunk(engine, chunk, status_id, executor, copy)
+                rows_done += len(chunk)
+                self.save_checkpoint(rows_done)
+
+                report.imported += imported
+                report.skipped += skipped
+                report.chunks += 1
+                self.log("Chunk {}: {} imported, {} skipped, {} rows done, {:.1f} rows/s".format(
+                    report.chunks, imported, skipped, rows_done, report.rows_per_second))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        return report
+
+    def import_chunk(self, engine, chunk, status_id, executor=None, copy=False):
+        """
+        Inserts the users of one chunk in a single transaction
+        :param engine: database engine
+        :param chunk: list of records
+        :param status_id: account status of the new users
+        :param executor: process pool used to hash passwords
+        :param copy: use COPY instead of executemany inserts
+        :return: number of users imported and number of records skipped
+        :rtype: tuple
+        """
+        users = self.clean_chunk(engine, chunk)
+        skipped = len(chunk) - len(users)
+        if not users:
+            return 0, skipped
+
+        passwords = [user.pop("password") for user in users]
+        hash_password = password_hasher.hash_function()
+        if executor is not None:
+            chunksize = max(1, len(passwords) // (self.workers * 4))
+            hashes = list(executor.map(hash_password, passwords, chunksize=chunksize))
+        else:
+            hashes = [hash_password(password) for password in passwords]
+
+        now = datetime.now()
+        profiles = [dict(first_name=user["first_name"], last_name=user["last_name"],
+                         email=user["email"], accept_tos=True, date_created=now,
+                         date_modified=now) for user in users]
+
+        with engine.begin() as connection:
+            self.insert(connection, UserProfile.__table__, profiles, copy)
+
+            profile_table = UserProfile.__table__
+            profile_ids = {email: profile_id for email, profile_id in connection.execute(
+                select([profile_table.c.email, profile_table.c.id])
+                .where(profile_table.c.email.in_([user["email"] for user in users])))}
+
+            accounts = [dict(uuid=str(uuid.uuid4()), username=user["username"],
+                             email=user["email"], password_hash=password_hash, admin=False,
+                             registered_on=now, confirmed=self.confirmed,
+                             confirmed_on=now if self.confirmed else None,
+                             user_profile_id=profile_ids[user["email"]],
+                             user_account_status_id=status_id, date_created=now,
+                             date_modified=now)
+                        for user, password_hash in zip(users, hashes)]
+            self.insert(connection, UserAccount.__table__, accounts, copy)
+
+        return len(users), skipped
+
+    @staticmethod
+    def clean_chunk(engine, chunk):
+        """
+        Normalizes the records of a chunk and drops the invalid ones, duplicates and users that
+        already exist. Skipping existing users is what makes re-running a chunk safe
+        :param engine: database engine
+        :param chunk: list of records
+        :return: list of users to insert
+        :rtype: list
+        """
+        users, emails, usernames = [], set(), set()
+        for record in chunk:
+            email = (record.get("email") or "").strip()
+            password = record.get("password")
+            if not email or not password:
+                continue
+            username = (record.get("username") or email).strip()
+            if email in emails or username in usernames:
+                continue
+            emails.add(email)
+            usernames.add(username)
+            users.append(dict(email=email, username=username, password=password,
+                              first_name=(record.get("first_name") or "").strip(),
+                              last_name=(record.get("last_name") or "").strip()))
+
+        if not users:
+            return users
+
+        profile_table, account_table = UserProfile.__table__, UserAccount.__table__
+        with engine.connect() as connection:
+            existing_emails = {email for email, in connection.execute(
+                select([profile_table.c.email]).where(profile_table.c.email.in_(emails)))}
+            existing_emails.update(email for email, in connection.execute(
+                select([account_table.c.email]).where(account_table.c.email.in_(emails))))
+            existing_usernames = {username for username, in connection.execute(
+                select([account_table.c.username])
+                .where(account_table.c.username.in_(usernames)))}
+
+        return [user for user in users if user["email"] not in existing_emails and
+                user["username"] not in existing_usernames]
+
+    @staticmethod
+    def insert(connection, table, rows, copy=False):
+        """
+        Inserts rows into a table, with COPY if requested or with an executemany insert
+        :param connection: database connection within the chunk's transaction
+        :param table: table to insert into
+        :param rows: list of dictionaries with the same keys
+        :param copy: use PostgreSQL's COPY
+        """
+        if not copy:
+            connection.execute(table.insert(), rows)
+            return
+
+        columns = list(rows[0].keys())
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow(["\\N" if row[column] is None else row[column]
+                             for column in columns])
+        buffer.seek(0)
+
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_expert("COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(
+                table.name, ", ".join(columns)), buffer)
+        finally:
+            cursor.close()
@@ -0,0 +1,201 @@
+"""
+Write-behind tracker for the user account 'last seen' column
+
+Updating UserAccount.last_seen on every request turns every read into a row UPDATE and a
+transaction. Instead, the latest timestamp for each user id is kept in memory and flushed to
+the database in a single bulk UPDATE once the pending set grows beyond a size threshold or the
+oldest pending timestamp is older than the configured staleness bound. Whatever is still pending
+when the process exits is flushed as well.
+"""
+import atexit
+import os
+import threading
+import time
+from datetime import datetime
+
+from flask import has_app_context
+from sqlalchemy import bindparam
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app import db
+
+
+class LastSeenTracker(object):
+    """
+    Keeps the most recent 'last seen' timestamp per user id and writes them to the database in
+    bulk.
+    :cvar flush_interval: staleness bound in seconds, pending timestamps are never kept in memory
+     for longer than this (0 flushes on every touch)
+    :cvar max_pending: number of pending user ids that triggers a flush
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.flush_interval = 60
+        self.max_pending = 500
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._oldest_pending = None
+        self._flusher = None
+        self._flusher_pid = None
+        self._stopped = threading.Event()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Configures the tracker from the application configuration and registers the final flush
+        that will run on interpreter shutdown
+        :param app: current flask application
+        """
+        # flush anything that belongs to a previous application before switching over, what can
+        # not be written is dropped rather than written to the new application's database
+        if self.app is not None and self.app is not app:
+            self.flush()
+            with self._lock:
+                self._pending.clear()
+                self._oldest_pending = None
+
+        self.app = app
+        self.flush_interval = app.config.get("LAST_SEEN_FLUSH_INTERVAL", 60)
+        self.max_pending = app.config.get("LAST_SEEN_MAX_PENDING", 500)
+        app.extensions["last_seen_tracker"] = self
+
+        if not getattr(self, "_registered_atexit", False):
+            atexit.register(self.shutdown)
+            self._registered_atexit = True
+
+    def touch(self, user, when=None):
+        """
+        Records that the given user has been seen. The in memory user object is updated without
+        marking it as modified so that it will not be written by the request session.
+        :param user: the user account that has made a request
+        :param when: when the user was seen, defaults to now
+        """
+        when = when or datetime.now()
+
+        # update the loaded instance, if it is one, without flagging it as dirty
+        try:
+            set_committed_value(user, "last_seen", when)
+        except AttributeError:
+            pass
+
+        with self._lock:
+            self._pending[int(user.get_id())] = when
+            if self._oldest_pending is None:
+                self._oldest_pending = time.time()
+            due = self._flush_due()
+
+        if due:
+            self.flush()
+        else:
+            self._ensure_flusher()
+
+    def _flush_due(self):
+        """
+        Checks whether pending timestamps should be written now, callers must hold the lock
+        :return: True if the pending timestamps should be flushed
+        :rtype: bool
+        """
+        if len(self._pending) >= self.max_pending:
+            return True
+        return self._oldest_pending is not None and \
+            time.time() - self._oldest_pending >= self.flush_interval
+
+    def flush(self):
+        """
+        Writes all pending timestamps to the database in a single bulk UPDATE. The pending set is
+        swapped out under the lock so that requests are never blocked by the database write.
+        :return: number of user accounts updated
+        :rtype: int
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._oldest_pending = None
+
+        if not pending or self.app is None:
+            return 0
+
+        from .models import UserAccount
+
+        table = UserAccount.__table__
+        statement = table.update() \
+            .where(table.c.id == bindparam("user_id")) \
+            .values(last_seen=bindparam("seen_at"))
+        params = [dict(user_id=user_id, seen_at=seen_at) for user_id, seen_at in pending.items()]
+
+        # the flusher thread and the shutdown hook run without an application context, pushing one
+        # inside a request would end the request's session when it is popped
+        context = None if has_app_context() else self.app.app_context()
+        if context is not None:
+            context.push()
+
+        try:
+            with db.get_engine(self.app).begin() as connection:
+                connection.execute(statement, params)
+        except Exception as e:
+            # put the timestamps back, unless a newer one has been recorded in the meantime
+            with self._lock:
+                for user_id, seen_at in pending.items():
+                    self._pending.setdefault(user_id, seen_at)
+                if self._oldest_pending is None:
+                    self._oldest_pending = time.time()
+            self.app.logger.warning("Failed to flush last seen timestamps: {}".format(e))
+            return 0
+        finally:
+            if context is not None:
+                context.pop()
+
+        return len(params)
+
+    def _ensure_flusher(self):
+        """
+        Starts the background thread that enforces the staleness bound when there is no traffic
+        to trigger a flush. This is started lazily so that each forked worker gets its own thread
+        """
+        if self.flush_interval <= 0:
+            return
+        if self._flusher is not None and self._flusher_pid == os.getpid() and \
+                self._flusher.is_alive():
+            return
+
+        with self._lock:
+            if self._flusher is not None and self._flusher_pid == os.getpid() and \
+                    self._flusher.is_alive():
+                return
+            self._flusher_pid = os.getpid()
+            self._flusher = threading.Thread(target=self._run_flusher,
+                                             name="last-seen-flusher", daemon=True)
+            self._flusher.start()
+
+    def _run_flusher(self):
+        """
+        Periodically flushes pending timestamps until the tracker is shut down
+        """
+        while not self._stopped.wait(self._seconds_until_due()):
+            with self._lock:
+                due = self._flush_due()
+            if due:
+                self.flush()
+
+    def _seconds_until_due(self):
+        """
+        Time the flusher sleeps for, until the oldest pending timestamp reaches the staleness bound
+        or a whole interval when nothing is pending
+        :rtype: float
+        """
+        with self._lock:
+            if self._oldest_pending is None:
+                return self.flush_interval
+            return max(0.0, self._oldest_pending + self.flush_interval - time.time())
+
+    def shutdown(self):
+        """
+        Stops the background flusher and writes whatever is still pending
+        """
+        self._stopped.set()
+        self.flush()
+
+
+last_seen_tracker = LastSeenTracker()
@@ -5,21 +5,26 @@ UserAccountStatus deals with the current account status details
 UserAccount deals with authenticating the user, will handle login and authentication details
 UserProfile is the actual user profile and will be used to display the user profile data
 ExternalServiceAccount is for storing data for external service providers
+AsyncOperation is the ledger entry of a background task and AsyncOperationSummary the daily totals
+that are kept once ledger entries are compacted
 """
-from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, Boolean
+from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, Boolean, event, Float, \
+    Text, Date, Index
 from app.models import Base
 from abc import ABCMeta
 import uuid
-from werkzeug.security import generate_password_hash, check_password_hash
 from sqlalchemy.ext.declarative import declared_attr
 from flask_login import UserMixin
 from .. import db, login_manager
 from datetime import datetime
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, object_session, Session
+from sqlalchemy.exc import IntegrityError
 import json
 from time import gmtime
-from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from flask import current_app
+from .user_cache import user_cache
+from .hashing import password_hasher
+from .tokens import token_service
 
 
 class UserAccountStatus(db.Model):
@@ -34,13 +39,63 @@ class UserAccountStatus(db.Model):
     __tablename__ = "user_account_status"
     id = Column(Integer, primary_key=True, autoincrement=True)
     code = Column(String(40), nullable=False)
-    name = Column(String(200), nullable=False)
+    name = Column(String(200), nullable=False, unique=True)
+
+    EMAIL_NON_CONFIRMED = "EMAIL_NON_CONFIRMED"
+    EMAIL_CONFIRMED = "EMAIL_CONFIRMED"
+
+    # lookup rows every deployment starts with, keyed by name with their codes
+    DEFAULT_STATUSES = {
+        EMAIL_NON_CONFIRMED: "0",
+        EMAIL_CONFIRMED: "1",
+    }
 
     def __init__(self, code, name):
         self.code = code
         self.name = name
     user_account = relationship("UserAccount", backref="user_account_status", lazy="dynamic")
 
+    @classmethod
+    def seed_defaults(cls):
+        """
+        Inserts the default account statuses that do not exist yet
+        """
+        existing = {name for name, in db.session.query(cls.name)}
+        for name, code in cls.DEFAULT_STATUSES.items():
+            if name not in existing:
+                db.session.add(cls(code=code, name=name))
+        db.session.commit()
+
+    @classmethod
+    def lookup_id(cls, name):
+        """
+        Gets the id of the account status with the given name. Statuses are lookup rows, so ids
+        are cached for the lifetime of the application and a default status that is missing is
+        created the first time it is asked for
+        :param name: name of the account status, e.g. EMAIL_NON_CONFIRMED
+        :return: id of the account status
+        :rtype: int
+        """
+        status_ids = current_app.extensions.setdefault("user_account_status_ids", {})
+        if name in status_ids:
+            return status_ids[name]
+
+        status = cls.query.filter_by(name=name).order_by(cls.id).first()
+        if status is None:
+            if name not in cls.DEFAULT_STATUSES:
+                raise LookupError("Unknown account status {}".format(name))
+            try:
+                status = cls(code=cls.DEFAULT_STATUSES[name], name=name)
+                db.session.add(status)
+                db.session.commit()
+            except IntegrityError:
+                # another worker created it first
+                db.session.rollback()
+                status = cls.query.filter_by(name=name).first()
+
+        status_ids[name] = status.id
+        return status.id
+
     def __repr__(self):
         """
         Create human readable representation of user account status
@@ -143,14 +198,26 @@ class UserAccount(Base, UserMixin):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     @password.getter
     def get_password(self):
         return self.password_hash
 
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        """
+        Checks the given password against the stored hash. If the hash was created with an
+        outdated method or cost it is transparently replaced with one using the current settings,
+        the caller is responsible for committing that change
+        :param password: plain text password
+        :return: True if the password is correct
+        :rtype: bool
+        """
+        if not password_hasher.verify(self.password_hash, password):
+            return False
+        if password_hasher.needs_rehash(self.password_hash):
+            self.password_hash = password_hasher.hash(password)
+        return True
 
     def generate_reset_token(self, expiration=3600):
         """
@@ -158,8 +225,7 @@ class UserAccount(Base, UserMixin):
         :param expiration: expiration time,
         :return: reset token
         """
-        serializer = Serializer(current_app.config["SECRET_KEY"], expires_in=expiration)
-        return serializer.dumps({"reset": self.id})
+        return token_service.generate_token({"reset": self.id}, expiration)
 
     def generate_confirm_token(self, expiration=3600):
         """
@@ -167,9 +233,9 @@ class UserAccount(Base, UserMixin):
         :param expiration: time to expire
         :return: confirmation token
         """
-        serializer = Serializer(current_app.config["SECRET_KEY"], expires_in=expiration)
-        self.email_confirmation_token = serializer.dumps({"confirm": self.id})
-        return serializer.dumps({"confirm": self.id})
+        self.email_confirmation_token = token_service.generate_token({"confirm": self.id},
+                                                                     expiration)
+        return self.email_confirmation_token
 
     def generate_auth_token(self, expiration):
         """
@@ -177,8 +243,16 @@ class UserAccount(Base, UserMixin):
         :param expiration: expiration time
         :return:
         """
-        serializer = Serializer(current_app.config["SECRET_KEY"], expires_in=expiration)
-        return serializer.dumps({"id": self.id}).decode("ascii")
+        return token_service.generate_auth_token(self.id, expiration)
+
+    @staticmethod
+    def verify_auth_token(token):
+        """
+        Verifies an authentication token from its signature alone, without a database query
+        :param token: authentication token
+        :return: id of the user the token was created for, None if it is invalid or has expired
+        """
+        return token_service.verify_auth_token(token)
 
     def __repr__(self):
         return "Id: {},\n uuid: {}, Username: {} ProfileId:{}, AccountStatusId:{}" \
@@ -208,9 +282,82 @@ class UserAccount(Base, UserMixin):
 
 
 # This callback is used to reload the user object from the user ID stored in the session
+# the user cache is checked first so that authenticated requests do not all hit the database
 @login_manager.user_loader
 def load_user(user_id):
-    return UserAccount.query.get(int(user_id))
+    user_id = int(user_id)
+    return user_cache.get(user_id, lambda: UserAccount.query.get(user_id))
+
+
+class TokenUser(UserMixin):
+    """
+    User authenticated with a bearer token. It is built from the verified token alone, the user
+    account is only loaded if an attribute other than the id is used
+    :cvar id: id of the user account the token was created for
+    """
+
+    def __init__(self, user_id):
+        self.id = user_id
+        self._account = None
+
+    @property
+    def account(self):
+        """
+        User account of this user, loaded through the user cache on first use
+        :rtype: UserAccount
+        """
+        if self._account is None:
+            self._account = load_user(self.id)
+        return self._account
+
+    def __getattr__(self, name):
+        # private and SQLAlchemy attributes are not forwarded, so checking whether this is an ORM
+        # instance does not load the account
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.account, name)
+
+    def __repr__(self):
+        return "TokenUser Id: {}".format(self.id)
+
+
+# This callback is used to load the user from a bearer token sent in the Authorization header
+# the token is verified from its signature, without a database query or a session
+@login_manager.request_loader
+def load_user_from_request(request):
+    authorization = request.headers.get("Authorization", "")
+    if not authorization.startswith("Bearer "):
+        return None
+
+    user_id = token_service.verify_auth_token(authorization[len("Bearer "):].strip())
+    if user_id is None:
+        return None
+    return TokenUser(user_id)
+
+
+@event.listens_for(UserAccount, "after_update")
+@event.listens_for(UserAccount, "after_delete")
+def collect_changed_user(mapper, connection, target):
+    """
+    Notes the user accounts changed through the ORM, for example when their password is reset or
+    their email is confirmed, to remove them from the user cache once the changes are committed.
+    Removing them when they are flushed would let a concurrent request cache the old row again
+    before the commit
+    """
+    session = object_session(target)
+    if session is None:
+        user_cache.invalidate(target.id)
+    else:
+        session.info.setdefault("changed_users", set()).add(target.id)
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_cached_users(session):
+    """
+    Removes the user accounts changed by a committed transaction from the user cache
+    """
+    for user_id in session.info.pop("changed_users", ()):
+        user_cache.invalidate(user_id)
 
 
 class ExternalServiceAccount(db.Model):
@@ -285,33 +432,185 @@ class GoogleAccount(ExternalServiceAccount):
 
 class AsyncOperationStatus(Base):
     """
-    Dictionary table that stores 3 available statuses, pending, ok, error
+    Dictionary table that stores the available statuses of async operations, pending, started, ok
+    and error
+    :cvar __tablename__ name of this model as a table in the db
+    :cvar code unique code of the status
     """
     __tablename__ = "async_operation_status"
 
-    code = Column("code", String(20), nullable=True)
+    code = Column("code", String(20), nullable=True, unique=True)
+
+    PENDING = "pending"
+    STARTED = "started"
+    OK = "ok"
+    ERROR = "error"
+
+    # lookup rows every deployment starts with
+    DEFAULT_STATUSES = (PENDING, STARTED, OK, ERROR)
+
+    def __init__(self, code):
+        self.code = code
+
+    @classmethod
+    def seed_defaults(cls):
+        """
+        Inserts the default async operation statuses that do not exist yet
+        """
+        existing = {code for code, in db.session.query(cls.code)}
+        for code in cls.DEFAULT_STATUSES:
+            if code not in existing:
+                db.session.add(cls(code=code))
+        db.session.commit()
+
+    @classmethod
+    def lookup_id(cls, code, connection):
+        """
+        Gets the id of the status with the given code. Ids are cached for the lifetime of the
+        application and a missing default status is created the first time it is asked for. The
+        given connection is used instead of the session, so that the task ledger never flushes or
+        commits the session of the request it runs in
+        :param code: code of the status, e.g. pending
+        :param connection: database connection
+        :return: id of the status
+        :rtype: int
+        """
+        status_ids = current_app.extensions.setdefault("async_operation_status_ids", {})
+        if code in status_ids:
+            return status_ids[code]
+
+        table = cls.__table__
+        select = db.select([table.c.id]).where(table.c.code == code).order_by(table.c.id)
+        status_id = connection.execute(select).scalar()
+        if status_id is None:
+            if code not in cls.DEFAULT_STATUSES:
+                raise LookupError("Unknown async operation status {}".format(code))
+            status_id = connection.execute(table.insert().values(code=code)).inserted_primary_key[0]
+
+        status_ids[code] = status_id
+        return status_id
+
+    def to_json(self):
+        return dict(id=self.id, code=self.code)
+
+    def from_json(self, status):
+        self.code = json.loads(status)["code"]
 
     def __repr__(self):
-        pass
+        return "Id: {}, Code: {}".format(self.id, self.code)
 
 
 class AsyncOperation(Base):
     """
-
+    Ledger entry of a background task, from the moment it is enqueued until it finishes
+    :cvar __tablename__ name of this model as a table in the db
+    :cvar task_id unique id of the celery task
+    :cvar name name of the celery task
+    :cvar enqueued_at when the task was sent to the broker
+    :cvar started_at when a worker started running the task
+    :cvar finished_at when the task finished
+    :cvar queue_time seconds the task waited in the queue
+    :cvar duration seconds the task ran for
+    :cvar retries number of times the task was sent again
+    :cvar error error the task failed with
+    :cvar user_profile_id FK id of the profile of the user whose request enqueued the task
     """
     __tablename__ = "async_operation"
 
+    task_id = Column(String(155), nullable=False, unique=True)
+    name = Column(String(200), nullable=False)
+    enqueued_at = Column(DateTime, nullable=True)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    queue_time = Column(Float, nullable=True)
+    duration = Column(Float, nullable=True)
+    retries = Column(Integer, nullable=False, default=0)
+    error = Column(Text, nullable=True)
+
     async_operation_status_id = Column(Integer, ForeignKey(AsyncOperationStatus.id))
     user_profile_id = Column(Integer, ForeignKey(UserProfile.id))
 
     status = relationship("AsyncOperationStatus", foreign_keys=async_operation_status_id)
     user_profile = relationship("UserProfile", foreign_keys=user_profile_id)
 
+    # "my recent jobs" is read newest first per user, retention deletes the oldest entries
+    __table_args__ = (
+        Index("ix_async_operation_user_profile_id_date_created", "user_profile_id",
+              "date_created"),
+        Index("ix_async_operation_date_created", "date_created"),
+    )
+
+    def to_json(self):
+        return dict(
+            task_id=self.task_id,
+            name=self.name,
+            status=self.status.code if self.status is not None else None,
+            enqueued_at=self.enqueued_at,
+            started_at=self.started_at,
+            finished_at=self.finished_at,
+            queue_time=self.queue_time,
+            duration=self.duration,
+            retries=self.retries,
+            error=self.error,
+        )
+
+    def from_json(self, operation):
+        operation = json.loads(operation)
+        self.task_id = operation["task_id"]
+        self.name = operation["name"]
+
     def __repr__(self):
-        pass
+        return "Id: {}, TaskId: {}, Name: {}, StatusId: {}, ProfileId: {}\n " \
+               "Dates: [enqueued: {}, started: {}, finished: {}]\n " \
+               "Queue time: {}, Duration: {}, Retries: {}, Error: {}" \
+            .format(self.id, self.task_id, self.name, self.async_operation_status_id,
+                    self.user_profile_id, self.enqueued_at, self.started_at, self.finished_at,
+                    self.queue_time, self.duration, self.retries, self.error)
+
+
+class AsyncOperationSummary(Base):
+    """
+    Daily totals of the async operations of a task and user, which is what is kept of the ledger
+    entries once they are past their retention period
+    :cvar __tablename__ name of this model as a table in the db
+    :cvar day day the operations were enqueued on
+    :cvar name name of the celery task
+    :cvar user_profile_id FK id of the profile of the user whose requests enqueued the tasks
+    """
+    __tablename__ = "async_operation_summary"
+
+    day = Column(Date, nullable=False)
+    name = Column(String(200), nullable=False)
+    user_profile_id = Column(Integer, ForeignKey(UserProfile.id), nullable=True)
+    count = Column(Integer, nullable=False, default=0)
+    errors = Column(Integer, nullable=False, default=0)
+    total_queue_time = Column(Float, nullable=False, default=0.0)
+    total_duration = Column(Float, nullable=False, default=0.0)
+    max_queue_time = Column(Float, nullable=True)
+    max_duration = Column(Float, nullable=True)
+
+    __table_args__ = (
+        Index("ix_async_operation_summary_day_name_user_profile_id", "day", "name",
+              "user_profile_id"),
+    )
 
-# todo add events
-# event.listen(
-#     AsyncOperationStatus.__table__, "after_create",
-#     DDL(""" INSERT INTO async_operation_status (id,code) VALUES(1,'pending'),(2, 'ok'),(3, 'error'); """)
-# )
+    def to_json(self):
+        return dict(
+            day=self.day,
+            name=self.name,
+            count=self.count,
+            errors=self.errors,
+            average_queue_time=self.total_queue_time / self.count if self.count else None,
+            average_duration=self.total_duration / self.count if self.count else None,
+            max_queue_time=self.max_queue_time,
+            max_duration=self.max_duration,
+        )
+
+    def from_json(self, summary):
+        summary = json.loads(summary)
+        self.name = summary["name"]
+        self.count = summary["count"]
+
+    def __repr__(self):
+        return "Day: {}, Name: {}, ProfileId: {}, Count: {}, Errors: {}".format(
+            self.day, self.name, self.user_profile_id, self.count, self.errors)
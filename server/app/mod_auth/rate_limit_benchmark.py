@@ -0,0 +1,104 @@
+"""
+Load test of the login endpoint under a credential stuffing attack
+
+An attacker posting wrong passwords for the existing accounts from a single IP address is mixed in
+with users logging in with their right passwords from their own addresses, attack_ratio attempts
+per login. Every attempt that reaches the view costs a password check at the given cost, so without
+a rate limit the attack decides how many logins a worker still serves. The same traffic is replayed
+with the rate limiter on, where the attacker's attempts past its IP bucket are refused with a 429
+before any password is checked.
+"""
+import time
+
+from app import create_app, db, redis_db
+from app.mod_auth.hashing import password_hasher
+from app.mod_auth.models import UserAccount
+from app.rate_limit import rate_limiter
+
+ATTACKER_IP = "203.0.113.7"
+PASSWORD = "benchmark-password"
+
+
+def user_ip(index):
+    """
+    Address of the user with the given index, every user logs in from their own address
+    :rtype: str
+    """
+    return "10.{}.{}.{}".format(index // 65536 % 256, index // 256 % 256, index % 256)
+
+
+def load_test(client, iterations, users=50, attack_ratio=20, limited=True):
+    """
+    Replays the attack and the users' logins against a fresh application
+    :param client: redis client holding the buckets, they are removed afterwards
+    :param iterations: pbkdf2 iterations of the users' password hashes
+    :param users: number of users logging in, once each
+    :param attack_ratio: attempts of the attacker per login
+    :param limited: whether the rate limiter is on
+    :return: dictionary with the counts of requests, refusals and password checks and the logins
+     served per second
+    :rtype: dict
+    """
+    app = create_app("testing")
+    app.config.update(PASSWORD_HASH_ITERATIONS=iterations, RATE_LIMIT_ENABLED=limited,
+                      RATE_LIMIT_KEY_PREFIX="rate-limit-benchmark:")
+    redis_db.init_app(app, client=client)
+    password_hasher.init_app(app)
+    rate_limiter.init_app(app)
+
+    with app.app_context():
+        db.create_all()
+        # every account shares one hash, creating them is not part of the test
+        password_hash = password_hasher.hash(PASSWORD)
+        emails = ["user{}@example.com".format(index) for index in range(users)]
+        for index, email in enumerate(emails):
+            db.session.add(UserAccount(email=email, username="user{}".format(index),
+                                       password_hash=password_hash))
+        db.session.commit()
+        rate_limiter.clear()
+
+        attacker, user = app.test_client(), app.test_client()
+        result = dict(limited=limited, requests=0, refused=0, password_checks=0, logins=0)
+        started = time.perf_counter()
+        for index, email in enumerate(emails):
+            for attempt in range(attack_ratio):
+                target = emails[(index * attack_ratio + attempt) % users]
+                response = attacker.post("/auth/signup",
+                                         data=dict(email=target, password="wrong-password"),
+                                         environ_base=dict(REMOTE_ADDR=ATTACKER_IP))
+                record(result, response)
+
+            response = user.post("/auth/signup", data=dict(email=email, password=PASSWORD),
+                                 environ_base=dict(REMOTE_ADDR=user_ip(index)))
+            record(result, response)
+            result["logins"] += int(response.status_code == 200 and response.json["success"])
+        elapsed = time.perf_counter() - started
+
+        rate_limiter.clear()
+        db.session.remove()
+        db.drop_all()
+
+    result.update(seconds=elapsed, requests_per_second=result["requests"] / elapsed,
+                  logins_per_second=result["logins"] / elapsed)
+    return result
+
+
+def record(result, response):
+    """
+    Counts a response to the login endpoint, every response but a refusal checked a password
+    """
+    result["requests"] += 1
+    if response.status_code == 429:
+        result["refused"] += 1
+    else:
+        result["password_checks"] += 1
+
+
+def benchmark(client, iterations, users=50, attack_ratio=20):
+    """
+    Runs the load test without and with the rate limiter
+    :return: list of the results of both runs
+    :rtype: list
+    """
+    return [load_test(client, iterations, users, attack_ratio, limited)
+            for limited in (False, True)]
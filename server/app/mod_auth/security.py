@@ -4,35 +4,41 @@ Security util
 Will deal with security utility
 """
 
-from itsdangerous import URLSafeTimedSerializer
+from itsdangerous import BadSignature
 from flask import current_app, abort
 from flask_mail import Message
 from app import mail
-from flask import current_app, abort, render_template, url_for
+from flask import current_app, abort, url_for
 from flask_mail import Message
 from app import mail, celery
+from app.outbox import mail_outbox
+from .tokens import token_service
+
+
+def queue_mail(to, subject, template, **context):
+    """
+    Queues an email in the mail outbox, it is sent by the outbox's drain task along with the other
+    queued emails
+    :param to: recipient of this email
+    :param subject: subject of email
+    :param template: template to use in the email sent
+    :param context: per recipient variables of the template, e.g. the confirm_url
+    :return: id of the queued email
+    """
+    return mail_outbox.enqueue(to, subject, template, **context)
 
 
 @celery.task
 def send_mail_async(to, subject, template, confirm_url):
     """
-    Task to send mail asynchronously
+    Task to send mail asynchronously, kept for the tasks already in the broker, the email is now
+    queued in the mail outbox
     :param confirm_url: Url used to confirm user email
     :param template: template to use in the email sent
     :param subject: subject of email
     :param to: recipients of this email
     """
-    app = current_app._get_current_object()
-
-    msg = Message(
-        subject=app.config["MAIL_SUBJECT_PREFIX"] + " " + subject,
-        sender=current_app.config.get("MAIL_DEFAULT_SENDER"),
-        recipients=[to],
-    )
-    msg.html = render_template(template, confirm_url=confirm_url)
-
-    with current_app.app_context():
-        mail.send(msg)
+    return queue_mail(to, subject, template, confirm_url=confirm_url)
 
 
 def generate_confirmation_token(email):
@@ -42,8 +48,7 @@ def generate_confirmation_token(email):
     :param email: email address of registering user 
     :return: confirmation token
     """
-    serializer = URLSafeTimedSerializer(current_app.config.get("SECRET_KEY"))
-    return serializer.dumps(email, salt=current_app.config.get("SECURITY_PASSWORD_SALT"))
+    return token_service.generate_email_token(email)
 
 
 def confirm_token(token):
@@ -53,15 +58,13 @@ def confirm_token(token):
     :param token: token used in registration process
     :return: An email as long as the token has not expired
     """
-    serializer = URLSafeTimedSerializer(current_app.config.get("SECRET_KEY"))
     try:
-        email = serializer.loads(
+        email = token_service.load_email_token(
             token,
-            salt=current_app.config.get("SECURITY_PASSWORD_SALT"),
             max_age=86400  # 24 hours
         )
         return email
-    except:
+    except BadSignature:
         abort(404)
 
 
@@ -0,0 +1,283 @@
+"""
+Token service
+
+Creates and verifies the signed tokens used for email confirmation, password resets and API
+authentication. Serializers are built once per application and salt instead of on every call,
+their signers are reused and the keys they derive from the secret are computed only once.
+
+Key rotation is supported through SECRET_KEY_FALLBACKS, tokens are always signed with SECRET_KEY
+but are also accepted if they were signed with one of the fallback keys.
+
+Authentication tokens are verified from their signature alone and verified tokens are cached for a
+few seconds, which is what allows bearer token requests to be served without a database query.
+"""
+import threading
+import time
+
+from itsdangerous import BadSignature, SignatureExpired, Signer, TimestampSigner, \
+    TimedJSONWebSignatureSerializer, URLSafeTimedSerializer
+
+from app.cache import LRUCache
+
+
+class _PrecomputedKeyMixin(object):
+    """
+    Signer mixin that derives the signing key from the secret only once
+    """
+
+    def derive_key(self):
+        key = self.__dict__.get("_derived_key")
+        if key is None:
+            key = self._derived_key = super(_PrecomputedKeyMixin, self).derive_key()
+        return key
+
+
+class PrecomputedKeySigner(_PrecomputedKeyMixin, Signer):
+    pass
+
+
+class PrecomputedKeyTimestampSigner(_PrecomputedKeyMixin, TimestampSigner):
+    pass
+
+
+class _CachedSignerMixin(object):
+    """
+    Serializer mixin that reuses the signers it creates instead of creating one per token
+    """
+
+    def make_signer(self, *args, **kwargs):
+        signers = self.__dict__.setdefault("_signers", {})
+        key = (args, tuple(sorted(kwargs.items())))
+        signer = signers.get(key)
+        if signer is None:
+            signer = signers[key] = super(_CachedSignerMixin, self).make_signer(*args, **kwargs)
+        return signer
+
+
+class CachedURLSafeTimedSerializer(_CachedSignerMixin, URLSafeTimedSerializer):
+    default_signer = PrecomputedKeyTimestampSigner
+
+
+class CachedTimedJSONWebSignatureSerializer(_CachedSignerMixin, TimedJSONWebSignatureSerializer):
+    default_signer = PrecomputedKeySigner
+
+
+class TokenService(object):
+    """
+    Builds the serializers for the application's keys once and uses them to create and verify
+    tokens
+    :cvar secret_keys: keys tokens are verified with, the first one is used to sign
+    :cvar salt: default salt of email tokens
+    """
+
+    def __init__(self, app=None):
+        self.secret_keys = []
+        self.salt = None
+        self._email_serializers = {}
+        self._timed_serializers = {}
+        self._lock = threading.Lock()
+        self.verified_tokens = LRUCache(maxsize=4096, ttl=30)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Reads the signing keys and salt from the application configuration
+        :param app: current flask application
+        """
+        fallbacks = app.config.get("SECRET_KEY_FALLBACKS") or []
+        self.secret_keys = [app.config["SECRET_KEY"]] + [key for key in fallbacks if key]
+        self.salt = app.config.get("SECURITY_PASSWORD_SALT")
+        self._email_serializers = {}
+        self._timed_serializers = {}
+        self.verified_tokens = LRUCache(maxsize=app.config.get("AUTH_TOKEN_CACHE_SIZE", 4096),
+                                        ttl=app.config.get("AUTH_TOKEN_CACHE_TTL", 30))
+        app.extensions["token_service"] = self
+
+    def email_serializers(self, salt=None):
+        """
+        URL safe serializers for email tokens, one per key
+        :param salt: salt of the tokens, defaults to SECURITY_PASSWORD_SALT
+        :rtype: list
+        """
+        salt = salt or self.salt
+        serializers = self._email_serializers.get(salt)
+        if serializers is None:
+            with self._lock:
+                serializers = self._email_serializers.setdefault(salt, [
+                    CachedURLSafeTimedSerializer(key, salt=salt) for key in self.secret_keys])
+        return serializers
+
+    def timed_serializers(self, expires_in=3600):
+        """
+        JSON web signature serializers with the given expiration, one per key
+        :param expires_in: seconds signed tokens are valid for
+        :rtype: list
+        """
+        serializers = self._timed_serializers.get(expires_in)
+        if serializers is None:
+            with self._lock:
+                serializers = self._timed_serializers.setdefault(expires_in, [
+                    CachedTimedJSONWebSignatureSerializer(key, expires_in=expires_in)
+                    for key in self.secret_keys])
+        return serializers
+
+    def generate_email_token(self, email, salt=None):
+        """
+        Creates a token hiding the given email, used for confirmation and reset links
+        :param email: email address
+        :param salt: salt of the token
+        :rtype: str
+        """
+        return self.email_serializers(salt)[0].dumps(email)
+
+    def generate_email_tokens(self, emails, salt=None):
+        """
+        Creates tokens for many emails at once, e.g. for mass mailings
+        :param emails: iterable of email addresses
+        :param salt: salt of the tokens
+        :return: list of tokens in the order of the emails
+        :rtype: list
+        """
+        serializer = self.email_serializers(salt)[0]
+        return [serializer.dumps(email) for email in emails]
+
+    def load_email_token(self, token, max_age=86400, salt=None):
+        """
+        Gets the email hidden in a token
+        :param token: token created by generate_email_token
+        :param max_age: maximum age of the token in seconds
+        :param salt: salt of the token
+        :return: email address
+        :raises BadSignature: if the token is invalid or has expired
+        """
+        return self._loads(self.email_serializers(salt), token, max_age=max_age)
+
+    def generate_token(self, payload, expires_in=3600):
+        """
+        Creates an expiring JSON web signature token for the given payload
+        :param payload: dictionary to sign
+        :param expires_in: seconds the token is valid for
+        :rtype: str
+        """
+        return self.timed_serializers(expires_in)[0].dumps(payload).decode("ascii")
+
+    def generate_tokens(self, payloads, expires_in=3600):
+        """
+        Creates expiring tokens for many payloads at once
+        :param payloads: iterable of dictionaries
+        :param expires_in: seconds the tokens are valid for
+        :return: list of tokens in the order of the payloads
+        :rtype: list
+        """
+        serializer = self.timed_serializers(expires_in)[0]
+        return [serializer.dumps(payload).decode("ascii") for payload in payloads]
+
+    def load_token(self, token):
+        """
+        Verifies a JSON web signature token, the expiration is checked from the token itself
+        :param token: token created by generate_token
+        :return: signed payload
+        :rtype: dict
+        :raises BadSignature: if the token is invalid or has expired
+        """
+        return self._loads(self.timed_serializers(), token)
+
+    def generate_auth_token(self, user_id, expires_in=3600):
+        """
+        Creates an authentication token for the given user
+        :param user_id: id of the user account
+        :param expires_in: seconds the token is valid for
+        :rtype: str
+        """
+        return self.generate_token({"id": user_id}, expires_in)
+
+    def verify_auth_token(self, token):
+        """
+        Verifies an authentication token without touching the database. Verified tokens are
+        cached briefly, never beyond their expiration, so that repeated requests with the same
+        token skip the signature check
+        :param token: authentication token
+        :return: id of the authenticated user or None if the token is invalid or has expired
+        """
+        user_id = self.verified_tokens.get(token)
+        if user_id is not None:
+            return user_id
+
+        try:
+            payload, header = self._loads(self.timed_serializers(), token, return_header=True)
+            user_id = payload.get("id")
+        except (BadSignature, AttributeError):
+            return None
+
+        if user_id is not None:
+            expires_in = header.get("exp", 0) - time.time()
+            self.verified_tokens.set(token, user_id, ttl=min(self.verified_tokens.ttl, expires_in))
+        return user_id
+
+    @staticmethod
+    def _loads(serializers, token, **kwargs):
+        """
+        Verifies a token with every key, starting with the current one
+        """
+        error = None
+        for serializer in serializers:
+            try:
+                return serializer.loads(token, **kwargs)
+            except SignatureExpired:
+                # the signature is valid, so other keys would not help
+                raise
+            except BadSignature as e:
+                error = e
+        raise error or BadSignature("No signing keys configured")
+
+
+def benchmark(secret_key, salt, count=10000):
+    """
+    Compares creating tokens with a new serializer per token, as it used to be done, with the
+    token service
+    :param secret_key: secret key to sign with
+    :param salt: salt of email tokens
+    :param count: number of tokens created by each method
+    :return: list of dictionaries with the tokens per second of each method
+    :rtype: list
+    """
+    service = TokenService()
+    service.secret_keys = [secret_key]
+    service.salt = salt
+    emails = ["user{}@example.com".format(index) for index in range(count)]
+
+    def per_call_email_tokens():
+        for email in emails:
+            URLSafeTimedSerializer(secret_key).dumps(email, salt=salt)
+
+    def per_call_auth_tokens():
+        for index in range(count):
+            TimedJSONWebSignatureSerializer(secret_key, expires_in=3600).dumps({"id": index})
+
+    def service_email_tokens():
+        for email in emails:
+            service.generate_email_token(email)
+
+    def service_auth_tokens():
+        for index in range(count):
+            service.generate_auth_token(index)
+
+    def service_batch_email_tokens():
+        service.generate_email_tokens(emails)
+
+    results = []
+    for name, function in (("email tokens, serializer per call", per_call_email_tokens),
+                           ("email tokens, token service", service_email_tokens),
+                           ("email tokens, token service batch", service_batch_email_tokens),
+                           ("auth tokens, serializer per call", per_call_auth_tokens),
+                           ("auth tokens, token service", service_auth_tokens)):
+        started = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - started
+        results.append(dict(name=name, count=count, tokens_per_second=count / elapsed))
+    return results
+
+
+token_service = TokenService()
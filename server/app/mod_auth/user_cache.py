@@ -0,0 +1,194 @@
+"""
+User object cache sitting in front of the login manager's user loader
+
+Without it, every authenticated request costs a query on the user_account table. The column
+values of loaded user accounts are cached, either in an in process LRU with a time to live or in
+Redis, and a session bound instance is rebuilt from them without a round trip to the database.
+Entries are invalidated whenever a change of a user account made through the ORM is committed.
+The in process LRU is private to every worker, which keeps serving its own copy until the time to
+live runs out, so deployments with several workers use the Redis backend.
+"""
+import pickle
+import threading
+
+from sqlalchemy.orm import make_transient_to_detached
+
+from app import db, redis_db
+from app.cache import LRUCache
+from app.metrics import metrics
+from app.replicas import primary
+
+
+class MemoryUserCacheBackend(object):
+    """
+    Keeps cached user accounts in an in process LRU cache
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.cache = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, user_id):
+        return self.cache.get(user_id)
+
+    def set(self, user_id, values):
+        self.cache.set(user_id, values)
+
+    def delete(self, user_id):
+        self.cache.delete(user_id)
+
+    def clear(self):
+        self.cache.clear()
+
+    def __len__(self):
+        return len(self.cache)
+
+
+class RedisUserCacheBackend(object):
+    """
+    Keeps cached user accounts in Redis so that the cache is shared by all workers
+    :cvar key_prefix: prefix of the keys used to store the cached user accounts
+    """
+    key_prefix = "user-cache:"
+
+    def __init__(self, client, ttl):
+        self.client = client
+        self.ttl = ttl
+
+    def get(self, user_id):
+        payload = self.client.get(self.key_prefix + str(user_id))
+        return pickle.loads(payload) if payload is not None else None
+
+    def set(self, user_id, values):
+        self.client.setex(self.key_prefix + str(user_id), self.ttl, pickle.dumps(values))
+
+    def delete(self, user_id):
+        self.client.delete(self.key_prefix + str(user_id))
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.key_prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+    def __len__(self):
+        return sum(1 for _ in self.client.scan_iter(match=self.key_prefix + "*"))
+
+
+class UserCache(object):
+    """
+    Cache of user accounts keyed by their id. The backend is selected with the USER_CACHE_BACKEND
+    configuration, 'memory', 'redis' or None to disable caching
+    """
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Creates the configured cache backend for the application
+        :param app: current flask application
+        """
+        backend = app.config.get("USER_CACHE_BACKEND")
+        ttl = app.config.get("USER_CACHE_TTL", 300)
+
+        if backend == "memory":
+            self.backend = MemoryUserCacheBackend(app.config.get("USER_CACHE_SIZE", 1024), ttl)
+        elif backend == "redis":
+            self.backend = RedisUserCacheBackend(redis_db.get_client(app), ttl)
+        else:
+            self.backend = None
+
+        self.hits = self.misses = 0
+        app.extensions["user_cache"] = self
+
+    def get(self, user_id, loader):
+        """
+        Gets the user account with the given id, falling back to the loader on a cache miss
+        :param user_id: id of the user account
+        :param loader: callable returning the user account from the database
+        :return: user account attached to the current session or None
+        """
+        if self.backend is None:
+            return loader()
+
+        values = self.backend.get(user_id)
+        if values is not None:
+            self._count(hit=True)
+            return self._restore(values)
+
+        self._count(hit=False)
+        # what is cached is read from the primary, a lagging replica would cache a stale row for
+        # the whole time to live
+        with primary(db.session):
+            user = loader()
+        if user is not None:
+            self.backend.set(user_id, self._dump(user))
+        return user
+
+    def invalidate(self, user_id):
+        """
+        Removes the cached user account with the given id
+        :param user_id: id of the user account
+        """
+        if self.backend is not None and user_id is not None:
+            self.backend.delete(user_id)
+
+    def clear(self):
+        """
+        Removes all cached user accounts and resets the counters
+        """
+        if self.backend is not None:
+            self.backend.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        """
+        Hit and miss counters of this worker, used to size the cache
+        :return: dictionary with the cache statistics
+        :rtype: dict
+        """
+        lookups = self.hits + self.misses
+        return dict(backend=type(self.backend).__name__ if self.backend is not None else None,
+                    size=len(self.backend) if self.backend is not None else 0,
+                    hits=self.hits, misses=self.misses,
+                    hit_ratio=float(self.hits) / lookups if lookups else 0.0)
+
+    def _count(self, hit):
+        metrics.cache_lookup("user", hit)
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @staticmethod
+    def _dump(user):
+        """
+        Column values of the user account, which is what is kept in the cache
+        :param user: user account to cache
+        :return: dictionary of column names and values
+        :rtype: dict
+        """
+        return {column.key: getattr(user, column.key) for column in user.__table__.columns}
+
+    @staticmethod
+    def _restore(values):
+        """
+        Rebuilds a user account from cached column values and attaches it to the current session
+        without loading it from the database
+        :param values: cached column values
+        :return: user account attached to the current session
+        """
+        from .models import UserAccount
+
+        user = UserAccount(**values)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+
+user_cache = UserCache()
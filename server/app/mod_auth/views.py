@@ -1,17 +1,21 @@
 from . import auth
 from app import db
 from flask_login import current_user
-from .security import generate_confirmation_token, confirm_token, send_mail_async
-from flask import jsonify, request, redirect, url_for, abort, render_template
+from .security import generate_confirmation_token, confirm_token, queue_mail
+from .tokens import token_service
+from flask import jsonify, request, redirect, url_for, abort, render_template, current_app
 from app import db
+from app.rate_limit import rate_limit
 from .forms import ResetPasswordForm
 import requests
 from datetime import datetime
+from sqlalchemy.exc import IntegrityError
 from flask_login import current_user, login_user, logout_user, login_required
 from .models import UserProfile, UserAccount, UserAccountStatus, FacebookAccount
 
 
 @auth.route("register", methods=["GET", "POST"])
+@rate_limit("register")
 def register():
     """
     Registers a new user, get request data, parse it and register user accordingly
@@ -23,76 +27,92 @@ def register():
     """
     # if the data from request values is available, perform data transaction
     if request.method == "POST":
+        # create the new user and store values in dict
         email = request.values.get("email")
-        user_account = UserAccount.query.filter_by(email=email).first()
+        first_name = request.values.get("first_name")
+        last_name = request.values.get("last_name")
+        username = request.values.get("username")
+        password = request.values.get("password")
+
+        # the NOT NULL constraints would fail the insert as well, but could not be told apart from
+        # an existing user
+        missing = [name for name, value in (("email", email), ("username", username),
+                                            ("password", password), ("first_name", first_name),
+                                            ("last_name", last_name)) if not value]
+        if missing:
+            return jsonify(dict(response=400, message="Missing required fields",
+                                fields=missing)), 400
+
+        # create a new user profile
+        new_user_profile = UserProfile(
+            email=email,
+            first_name=first_name,
+            last_name=last_name,
+            accept_tos=True,
+        )
+
+        # create a token from the new user's email, this does not need the account to be saved
+        token = generate_confirmation_token(email)
 
-        # check if the user already exists
-        if user_account is not None:
+        # the new account references the cached EMAIL_NON_CONFIRMED lookup row instead of
+        # creating a new account status for every user
+        new_user_account = UserAccount(
+            email=email,
+            username=username,
+            password=password,
+            email_confirmation_token=token,
+            user_profile=new_user_profile,
+            user_account_status_id=UserAccountStatus.lookup_id(
+                UserAccountStatus.EMAIL_NON_CONFIRMED)
+        )
+
+        # profile and account are inserted in a single transaction. the unique constraints on the
+        # email and username are the existence check, so no query is made beforehand
+        db.session.add(new_user_profile)
+        db.session.add(new_user_account)
+        try:
+            db.session.commit()
+        except IntegrityError as error:
+            db.session.rollback()
+            if not is_unique_violation(error):
+                current_app.logger.warning("Registration failed: {}".format(error.orig))
+                return jsonify(dict(response=400, message="Registration failed")), 400
             # return registration failed message back to client
             return jsonify(dict(response=400, message="User already exists"))
-        else:
-            # create the new user and store values in dict
-            email = request.values.get("email")
-            first_name = request.values.get("first_name")
-            last_name = request.values.get("last_name")
-            username = request.values.get("username")
-            password = request.values.get("password")
-
-            # create a new user profile
-            new_user_profile = UserProfile(
-                email=email,
-                first_name=first_name,
-                last_name=last_name,
-                accept_tos=True,
-            )
-
-            # add the new user profile and commit
-            db.session.add(new_user_profile)
-            db.session.commit()
-
-            # now we add the status of this new account and commit it
-            new_user_account_status = UserAccountStatus(code="0", name="EMAIL_NON_CONFIRMED")
-
-            db.session.add(new_user_account_status)
-            db.session.commit()
-
-            # add the new user account and commit it
-            new_user_account = UserAccount(
-                email=email,
-                username=username,
-                password=password,
-                user_profile_id=new_user_profile.id,
-                user_account_status_id=new_user_account_status.id
-            )
-
-            db.session.add(new_user_account)
-            db.session.commit()
-
-            # create a token from the new user account
-            token = new_user_account.generate_confirm_token()
 
-            # _external adds the full absolute URL that includes the hostname and port
-            confirm_url = url_for("auth.confirm_email", token=token, _external=True)
+        # _external adds the full absolute URL that includes the hostname and port
+        confirm_url = url_for("auth.confirm_email", token=token, _external=True)
 
-            # send user confirmation email asynchronously
-            # Todo: fails to send email, why?
-            send_mail_async.delay(new_user_account.email, "Please Confirm you email",
-                                  "auth.confirm_email.html", confirm_url)
+        # queue the confirmation email, the mail outbox sends it asynchronously
+        queue_mail(new_user_account.email, "Please Confirm you email",
+                   "auth.confirm_email.html", confirm_url=confirm_url)
 
-            # log in the new user
-            login_user(new_user_account)
+        # log in the new user
+        login_user(new_user_account)
 
-            # post a success message back to client so that the client can redirect user
-            # to login
-            return jsonify(dict(status="success", message="User created",
-                                state="User Logged in", response=200,
-                                confirm_email_sent=True))
+        # post a success message back to client so that the client can redirect user
+        # to login
+        return jsonify(dict(status="success", message="User created",
+                            state="User Logged in", response=200,
+                            confirm_email_sent=True))
 
     elif request.method == "GET":
         return jsonify(dict())
     return jsonify(dict())
 
 
+def is_unique_violation(error):
+    """
+    Whether an integrity error was raised by a unique constraint, e.g. an email or username that is
+    already registered, rather than by another constraint
+    :param error: IntegrityError raised by the database
+    :rtype: bool
+    """
+    # postgresql reports the SQLSTATE of the violation, SQLite only its message
+    return getattr(error.orig, "pgcode", None) == "23505" or \
+        "UNIQUE constraint failed" in str(error.orig)
+
+
 @auth.route('confirm/<token>')
 # @login_required
 def confirm_email(token):
@@ -124,6 +144,7 @@ def confirm_email(token):
     if user.email == email:
         user.confirmed = True
         user.confirmed_on = datetime.now()
+        user.user_account_status_id = UserAccountStatus.lookup_id(UserAccountStatus.EMAIL_CONFIRMED)
 
         # update the confirmed_on column
         db.session.add(user)
@@ -143,6 +164,7 @@ def login():
 
 
 @auth.route("signup", methods=["GET", "POST"])
+@rate_limit("login")
 def signup():
     pass
     if request.method == "POST":
@@ -156,6 +178,10 @@ def signup():
         # if the user exists, check their password
         if user is not None:
             if user.verify_password(user_password):
+                # save the password hash if it has been upgraded to the current settings
+                if db.session.is_modified(user):
+                    db.session.commit()
+
                 # log in the user
                 login_user(user)
 
@@ -171,7 +197,23 @@ def signup():
     return jsonify(dict())
 
 
+@auth.route("token", methods=["GET", "POST"])
+@login_required
+def auth_token():
+    """
+    Creates an authentication token for the logged in user. The token can then be sent as a
+    bearer token in the Authorization header of API requests, which are authenticated without
+    a session or a database query
+    :return: JSON response with the token and the number of seconds it is valid for
+    :rtype: dict
+    """
+    expiration = current_app.config.get("AUTH_TOKEN_EXPIRATION", 3600)
+    token = token_service.generate_auth_token(int(current_user.get_id()), expiration)
+    return jsonify(dict(token=token, expiration=expiration, success=True))
+
+
 @auth.route("reset", methods=["GET", "POST"])
+@rate_limit("reset_password")
 def reset_password():
     """
     Resets the user's password if they have forgotten it. In this case, we shall get the user email
@@ -190,9 +232,9 @@ def reset_password():
         # create the recover url to be sent in the email
         recover_url = url_for("auth.reset_with_token", token=token, _external=True)
 
-        # send user confirmation email asynchronously
-        # Todo: fails to send email, why?
-        send_mail_async.delay(email, "Please reset requested", "auth.reset_email.html", recover_url)
+        # queue the reset email, the mail outbox sends it asynchronously
+        queue_mail(email, "Please reset requested", "auth.reset_email.html",
+                   recover_url=recover_url)
 
         return jsonify(dict(message="Password reset sent", success=True))
 
@@ -222,6 +264,7 @@ def reset_with_token(token):
 
         user.confirmed = True
         user.confirmed_on = datetime.now()
+        user.user_account_status_id = UserAccountStatus.lookup_id(UserAccountStatus.EMAIL_CONFIRMED)
 
         # update the confirmed_on column
         db.session.add(user)
@@ -1,32 +1,83 @@
 """
 Tasks that will be carried out by celery when this module is called upon.
 
-Will run tasks in the background and fetch related data
+Will run tasks in the background and fetch related data. Celery beat refreshes every configured news
+source on its own schedule, see news_refresh_schedule, so the news are crawled ahead of time
+instead of when a user asks for them.
 """
+import random
+
+from flask import current_app
+
 from app import celery
-# from app import redis_db
-import json
-import newspaper
-import time
+from app.mod_blog.models import Article
+from app.mod_blog.news_cache import news_cache
+from app.mod_tasks.progress import ProgressTask
 
 
-@celery.task(bind=True)
-def fetch_news(self):
+def news_refresh_schedule(sources):
+    """
+    Celery beat schedule refreshing every news source at its own interval
+    :param sources: dictionary of source names and their settings, NEWS_SOURCES
+    :return: celery beat schedule
+    :rtype: dict
+    """
+    return {
+        "refresh-news-{}".format(name): {
+            "task": refresh_news_source.name,
+            "schedule": float(settings.get("interval", 900)),
+            "args": (name,),
+        }
+        for name, settings in sources.items()
+    }
+
+
+@celery.task
+def refresh_news_source(name):
+    """
+    Started by celery beat, dispatches the crawl of a news source after a random delay so that
+    sources sharing a schedule, or every worker restarted at the same time, do not all crawl at
+    once. Nothing is dispatched if the source is already being crawled
+    :param name: name of the news source in NEWS_SOURCES
+    :return: id of the task crawling the source
+    """
+    settings = current_app.config["NEWS_SOURCES"][name]
+    countdown = random.uniform(0, settings.get("jitter", 0))
+
+    return news_cache.refresh(name, fetch_news, name, settings["url"], settings.get("limit"),
+                              countdown=countdown)
+
+
+@celery.task(bind=True, base=ProgressTask)
+def fetch_news(self, feed, url, limit=None):
     """
     fetch the news and blog posts for the blogs and news section
-    This will be done on a different thread
-    :return: a dictionary with the blogs and news items
+    This will be done on a different thread. The source's category pages and feeds are crawled
+    concurrently by the news crawler and the articles are stored in the article store, from where
+    they are served to the clients. The news cache keeps the url hashes of the latest crawl and
+    when it happened, and the refresh lock of the feed is released once done. Every fetched article
+    is published on the task's progress channel as soon as it is crawled
+    :param feed: name of the feed in the news cache, also the name of the source in NEWS_SOURCES
+    :param url: url of the news site to crawl
+    :param limit: maximum number of articles to keep
+    :return: number of articles stored
     """
-    self.update_state(state="PENDING")
+    # imported here, web processes only ever send this task
+    from app.mod_blog.crawler import get_crawler
 
-    results = []
-    investopedia = newspaper.build("http://www.investopedia.com/")
+    self.update_state(state="PENDING")
 
-    for categories in investopedia.category_urls():
-        self.update_state(state="PROGRESS")
-        results.append(categories)
+    try:
+        settings = dict(current_app.config["NEWS_SOURCES"].get(feed, {}), url=url, limit=limit)
+        self.update_state(state="PROGRESS", meta={"current": 0, "total": None})
+        results = get_crawler().crawl(
+            {feed: settings},
+            progress=lambda done, total, article: self.progress(done, total, article=article))
+        stored = Article.upsert_many(feed, results, source_url=url)
+        news_cache.set(feed, [article["url_hash"] for article in results])
+    finally:
+        news_cache.release(feed, self.request.id)
 
-    self.update_state(state="COMPLETE", meta={"result": results})
-    time.sleep(1)
+    self.update_state(state="COMPLETE", meta={"stored": stored})
 
-    return json.dumps(results)
+    return stored
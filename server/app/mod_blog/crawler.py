@@ -0,0 +1,407 @@
+"""
+News crawler
+
+Crawls many news sources concurrently. Every source has one or more category pages, whose links
+to articles are followed, and optionally RSS or Atom feeds, whose entries are used as they are.
+Pages are fetched by a bounded thread pool through a single HTTP session, so connections to a host
+are reused, while the number of concurrent requests to any one host is limited.
+
+Pages are fetched with conditional requests. The ETag and Last-Modified validators of every page
+are remembered along with what was parsed from it, a page that has not changed since the previous
+crawl is answered with a 304 and is neither downloaded nor parsed again.
+
+The output of a crawl is a single list of articles, merged from all sources, deduplicated by their
+canonical url and sorted newest first.
+"""
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urldefrag, urljoin, urlsplit
+
+import requests
+from flask import current_app
+from lxml import etree, html
+from requests.adapters import HTTPAdapter
+
+from app.cache import LRUCache
+
+ATOM_NAMESPACE = "{http://www.w3.org/2005/Atom}"
+
+# links to these are never articles
+IGNORED_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".svg", ".pdf", ".css", ".js", ".xml",
+                      ".zip", ".mp3", ".mp4")
+
+
+def url_hash(url):
+    """
+    Hash identifying an article by its url
+    :rtype: str
+    """
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+
+def normalize_date(value):
+    """
+    Converts the publication dates found in feeds and article pages to ISO 8601 in UTC
+    :param value: RFC 822 or ISO 8601 date
+    :return: ISO 8601 date or None if it could not be parsed
+    """
+    if not value:
+        return None
+    value = value.strip()
+
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        date = None
+
+    if date is None:
+        for pattern, length in (("%Y-%m-%dT%H:%M:%S", 19), ("%Y-%m-%d %H:%M:%S", 19),
+                                ("%Y-%m-%d", 10)):
+            try:
+                date = datetime.strptime(value[:length], pattern)
+                break
+            except ValueError:
+                continue
+        else:
+            return None
+
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date.isoformat()
+
+
+def looks_like_article(url):
+    """
+    Guesses whether a link found on a category page leads to an article. Article urls end with a
+    slug or an id, e.g. /news/2017/05/markets-rally or /articles/12345
+    :rtype: bool
+    """
+    segments = [segment for segment in urlsplit(url).path.split("/") if segment]
+    if not segments:
+        return False
+    last = segments[-1].lower()
+    if last.endswith(IGNORED_EXTENSIONS):
+        return False
+    return "-" in last or any(character.isdigit() for character in last)
+
+
+def parse_links(url, content):
+    """
+    Article links of a category page, in the order they appear
+    :param url: url of the category page
+    :param content: HTML of the category page
+    :return: absolute urls of the articles, on the same host as the page
+    :rtype: list
+    """
+    document = html.fromstring(content, base_url=url)
+    host = urlsplit(url).netloc
+    links, seen = [], set()
+
+    for element, _, link, _ in document.iterlinks():
+        if element.tag != "a":
+            continue
+        link = urldefrag(urljoin(url, link))[0]
+        if link in seen or link == url or urlsplit(link).netloc != host:
+            continue
+        seen.add(link)
+        if looks_like_article(link):
+            links.append(link)
+    return links
+
+
+def parse_feed(url, content):
+    """
+    Articles of an RSS or Atom feed
+    :param url: url of the feed
+    :param content: XML of the feed
+    :return: list of articles
+    :rtype: list
+    """
+    parser = etree.XMLParser(resolve_entities=False, no_network=True, recover=True)
+    root = etree.fromstring(content, parser=parser)
+    if root is None:
+        return []
+
+    articles = []
+    for item in root.iter("item"):
+        link = urljoin(url, (item.findtext("link") or "").strip())
+        if link:
+            articles.append(article(link, item.findtext("title"), item.findtext("description"),
+                                    published_at=item.findtext("pubDate")))
+
+    for entry in root.iter(ATOM_NAMESPACE + "entry"):
+        element = entry.find(ATOM_NAMESPACE + "link")
+        link = urljoin(url, element.get("href", "")) if element is not None else ""
+        if link:
+            published_at = entry.findtext(ATOM_NAMESPACE + "published") or \
+                entry.findtext(ATOM_NAMESPACE + "updated")
+            authors = [name.strip() for name in
+                       entry.xpath("atom:author/atom:name/text()",
+                                   namespaces={"atom": ATOM_NAMESPACE[1:-1]})]
+            articles.append(article(link, entry.findtext(ATOM_NAMESPACE + "title"),
+                                    entry.findtext(ATOM_NAMESPACE + "summary"),
+                                    authors=authors, published_at=published_at))
+    return articles
+
+
+def parse_article(url, content):
+    """
+    Title, summary, image, authors and publication date of an article page, read from its
+    OpenGraph and standard meta tags
+    :param url: url of the article
+    :param content: HTML of the article
+    :return: article
+    :rtype: dict
+    """
+    document = html.fromstring(content, base_url=url)
+
+    def meta(*names):
+        for name in names:
+            values = document.xpath("//meta[@property=$name or @name=$name]/@content", name=name)
+            if values and values[0].strip():
+                return values[0].strip()
+        return None
+
+    canonical = document.xpath("//link[@rel='canonical']/@href")
+    if canonical:
+        url = urljoin(url, canonical[0])
+
+    title = meta("og:title", "twitter:title") or document.findtext(".//title")
+    summary = meta("og:description", "description", "twitter:description")
+    if not summary:
+        paragraphs = document.xpath("//p")
+        summary = paragraphs[0].text_content()[:300] if paragraphs else None
+
+    published_at = meta("article:published_time", "pubdate", "date")
+    if not published_at:
+        times = document.xpath("//time/@datetime")
+        published_at = times[0] if times else None
+
+    author = meta("author", "article:author")
+    authors = [name.strip() for name in author.split(",")] if author else []
+
+    image = meta("og:image", "twitter:image")
+    return article(url, title, summary, authors=authors,
+                   image=urljoin(url, image) if image else None, published_at=published_at)
+
+
+def article(url, title, summary, authors=None, image=None, published_at=None):
+    """
+    Article in the form it is cached and served to the clients
+    :rtype: dict
+    """
+    return dict(url=url, url_hash=url_hash(url), title=(title or "").strip(),
+                summary=(summary or "").strip(), authors=authors or [], image=image,
+                published_at=normalize_date(published_at))
+
+
+class Crawler(object):
+    """
+    Concurrent crawler of news sources
+    :cvar max_workers: number of pages fetched at the same time
+    :cvar per_host: number of pages fetched at the same time from any one host
+    :cvar timeout: seconds to wait for a response
+    """
+    user_agent = "Arco news crawler"
+
+    def __init__(self, max_workers=16, per_host=4, timeout=10, validators_size=10000,
+                 validators_ttl=86400, app=None):
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self.validators = LRUCache(maxsize=validators_size, ttl=validators_ttl)
+        self._host_semaphores = {}
+        self._lock = threading.Lock()
+        self._counters = dict(requests=0, not_modified=0, errors=0, bytes=0)
+        self.session = self.create_session()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Reads the crawler settings from the application configuration
+        :param app: current flask application
+        """
+        self.max_workers = app.config.get("NEWS_CRAWLER_WORKERS", 16)
+        self.per_host = app.config.get("NEWS_CRAWLER_PER_HOST", 4)
+        self.timeout = app.config.get("NEWS_CRAWLER_TIMEOUT", 10)
+        self._host_semaphores = {}
+        self.session = self.create_session()
+        app.extensions["news_crawler"] = self
+
+    def create_session(self):
+        """
+        HTTP session shared by all fetches, with a connection pool large enough for every worker
+        :rtype: requests.Session
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers["User-Agent"] = self.user_agent
+        return session
+
+    def host_semaphore(self, url):
+        host = urlsplit(url).netloc
+        semaphore = self._host_semaphores.get(host)
+        if semaphore is None:
+            with self._lock:
+                semaphore = self._host_semaphores.setdefault(
+                    host, threading.BoundedSemaphore(self.per_host))
+        return semaphore
+
+    def fetch(self, url, parse):
+        """
+        Fetches a page with a conditional request and parses it. If the page has not changed since
+        it was last fetched, what was parsed from it then is returned
+        :param url: url of the page
+        :param parse: callable parsing the page, called with the url and the content
+        :return: parsed page or None if it could not be fetched
+        """
+        cached = self.validators.get(url)
+        headers = {}
+        if cached is not None:
+            etag, last_modified, _ = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        try:
+            with self.host_semaphore(url):
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
+                content = response.content
+        except requests.RequestException:
+            self._count(errors=1)
+            return None
+
+        if response.status_code == 304 and cached is not None:
+            self._count(requests=1, not_modified=1)
+            return cached[2]
+
+        if response.status_code != 200:
+            self._count(requests=1, errors=1)
+            return None
+
+        self._count(requests=1, bytes=len(content))
+        try:
+            parsed = parse(response.url, content)
+        except (etree.ParserError, etree.XMLSyntaxError, ValueError):
+            self._count(errors=1)
+            return None
+
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag or last_modified:
+            self.validators.set(url, (etag, last_modified, parsed))
+        return parsed
+
+    def crawl(self, sources, progress=None):
+        """
+        Crawls the given sources. The category pages and feeds of all sources are fetched first,
+        then the articles they link to, both concurrently
+        :param sources: dictionary of source names and their settings, with the source's 'url',
+         its 'categories' and 'feeds' urls and the 'limit' of articles kept per source. The source
+         url is used as the only category page if no categories are given
+        :param progress: callable called with the number of articles done, the number of articles
+         found and the article, whenever an article has been fetched
+        :return: merged and deduplicated articles of all sources, newest first
+        :rtype: list
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            discovery = {}
+            for name, settings in sources.items():
+                pages = settings.get("categories") or [settings["url"]]
+                discovery[name] = (
+                    [pool.submit(self.fetch, page, parse_links) for page in pages],
+                    [pool.submit(self.fetch, feed, parse_feed) for feed in
+                     settings.get("feeds") or []])
+
+            articles, pending = [], []
+            for name, (page_futures, feed_futures) in discovery.items():
+                limit = sources[name].get("limit")
+                from_feeds = [item for future in feed_futures for item in future.result() or []]
+                known = set(item["url"] for item in from_feeds)
+
+                links = []
+                for future in page_futures:
+                    for link in future.result() or []:
+                        if link not in known:
+                            known.add(link)
+                            links.append(link)
+
+                if limit:
+                    from_feeds = from_feeds[:limit]
+                    links = links[:max(limit - len(from_feeds), 0)]
+
+                articles.extend(dict(item, source=name) for item in from_feeds)
+                pending.extend((name, pool.submit(self.fetch, link, parse_article))
+                               for link in links)
+
+            total = len(articles) + len(pending)
+            if progress is not None:
+                for done, item in enumerate(articles, 1):
+                    progress(done, total, item)
+
+            done = len(articles)
+            for name, future in pending:
+                item = future.result()
+                done += 1
+                if item is not None:
+                    item = dict(item, source=name)
+                    articles.append(item)
+                if progress is not None:
+                    progress(done, total, item)
+
+        return merge_articles(articles)
+
+    def stats(self):
+        """
+        Counters of the requests made by this crawler
+        :rtype: dict
+        """
+        with self._lock:
+            return dict(self._counters, validators=len(self.validators))
+
+    def _count(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                self._counters[name] += count
+
+
+def merge_articles(articles):
+    """
+    Deduplicates articles by their canonical url, keeping the first one, and sorts them newest
+    first, articles without a publication date last
+    :param articles: articles of one or more sources
+    :rtype: list
+    """
+    merged, seen = [], set()
+    for item in articles:
+        if item["url_hash"] not in seen:
+            seen.add(item["url_hash"])
+            merged.append(item)
+    merged.sort(key=lambda item: item.get("published_at") or "", reverse=True)
+    return merged
+
+
+def get_crawler(app=None):
+    """
+    Gets the news crawler, configured for the given or current application on first use. Web
+    processes started with LAZY_IMPORTS never call this and never import this module
+    :param app: flask application, defaults to the current one
+    :rtype: Crawler
+    """
+    app = app or current_app
+    crawler = app.extensions.get("news_crawler")
+    if crawler is None:
+        news_crawler.init_app(app)
+        crawler = news_crawler
+    return crawler
+
+
+news_crawler = Crawler()
@@ -0,0 +1,164 @@
+"""
+Benchmark of the news crawler against a local fixture server
+
+The fixture server serves a news site made of category pages, an RSS feed and article pages, with
+an optional delay per response standing in for the latency of a real site. Every page has an ETag
+and a Last-Modified date and conditional requests are answered with a 304, like most news sites
+do, so that the cost of a re-crawl can be measured as well.
+"""
+import hashlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from app.mod_blog.crawler import Crawler
+
+LAST_MODIFIED = "Mon, 01 May 2017 10:00:00 GMT"
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """
+    Serves the pages of the fixture news site
+    """
+
+    def do_GET(self):
+        server = self.server
+        server.count_request()
+        time.sleep(server.delay)
+
+        page = self.render(self.path)
+        if page is None:
+            self.send_error(404)
+            return
+
+        content_type, body = page
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", LAST_MODIFIED)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def render(self, path):
+        server = self.server
+        parts = [part for part in path.split("/") if part]
+
+        if len(parts) == 2 and parts[0] == "category" and parts[1].isdigit():
+            category = int(parts[1])
+            links = "".join(
+                '<li><a href="/news/{0}-{1}-story">Story {0}.{1}</a></li>'.format(category, index)
+                for index in range(server.articles_per_category))
+            return "text/html", "<html><body><a href='/'>Home</a><ul>{}</ul></body></html>".format(
+                links).encode("utf-8")
+
+        if parts == ["feed.xml"]:
+            items = "".join(
+                "<item><title>Feed story {0}</title><link>/feed/{0}-story</link>"
+                "<description>Summary {0}</description>"
+                "<pubDate>Mon, 01 May 2017 {1:02d}:00:00 GMT</pubDate></item>".format(
+                    index, index % 24)
+                for index in range(server.feed_items))
+            return "application/rss+xml", "<rss><channel>{}</channel></rss>".format(
+                items).encode("utf-8")
+
+        if len(parts) == 2 and parts[0] == "news":
+            slug = parts[1]
+            return "text/html", (
+                "<html><head><title>{0}</title>"
+                "<meta property='og:description' content='Summary of {0}'>"
+                "<meta property='article:published_time' content='2017-05-01T10:00:00Z'>"
+                "<meta name='author' content='Arco'>"
+                "</head><body><p>{1}</p></body></html>").format(
+                slug, "Lorem ipsum dolor sit amet. " * 200).encode("utf-8")
+
+        return None
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServer(ThreadingMixIn, HTTPServer):
+    """
+    Local news site for tests and benchmarks, listening on a random port
+    :cvar delay: seconds every response is delayed by
+    """
+    daemon_threads = True
+
+    def __init__(self, categories=4, articles_per_category=25, feed_items=10, delay=0.0):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), FixtureHandler)
+        self.categories = categories
+        self.articles_per_category = articles_per_category
+        self.feed_items = feed_items
+        self.delay = delay
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def source(self, limit=None):
+        """
+        Settings of the fixture site as a news source
+        :rtype: dict
+        """
+        return dict(url=self.url + "/", limit=limit, feeds=[self.url + "/feed.xml"],
+                    categories=["{}/category/{}".format(self.url, category)
+                                for category in range(self.categories)])
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def benchmark(workers_list, per_host=64, delay=0.02, categories=4, articles_per_category=25):
+    """
+    Measures articles crawled per second with different numbers of workers, first with a cold
+    crawler and then again once the validators of every page are known
+    :param workers_list: numbers of crawler workers to measure
+    :param per_host: concurrent requests allowed to the fixture host
+    :param delay: seconds every response of the fixture server is delayed by
+    :param categories: number of category pages of the fixture site
+    :param articles_per_category: number of articles on every category page
+    :return: list of dictionaries with the results of every run
+    :rtype: list
+    """
+    server = FixtureServer(categories=categories, articles_per_category=articles_per_category,
+                           delay=delay).start()
+    results = []
+    try:
+        for workers in workers_list:
+            crawler = Crawler(max_workers=workers, per_host=per_host)
+            for run in ("cold", "conditional"):
+                requests_before = server.requests
+                not_modified_before = crawler.stats()["not_modified"]
+                started = time.perf_counter()
+                articles = crawler.crawl({"fixture": server.source()})
+                elapsed = time.perf_counter() - started
+                results.append(dict(workers=workers, run=run, articles=len(articles),
+                                    requests=server.requests - requests_before,
+                                    seconds=elapsed, articles_per_second=len(articles) / elapsed,
+                                    not_modified=crawler.stats()["not_modified"] -
+                                    not_modified_before))
+    finally:
+        server.stop()
+    return results
@@ -0,0 +1,290 @@
+"""
+Models of the news sources and the articles crawled from them
+
+Source is a news site crawled by the news crawler
+Article is an article of a source, identified by the hash of its canonical url
+
+Articles are written with idempotent upserts, crawling the same article again updates the stored
+row instead of adding another one. They are read newest first with keyset pagination, every page
+is fetched with an index range scan starting after the last article of the previous page, which
+costs the same whether it is the first page or the ten thousandth.
+"""
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, Text, Index, and_, or_, \
+    bindparam, case, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import relationship, contains_eager
+
+from app import db
+from app.models import Base
+
+
+class Source(Base):
+    """
+    News source
+    :cvar __tablename__ name of this model as a table in the db
+    :cvar name unique name of the source, the key of the source in NEWS_SOURCES
+    :cvar url url of the news site
+    """
+    __tablename__ = "news_source"
+
+    name = Column(String(100), nullable=False, unique=True)
+    url = Column(String(500), nullable=True)
+
+    articles = relationship("Article", backref="source", lazy="dynamic")
+
+    def __init__(self, name, url=None):
+        self.name = name
+        self.url = url
+
+    @classmethod
+    def lookup_id(cls, name, url=None):
+        """
+        Gets the id of the source with the given name, creating the source if it does not exist
+        yet. Ids are cached for the lifetime of the application
+        :param name: name of the source
+        :param url: url of the source, used if it has to be created
+        :return: id of the source
+        :rtype: int
+        """
+        source_ids = current_app.extensions.setdefault("news_source_ids", {})
+        if name in source_ids:
+            return source_ids[name]
+
+        source = cls.query.filter_by(name=name).first()
+        if source is None:
+            try:
+                source = cls(name=name, url=url)
+                db.session.add(source)
+                db.session.commit()
+            except IntegrityError:
+                # created concurrently by another worker
+                db.session.rollback()
+                source = cls.query.filter_by(name=name).one()
+
+        source_ids[name] = source.id
+        return source.id
+
+    def to_json(self):
+        return dict(id=self.id, name=self.name, url=self.url)
+
+    def from_json(self, source):
+        source = json.loads(source)
+        self.name = source["name"]
+        self.url = source.get("url")
+
+    def __repr__(self):
+        return "Id: {}, Name: {}, Url: {}".format(self.id, self.name, self.url)
+
+
+class Article(Base):
+    """
+    Article of a news source
+    :cvar __tablename__ name of this model as a table in the db
+    :cvar source_id FK id of the source of the article
+    :cvar url canonical url of the article
+    :cvar url_hash sha1 of the url, identifies the article
+    :cvar published_at publication date of the article, or when it was first crawled if it has
+     none, so that every article has a position in the feed
+    """
+    __tablename__ = "article"
+
+    source_id = Column(Integer, ForeignKey("news_source.id"), nullable=False)
+    url = Column(String(2000), nullable=False)
+    url_hash = Column(String(40), nullable=False, unique=True)
+    title = Column(String(500), nullable=False, default="")
+    summary = Column(Text, nullable=True)
+    authors = Column(String(500), nullable=True)
+    image = Column(String(2000), nullable=True)
+    published_at = Column(DateTime, nullable=False)
+
+    # the feed is read newest first, over all sources or for a single source, (published_at, id)
+    # is the sort key and the keyset of its pages
+    __table_args__ = (
+        Index("ix_article_published_at_id", "published_at", "id"),
+        Index("ix_article_source_id_published_at_id", "source_id", "published_at", "id"),
+    )
+
+    # columns that are refreshed when an article is crawled again. The publication date is only
+    # ever moved back, so that an article without one keeps the date it was first crawled on and
+    # its position in the feed
+    UPDATABLE_COLUMNS = ("url", "title", "summary", "authors", "image")
+
+    @staticmethod
+    def row(source_id, article, now):
+        """
+        Converts an article produced by the news crawler into the values of a row
+        :param source_id: id of the source of the article
+        :param article: dictionary as produced by the news crawler
+        :param now: date used for articles without a publication date
+        :rtype: dict
+        """
+        published_at = article.get("published_at")
+        return dict(
+            source_id=source_id,
+            url=article["url"][:2000],
+            url_hash=article["url_hash"],
+            title=(article.get("title") or "")[:500],
+            summary=article.get("summary"),
+            authors=", ".join(article.get("authors") or [])[:500] or None,
+            image=(article.get("image") or "")[:2000] or None,
+            published_at=datetime.strptime(published_at[:19], "%Y-%m-%dT%H:%M:%S")
+            if published_at else now,
+        )
+
+    @classmethod
+    def upsert_many(cls, source_name, articles, source_url=None):
+        """
+        Stores the articles crawled from a source. Articles that are already stored are updated,
+        the others are inserted, so storing the same crawl twice changes nothing. PostgreSQL does
+        this in a single INSERT ... ON CONFLICT statement, other databases update the articles
+        that exist and insert the rest
+        :param source_name: name of the source
+        :param articles: articles as produced by the news crawler
+        :param source_url: url of the source, used if it has to be created
+        :return: number of articles written
+        :rtype: int
+        """
+        source_id = Source.lookup_id(source_name, source_url)
+        # cursors hold dates to the second
+        now = datetime.utcnow().replace(microsecond=0)
+
+        rows = {}
+        for article in articles:
+            rows[article["url_hash"]] = cls.row(source_id, article, now)
+        if not rows:
+            return 0
+        rows = list(rows.values())
+
+        engine = db.session.get_bind(mapper=cls.__mapper__)
+        if engine.dialect.name == "postgresql":
+            cls._upsert_on_conflict(rows)
+        else:
+            try:
+                cls._upsert_select_first(rows)
+            except IntegrityError:
+                # another worker inserted some of the articles in the meantime, now they exist
+                db.session.rollback()
+                cls._upsert_select_first(rows)
+        db.session.commit()
+        return len(rows)
+
+    @classmethod
+    def _upsert_on_conflict(cls, rows):
+        from sqlalchemy.dialects.postgresql import insert
+
+        table = cls.__table__
+        statement = insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.url_hash],
+            set_=dict({column: getattr(statement.excluded, column)
+                       for column in cls.UPDATABLE_COLUMNS},
+                      published_at=func.least(table.c.published_at,
+                                              statement.excluded.published_at),
+                      date_modified=datetime.utcnow()))
+        db.session.execute(statement, rows)
+
+    @classmethod
+    def _upsert_select_first(cls, rows):
+        table = cls.__table__
+        hashes = [row["url_hash"] for row in rows]
+        existing = {url_hash for url_hash, in db.session.execute(
+            db.select([table.c.url_hash]).where(table.c.url_hash.in_(hashes)))}
+
+        # bound parameters can not be named after the columns they update
+        updates = [dict({"new_" + column: row[column] for column in cls.UPDATABLE_COLUMNS},
+                        key=row["url_hash"], new_published_at=row["published_at"])
+                   for row in rows if row["url_hash"] in existing]
+        inserts = [row for row in rows if row["url_hash"] not in existing]
+
+        if updates:
+            db.session.execute(
+                table.update().where(table.c.url_hash == bindparam("key")).values(
+                    dict({column: bindparam("new_" + column) for column in cls.UPDATABLE_COLUMNS},
+                         published_at=case([(table.c.published_at < bindparam("new_published_at"),
+                                             table.c.published_at)],
+                                           else_=bindparam("new_published_at")))),
+                updates)
+        if inserts:
+            db.session.execute(table.insert(), inserts)
+
+    @classmethod
+    def page(cls, limit, cursor=None, source=None):
+        """
+        Gets a page of articles, newest first
+        :param limit: number of articles on the page
+        :param cursor: cursor of the page, as returned with the previous page, None for the first
+         page
+        :param source: only return articles of the source with this name
+        :return: articles of the page and the cursor of the next page, None on the last page
+        :rtype: tuple
+        :raises ValueError: if the cursor is invalid
+        """
+        query = cls.query.join(Source).options(contains_eager(cls.source))
+        if source is not None:
+            query = query.filter(Source.name == source)
+
+        if cursor is not None:
+            published_at, article_id = cls.decode_cursor(cursor)
+            query = query.filter(or_(cls.published_at < published_at,
+                                     and_(cls.published_at == published_at,
+                                          cls.id < article_id)))
+
+        # one article more than asked for tells whether there is a next page
+        articles = query.order_by(cls.published_at.desc(), cls.id.desc()).limit(limit + 1).all()
+        if len(articles) <= limit:
+            return articles, None
+
+        articles = articles[:limit]
+        return articles, cls.encode_cursor(articles[-1])
+
+    @staticmethod
+    def encode_cursor(article):
+        """
+        Opaque cursor pointing after the given article
+        :rtype: str
+        """
+        position = json.dumps([article.published_at.isoformat(), article.id])
+        return base64.urlsafe_b64encode(position.encode("utf-8")).decode("ascii")
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """
+        Publication date and id of the article a cursor points after
+        :rtype: tuple
+        :raises ValueError: if the cursor is invalid
+        """
+        try:
+            published_at, article_id = json.loads(
+                base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+            return datetime.strptime(published_at[:19], "%Y-%m-%dT%H:%M:%S"), int(article_id)
+        except (binascii.Error, UnicodeError, TypeError, ValueError):
+            raise ValueError("Invalid cursor {}".format(cursor))
+
+    def to_json(self):
+        return dict(
+            id=self.id,
+            source=self.source.name,
+            url=self.url,
+            url_hash=self.url_hash,
+            title=self.title,
+            summary=self.summary,
+            authors=self.authors.split(", ") if self.authors else [],
+            image=self.image,
+            published_at=self.published_at.isoformat(),
+        )
+
+    def from_json(self, article):
+        article = json.loads(article)
+        for column, value in self.row(self.source_id, article, datetime.utcnow()).items():
+            if column != "source_id":
+                setattr(self, column, value)
+
+    def __repr__(self):
+        return "Id: {}, SourceId: {}, Title: {}\n Url: {}\n Published: {}".format(
+            self.id, self.source_id, self.title, self.url, self.published_at)
@@ -0,0 +1,167 @@
+"""
+News cache
+
+Fetched news are kept in Redis so that requests to the blog are served from the cache instead of
+crawling the news sites every time. Cached news are fresh for NEWS_CACHE_TTL seconds, after which
+they are still served, stale, while a refresh runs in the background, until NEWS_CACHE_STALE_TTL
+seconds have passed.
+
+Refreshes of the same feed are coalesced, only one fetch task runs at a time per feed. The first
+request to need a refresh takes a lock holding the id of the task it dispatches, concurrent
+requests find the lock and report the same task id instead of dispatching another task.
+"""
+import json
+import time
+import uuid
+
+from redis import WatchError
+
+from app import redis_db
+from app.metrics import metrics
+
+
+class NewsCache(object):
+    """
+    Redis cache of fetched news with single flight refreshes
+    :cvar key_prefix: prefix of the Redis keys used by the cache
+    """
+    key_prefix = "news:"
+
+    def __init__(self, app=None):
+        self.ttl = 300
+        self.stale_ttl = 3600
+        self.lock_timeout = 300
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Reads the cache settings from the application configuration
+        :param app: current flask application
+        """
+        self.ttl = app.config.get("NEWS_CACHE_TTL", 300)
+        self.stale_ttl = max(app.config.get("NEWS_CACHE_STALE_TTL", 3600), self.ttl)
+        self.lock_timeout = app.config.get("NEWS_CACHE_LOCK_TIMEOUT", 300)
+        app.extensions["news_cache"] = self
+
+    def data_key(self, feed):
+        return "{}{}:data".format(self.key_prefix, feed)
+
+    def lock_key(self, feed):
+        return "{}{}:lock".format(self.key_prefix, feed)
+
+    def get(self, feed):
+        """
+        Gets the cached news of a feed
+        :param feed: name of the feed
+        :return: dictionary with the news 'items', the time they were 'fetched_at' and whether they
+         are 'stale', or None if nothing is cached
+        :rtype: dict
+        """
+        return self._load(redis_db.get_client().get(self.data_key(feed)))
+
+    def get_many(self, feeds):
+        """
+        Gets the cached news of several feeds in a single round trip
+        :param feeds: names of the feeds
+        :return: dictionary of feed names and their cached news, as returned by get
+        :rtype: dict
+        """
+        feeds = list(feeds)
+        if not feeds:
+            return {}
+        payloads = redis_db.get_client().mget([self.data_key(feed) for feed in feeds])
+        return {feed: self._load(payload) for feed, payload in zip(feeds, payloads)}
+
+    def _load(self, payload):
+        metrics.cache_lookup("news", payload is not None)
+        if payload is None:
+            return None
+
+        entry = json.loads(payload.decode("utf-8"))
+        entry["stale"] = time.time() - entry["fetched_at"] >= self.ttl
+        return entry
+
+    def set(self, feed, items):
+        """
+        Caches the news of a feed, they are kept until they are too stale to be served
+        :param feed: name of the feed
+        :param items: JSON serializable list of news
+        """
+        payload = json.dumps(dict(items=items, fetched_at=time.time()))
+        redis_db.get_client().setex(self.data_key(feed), self.stale_ttl, payload)
+
+    def in_flight(self, feed):
+        """
+        Id of the task currently refreshing a feed
+        :param feed: name of the feed
+        :return: task id or None if no refresh is running
+        """
+        task_id = redis_db.get_client().get(self.lock_key(feed))
+        return task_id.decode("utf-8") if task_id is not None else None
+
+    def acquire(self, feed, task_id):
+        """
+        Takes the refresh lock of a feed for the given task
+        :param feed: name of the feed
+        :param task_id: id of the task that will refresh the feed
+        :return: True if the lock was taken, False if another refresh is running
+        :rtype: bool
+        """
+        # the lock expires on its own, so a crashed worker can not block refreshes forever
+        return bool(redis_db.get_client().set(self.lock_key(feed), task_id, nx=True,
+                                              ex=self.lock_timeout))
+
+    def release(self, feed, task_id=None):
+        """
+        Releases the refresh lock of a feed
+        :param feed: name of the feed
+        :param task_id: only release the lock if it is held by this task, so that a task whose lock
+         has expired does not release the lock of the next one
+        """
+        client = redis_db.get_client()
+        key = self.lock_key(feed)
+
+        if task_id is None:
+            client.delete(key)
+            return
+
+        with client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                holder = pipe.get(key)
+                if holder is not None and holder.decode("utf-8") == task_id:
+                    pipe.multi()
+                    pipe.delete(key)
+                    pipe.execute()
+            except WatchError:
+                # the lock changed hands in the meantime, it is not ours to release
+                pass
+
+    def refresh(self, feed, task, *args, **options):
+        """
+        Dispatches the task refreshing a feed, unless a refresh is already running
+        :param feed: name of the feed
+        :param task: celery task fetching the news, called with the given arguments
+        :param options: options passed on to apply_async, e.g. countdown
+        :return: id of the task refreshing the feed
+        :rtype: str
+        """
+        task_id = str(uuid.uuid4())
+
+        while not self.acquire(feed, task_id):
+            running = self.in_flight(feed)
+            if running is not None:
+                return running
+            # the lock expired or was released between the two calls, try to take it again
+
+        try:
+            task.apply_async(args=args, task_id=task_id, **options)
+        except Exception:
+            self.release(feed, task_id)
+            raise
+        return task_id
+
+
+news_cache = NewsCache()
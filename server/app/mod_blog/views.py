@@ -7,35 +7,61 @@ No template is rendered, neither are static files loaded. This will be used to d
 data from various news articles and sites. client will handle static files and HTML page 
 rendering.
 """
-from flask import jsonify
+from flask import jsonify, current_app, request, url_for
 
+from app.http_cache import cached_response
 from app.mod_blog.blog_tasks import fetch_news
+from app.mod_blog.models import Article
+from app.mod_blog.news_cache import news_cache
 from . import blog
 
 
 @blog.route("", methods=["GET", "POST"])
+@cached_response("BLOG_CACHE_TTL")
 def display_top_news():
     """
     Will create a proper JSON response for the top news to display to the client
     Accessed via route <API_URL>/blog/
+    The news are crawled ahead of time by celery beat and read from the article store, a page at
+    a time, newest first. The next page is requested with the 'cursor' returned with the previous
+    one, 'limit' sets the number of articles per page and 'source' only returns the articles of
+    one source.
+    If a source has never been crawled and NEWS_REFRESH_ON_MISS is set, a crawl of it is started
+    and its task id returned along with the url of the task's progress stream, which pushes the
+    articles as they are crawled. An empty 202 is only returned if there are no articles at all.
+    Pages are cached for BLOG_CACHE_TTL seconds, except those that started a crawl
     :return: JSON response of data related to blog posts and news
     """
+    page_size = current_app.config.get("BLOG_PAGE_SIZE", 20)
+    # a negative limit would fail on postgresql and load the whole table on sqlite
+    limit = max(1, min(request.args.get("limit", page_size, type=int) or page_size,
+                       current_app.config.get("BLOG_MAX_PAGE_SIZE", 100)))
+    cursor = request.args.get("cursor")
+
     try:
-        news_results = fetch_news.apply_async()
+        articles, next_cursor = Article.page(limit, cursor=cursor,
+                                             source=request.args.get("source"))
+    except ValueError:
+        return jsonify(dict(message="Invalid cursor", success=False, response_code=400)), 400
 
-        if news_results.state != "FAILURE":
-            print(news_results)
-            print("id", news_results.id)
-            print("state", news_results.state)
-            print("info", news_results.info)
-            # news_results = fetch_news.apply_async()
+    sources = current_app.config["NEWS_SOURCES"]
+    status, tasks = {}, {}
+    for name, entry in news_cache.get_many(sources).items():
+        if entry is not None:
+            status[name] = dict(fetched_at=entry["fetched_at"], stale=entry["stale"])
+        elif current_app.config.get("NEWS_REFRESH_ON_MISS"):
+            settings = sources[name]
+            # concurrent requests share the crawl that is already running for the source
+            tasks[name] = news_cache.refresh(name, fetch_news, name, settings["url"],
+                                             settings.get("limit"))
 
-            # if news_results.state != "FAILURE":
-            #     print(news_results)
-            #     print("id", news_results.id)
-            #     print("state", news_results.state)
-            #     print("info", news_results.info)
-            # return jsonify(news_results)
-        return jsonify({}), 202
-    except ValueError as ve:
-        print(ve)
+    streams = {name: url_for("tasks.task_stream", task_id=task_id)
+               for name, task_id in tasks.items()}
+    response = jsonify(dict(items=[article.to_json() for article in articles],
+                            next_cursor=next_cursor, sources=status, tasks=tasks, streams=streams))
+    if tasks:
+        # the page is out of date as soon as the crawls it started store their articles
+        response.cache_control.no_store = True
+    if not articles and cursor is None and tasks:
+        return response, 202
+    return response
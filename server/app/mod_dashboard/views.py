@@ -3,7 +3,7 @@ from flask import render_template, url_for
 from flask_login import login_required
 
 
-@login_required
 @dashboard.route("")
+@login_required
 def dashboard():
     return render_template("dashboard.dashboard.html")
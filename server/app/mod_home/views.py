@@ -4,6 +4,7 @@ Entry point to API application. This will be for running simple checks on the ap
 """
 from flask import jsonify, url_for, redirect, request
 from flask_login import current_user
+from app.http_cache import cached_response
 from . import home
 from ..__meta__ import __version__, __project__, __copyright__
 
@@ -11,6 +12,7 @@ from ..__meta__ import __version__, __project__, __copyright__
 @home.route("")
 @home.route("home")
 @home.route("index")
+@cached_response("HOME_CACHE_TTL")
 def index():
     """
     Entry point into the app
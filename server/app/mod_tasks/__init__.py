@@ -0,0 +1,11 @@
+"""
+Module exposing the status and progress of background tasks
+
+Clients get the status of a task as JSON or follow its progress with a Server-Sent Events stream,
+which is pushed to them as the task reports it instead of being polled from the result backend
+"""
+from flask import Blueprint
+
+tasks = Blueprint(name="tasks", import_name=__name__, url_prefix="/tasks/")
+
+from . import views
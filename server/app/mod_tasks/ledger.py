@@ -0,0 +1,284 @@
+"""
+Ledger of background tasks
+
+Every celery task is recorded as an AsyncOperation. The entry is created when the task is sent to
+the broker, along with the profile of the user whose request sent it, then updated when a worker
+starts running it and when it finishes. Queue time and duration are computed from these, so queue
+latency and task runtimes can be measured per task and per user.
+
+Ledger writes go through their own connection and transaction and never through the session of
+the request or task they happen in, and a failing write is logged rather than raised, the ledger
+must never keep a task from being sent or run.
+
+Entries older than TASK_LEDGER_RETENTION_DAYS are compacted by a daily task into per day, task and
+user totals, AsyncOperationSummary, and then deleted.
+"""
+import logging
+from datetime import datetime, timedelta
+
+from celery.signals import before_task_publish, task_prerun, task_postrun
+from flask import has_app_context, has_request_context
+from flask_login import current_user
+from sqlalchemy import func, case
+from sqlalchemy.exc import SQLAlchemyError
+
+from app import db, celery
+
+logger = logging.getLogger(__name__)
+
+
+class TaskLedger(object):
+    """
+    Records the life of every celery task in the async operation ledger
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = True
+        self.retention_days = 30
+        self._connected = False
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Reads the ledger settings from the application configuration and connects the ledger to
+        the celery signals
+        :param app: current flask application
+        """
+        self.app = app
+        self.enabled = app.config.get("TASK_LEDGER_ENABLED", True)
+        self.retention_days = app.config.get("TASK_LEDGER_RETENTION_DAYS", 30)
+        app.extensions["task_ledger"] = self
+
+        if not self._connected:
+            before_task_publish.connect(self.on_publish, weak=False)
+            task_prerun.connect(self.on_prerun, weak=False)
+            task_postrun.connect(self.on_postrun, weak=False)
+            self._connected = True
+
+    def on_publish(self, sender=None, headers=None, body=None, **kwargs):
+        task_id = (headers or {}).get("id") or (body or {}).get("id")
+        if task_id is not None:
+            self.enqueued(task_id, sender, self.current_user_profile_id())
+
+    def on_prerun(self, task_id=None, task=None, **kwargs):
+        self.started(task_id, task.name)
+
+    def on_postrun(self, task_id=None, task=None, retval=None, state=None, **kwargs):
+        self.finished(task_id, task.name, state, retval)
+
+    @staticmethod
+    def current_user_profile_id():
+        """
+        Id of the profile of the user whose request is sending a task, None outside of requests
+        """
+        if has_request_context() and current_user.is_authenticated:
+            return getattr(current_user, "user_profile_id", None)
+        return None
+
+    def enqueued(self, task_id, name, user_profile_id=None, when=None):
+        """
+        Records that a task has been sent to the broker, a task sent again, when it is retried,
+        has its retries counted
+        :param task_id: id of the task
+        :param name: name of the task
+        :param user_profile_id: id of the profile of the user who caused the task to be sent
+        :param when: when the task was sent, defaults to now
+        """
+        from app.mod_auth.models import AsyncOperation, AsyncOperationStatus
+
+        when = when or datetime.utcnow()
+        table = AsyncOperation.__table__
+
+        def write(connection):
+            status_id = AsyncOperationStatus.lookup_id(AsyncOperationStatus.PENDING, connection)
+            retried = connection.execute(table.update().where(table.c.task_id == task_id).values(
+                enqueued_at=when, async_operation_status_id=status_id,
+                retries=table.c.retries + 1))
+
+            if not retried.rowcount:
+                connection.execute(table.insert().values(
+                    task_id=task_id, name=name, enqueued_at=when, date_created=when,
+                    user_profile_id=user_profile_id, async_operation_status_id=status_id,
+                    retries=0))
+
+        self._write(write)
+
+    def started(self, task_id, name, when=None):
+        """
+        Records that a worker has started running a task. Tasks that were not recorded when they
+        were sent, e.g. tasks run eagerly, are recorded now
+        :param task_id: id of the task
+        :param name: name of the task
+        :param when: when the task started, defaults to now
+        """
+        from app.mod_auth.models import AsyncOperation, AsyncOperationStatus
+
+        when = when or datetime.utcnow()
+        table = AsyncOperation.__table__
+
+        def write(connection):
+            status_id = AsyncOperationStatus.lookup_id(AsyncOperationStatus.STARTED, connection)
+            enqueued_at = connection.execute(
+                db.select([table.c.enqueued_at]).where(table.c.task_id == task_id)).first()
+
+            if enqueued_at is None:
+                connection.execute(table.insert().values(
+                    task_id=task_id, name=name, started_at=when, date_created=when,
+                    async_operation_status_id=status_id, retries=0))
+                return
+
+            queue_time = (when - enqueued_at[0]).total_seconds() if enqueued_at[0] else None
+            connection.execute(table.update().where(table.c.task_id == task_id).values(
+                started_at=when, queue_time=queue_time, async_operation_status_id=status_id))
+
+        self._write(write)
+
+    def finished(self, task_id, name, state, retval=None, when=None):
+        """
+        Records that a task has finished
+        :param task_id: id of the task
+        :param name: name of the task
+        :param state: final celery state of the task
+        :param retval: return value of the task, or the exception it failed with
+        :param when: when the task finished, defaults to now
+        """
+        from app.mod_auth.models import AsyncOperation, AsyncOperationStatus
+
+        when = when or datetime.utcnow()
+        table = AsyncOperation.__table__
+        failed = state != "SUCCESS"
+
+        def write(connection):
+            code = AsyncOperationStatus.ERROR if failed else AsyncOperationStatus.OK
+            status_id = AsyncOperationStatus.lookup_id(code, connection)
+            started_at = connection.execute(
+                db.select([table.c.started_at]).where(table.c.task_id == task_id)).scalar()
+
+            connection.execute(table.update().where(table.c.task_id == task_id).values(
+                finished_at=when, async_operation_status_id=status_id,
+                duration=(when - started_at).total_seconds() if started_at else None,
+                error="{!r}".format(retval)[:2000] if failed else None))
+
+        self._write(write)
+
+    def compact(self, now=None):
+        """
+        Adds the ledger entries older than the retention period to the daily summaries and deletes
+        them, both in one transaction
+        :param now: current date, defaults to now
+        :return: number of entries compacted
+        :rtype: int
+        """
+        from app.mod_auth.models import AsyncOperation, AsyncOperationStatus, \
+            AsyncOperationSummary
+
+        cutoff = (now or datetime.utcnow()) - timedelta(days=self.retention_days)
+        # whole days only, so that a day is never split between two summaries
+        cutoff = datetime(cutoff.year, cutoff.month, cutoff.day)
+        table = AsyncOperation.__table__
+        summaries = AsyncOperationSummary.__table__
+
+        def write(connection):
+            error_id = AsyncOperationStatus.lookup_id(AsyncOperationStatus.ERROR, connection)
+            day = func.date(table.c.date_created)
+            totals = connection.execute(
+                db.select([day.label("day"), table.c.name, table.c.user_profile_id,
+                           func.count().label("count"),
+                           func.sum(case([(table.c.async_operation_status_id == error_id, 1)],
+                                         else_=0)).label("errors"),
+                           func.coalesce(func.sum(table.c.queue_time), 0.0).label("queue_time"),
+                           func.coalesce(func.sum(table.c.duration), 0.0).label("duration"),
+                           func.max(table.c.queue_time).label("max_queue_time"),
+                           func.max(table.c.duration).label("max_duration")])
+                .where(table.c.date_created < cutoff)
+                .group_by(day, table.c.name, table.c.user_profile_id)).fetchall()
+
+            for row in totals:
+                row_day = row.day if not isinstance(row.day, str) else \
+                    datetime.strptime(row.day, "%Y-%m-%d").date()
+                match = (summaries.c.day == row_day) & (summaries.c.name == row.name) & \
+                    (summaries.c.user_profile_id == row.user_profile_id
+                     if row.user_profile_id is not None
+                     else summaries.c.user_profile_id.is_(None))
+                updated = connection.execute(summaries.update().where(match).values(
+                    count=summaries.c.count + row.count,
+                    errors=summaries.c.errors + row.errors,
+                    total_queue_time=summaries.c.total_queue_time + row.queue_time,
+                    total_duration=summaries.c.total_duration + row.duration,
+                    max_queue_time=greatest(summaries.c.max_queue_time, row.max_queue_time),
+                    max_duration=greatest(summaries.c.max_duration, row.max_duration)))
+                if not updated.rowcount:
+                    connection.execute(summaries.insert().values(
+                        day=row_day, name=row.name, user_profile_id=row.user_profile_id,
+                        count=row.count, errors=row.errors, total_queue_time=row.queue_time,
+                        total_duration=row.duration, max_queue_time=row.max_queue_time,
+                        max_duration=row.max_duration))
+
+            return connection.execute(table.delete().where(table.c.date_created < cutoff)).rowcount
+
+        return self._write(write, raise_errors=True) or 0
+
+    def _write(self, write, raise_errors=False):
+        """
+        Runs a ledger write in its own transaction
+        :param write: callable called with the connection
+        :param raise_errors: whether database errors are raised rather than logged
+        :return: what the write returned
+        """
+        if not self.enabled or self.app is None:
+            return None
+
+        # signals of tasks sent by beat or by another task may come without an application
+        # context, pushing one inside a request would end the request's session when it is popped
+        context = None if has_app_context() else self.app.app_context()
+        if context is not None:
+            context.push()
+
+        try:
+            with db.get_engine(self.app).begin() as connection:
+                return write(connection)
+        except SQLAlchemyError as e:
+            if raise_errors:
+                raise
+            logger.warning("Failed to write to the task ledger: {}".format(e))
+            return None
+        finally:
+            if context is not None:
+                context.pop()
+
+
+def greatest(column, value):
+    """
+    Portable GREATEST of a column and a value, ignoring NULLs
+    """
+    if value is None:
+        return column
+    return case([(column > value, column)], else_=value)
+
+
+def ledger_schedule():
+    """
+    Celery beat schedule of the ledger's compaction, once a day
+    :rtype: dict
+    """
+    return {
+        "compact-task-ledger": {
+            "task": compact_task_ledger.name,
+            "schedule": 24 * 60 * 60.0,
+        }
+    }
+
+
+@celery.task
+def compact_task_ledger():
+    """
+    Compacts the ledger entries that are past their retention period
+    :return: number of entries compacted
+    """
+    return task_ledger.compact()
+
+
+task_ledger = TaskLedger()
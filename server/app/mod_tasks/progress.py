@@ -0,0 +1,119 @@
+"""
+Progress channel of celery tasks
+
+Tasks built on ProgressTask publish every state they report with update_state, and finer grained
+progress reported with progress, on a Redis pub/sub channel named after the task id. The last event
+of every task is also kept for a while, so that a client subscribing late, or asking for the status
+of a task, gets the current state right away. Events are numbered, so a client that reads the last
+event and then receives it again from the channel can tell they are the same.
+"""
+import json
+import time
+
+from app import celery, redis_db
+
+# states after which a task reports nothing anymore
+READY_STATES = frozenset(["SUCCESS", "FAILURE", "REVOKED"])
+
+
+class TaskProgress(object):
+    """
+    Publishes and reads the progress events of tasks
+    :cvar key_prefix: prefix of the Redis channels and keys used for task progress
+    """
+    key_prefix = "task-progress:"
+
+    def __init__(self, app=None):
+        self.ttl = 3600
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Reads the progress settings from the application configuration
+        :param app: current flask application
+        """
+        self.ttl = app.config.get("TASK_PROGRESS_TTL", 3600)
+        app.extensions["task_progress"] = self
+
+    def channel(self, task_id):
+        return "{}{}".format(self.key_prefix, task_id)
+
+    def last_key(self, task_id):
+        return "{}{}:last".format(self.key_prefix, task_id)
+
+    def sequence_key(self, task_id):
+        return "{}{}:seq".format(self.key_prefix, task_id)
+
+    def publish(self, task_id, state, meta=None):
+        """
+        Publishes an event of a task and keeps it as the task's last event
+        :param task_id: id of the task
+        :param state: state of the task, e.g. PROGRESS
+        :param meta: JSON serializable details of the event
+        :return: the published event
+        :rtype: dict
+        """
+        client = redis_db.get_client()
+        sequence = client.incr(self.sequence_key(task_id))
+        event = dict(task_id=task_id, state=state, meta=meta, seq=sequence, time=time.time())
+        payload = json.dumps(event, default=str)
+
+        pipe = client.pipeline(transaction=False)
+        pipe.expire(self.sequence_key(task_id), self.ttl)
+        pipe.setex(self.last_key(task_id), self.ttl, payload)
+        pipe.publish(self.channel(task_id), payload)
+        pipe.execute()
+        return event
+
+    def last_event(self, task_id):
+        """
+        Last event published by a task
+        :param task_id: id of the task
+        :return: event or None if the task has not published any or it has expired
+        :rtype: dict
+        """
+        payload = redis_db.get_client().get(self.last_key(task_id))
+        return json.loads(payload.decode("utf-8")) if payload is not None else None
+
+    def subscribe(self, task_id):
+        """
+        Subscribes to the events of a task
+        :param task_id: id of the task
+        :return: subscribed pub/sub object, to be closed by the caller
+        """
+        pubsub = redis_db.get_client().pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel(task_id))
+        return pubsub
+
+
+task_progress = TaskProgress()
+
+
+class ProgressTask(celery.Task):
+    """
+    Base of tasks whose progress is pushed to clients. States reported with update_state are
+    stored in the result backend and published, progress increments reported with progress are
+    only published, so reporting them often does not load the result backend. The final state
+    of the task is published once it returns
+    """
+
+    def update_state(self, task_id=None, state=None, meta=None, **kwargs):
+        super(ProgressTask, self).update_state(task_id=task_id, state=state, meta=meta, **kwargs)
+        task_progress.publish(task_id or self.request.id, state, meta)
+
+    def progress(self, current, total, **meta):
+        """
+        Publishes a progress increment of the task
+        :param current: units of work done
+        :param total: units of work in total
+        :param meta: further JSON serializable details, e.g. a partial result
+        """
+        task_progress.publish(self.request.id, "PROGRESS", dict(meta, current=current,
+                                                                 total=total))
+
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        meta = dict(error=str(retval)) if status == "FAILURE" else dict(result=retval)
+        task_progress.publish(task_id, status, meta)
+        super(ProgressTask, self).after_return(status, retval, task_id, args, kwargs, einfo)
@@ -0,0 +1,175 @@
+"""
+View functions exposing the status and progress of background tasks
+
+The status endpoint answers with the last event a task published and only falls back to the
+result backend for tasks that did not publish any. The stream endpoint pushes every event of a
+task to the client as a Server-Sent Event until the task is done, which for tasks that do not
+publish progress is only known to the result backend, checked every RESULT_POLL_INTERVAL seconds.
+Every open stream holds a thread of a gunicorn worker, see gunicorn_config.py.
+
+Both need a logged in user, and a task sent by the request of a user, as recorded by the task
+ledger, is only shown to that user. Tasks sent without a user, e.g. by celery beat, are shown to
+every user.
+"""
+import json
+import time
+from datetime import datetime, timedelta
+
+from celery.backends.base import DisabledBackend
+from flask import jsonify, current_app, Response, stream_with_context, request, abort
+from flask_login import login_required, current_user
+from sqlalchemy import func
+
+from app import celery, db
+from app.mod_auth.models import AsyncOperation
+from .progress import task_progress, READY_STATES
+from . import tasks
+
+# seconds between two checks of the result backend by a stream
+RESULT_POLL_INTERVAL = 5
+
+
+def backend_event(task_id, sequence=0):
+    """
+    Event of a task built from the result backend, for tasks whose events were not published or
+    have expired, a pending event when there is no result backend
+    :param task_id: id of the task
+    :param sequence: sequence number of the event
+    :return: dictionary with the state of the task and its result or error
+    :rtype: dict
+    """
+    if isinstance(celery.backend, DisabledBackend):
+        # without a result backend nothing is known of the task besides its events
+        return dict(task_id=task_id, state="PENDING", meta=None, seq=sequence)
+
+    result = celery.AsyncResult(task_id)
+    info = result.info
+    if isinstance(info, Exception):
+        info = dict(error=str(info))
+    return dict(task_id=task_id, state=result.state, meta=info, seq=sequence)
+
+
+def check_owner(task_id):
+    """
+    Answers with a 404 if the task was sent by the request of another user, its meta may hold
+    partial results and errors
+    :param task_id: id of the task
+    """
+    owner = db.session.query(AsyncOperation.user_profile_id).filter_by(task_id=task_id).scalar()
+    if owner is not None and owner != current_user.user_profile_id:
+        abort(404)
+
+
+@tasks.route("mine")
+@login_required
+def my_recent_tasks():
+    """
+    Recent background tasks of the current user, newest first, with the average queue time and
+    duration of each kind of task over the last 'days' days
+    Accessed via route <API_URL>/tasks/mine
+    :return: JSON response with the user's recent tasks and their statistics
+    """
+    user_profile_id = current_user.user_profile_id
+    limit = min(request.args.get("limit", 20, type=int) or 20, 100)
+    since = datetime.utcnow() - timedelta(days=request.args.get("days", 7, type=int) or 7)
+
+    # both queries are range scans of the (user_profile_id, date_created) index
+    operations = AsyncOperation.query.filter_by(user_profile_id=user_profile_id) \
+        .order_by(AsyncOperation.date_created.desc()).limit(limit).all()
+
+    table = AsyncOperation.__table__
+    statistics = db.session.execute(
+        db.select([table.c.name, func.count().label("count"),
+                   func.avg(table.c.queue_time).label("average_queue_time"),
+                   func.avg(table.c.duration).label("average_duration")])
+        .where(table.c.user_profile_id == user_profile_id)
+        .where(table.c.date_created >= since)
+        .group_by(table.c.name))
+
+    return jsonify(dict(tasks=[operation.to_json() for operation in operations],
+                        statistics=[dict(row) for row in statistics]))
+
+
+@tasks.route("<task_id>")
+@login_required
+def task_status(task_id):
+    """
+    Status of a task
+    Accessed via route <API_URL>/tasks/<task_id>
+    :param task_id: id of the task
+    :return: JSON response with the state of the task and the details of its last event
+    """
+    check_owner(task_id)
+    event = task_progress.last_event(task_id)
+    if event is None:
+        event = backend_event(task_id)
+
+    return jsonify(event)
+
+
+@tasks.route("<task_id>/stream")
+@login_required
+def task_stream(task_id):
+    """
+    Server-Sent Events stream of the progress of a task, the last event of the task is sent first
+    and the stream ends once the task is done or TASK_STREAM_TIMEOUT seconds have passed, after
+    which the client's EventSource reconnects
+    Accessed via route <API_URL>/tasks/<task_id>/stream
+    :param task_id: id of the task
+    :return: event stream response
+    """
+    check_owner(task_id)
+    timeout = current_app.config.get("TASK_STREAM_TIMEOUT", 300)
+    heartbeat = current_app.config.get("TASK_STREAM_HEARTBEAT", 15)
+
+    def format_event(event):
+        return "id: {}\nevent: {}\ndata: {}\n\n".format(event["seq"], event["state"].lower(),
+                                                         json.dumps(event, default=str))
+
+    def events():
+        # subscribing before reading the last event means no event can be missed in between
+        pubsub = task_progress.subscribe(task_id)
+        try:
+            last_sequence = 0
+            event = task_progress.last_event(task_id)
+            if event is None:
+                event = backend_event(task_id)
+                if event["state"] in READY_STATES:
+                    yield format_event(event)
+                    return
+            else:
+                last_sequence = event["seq"]
+                yield format_event(event)
+                if event["state"] in READY_STATES:
+                    return
+
+            deadline = time.time() + timeout
+            last_sent = last_checked = time.time()
+            while time.time() < deadline:
+                message = pubsub.get_message(timeout=1.0)
+                if message is None or message["type"] != "message":
+                    if time.time() - last_checked >= RESULT_POLL_INTERVAL:
+                        last_checked = time.time()
+                        event = backend_event(task_id, last_sequence + 1)
+                        if event["state"] in READY_STATES:
+                            yield format_event(event)
+                            return
+                    if time.time() - last_sent >= heartbeat:
+                        # a comment keeps proxies from closing an idle connection
+                        last_sent = time.time()
+                        yield ": keep-alive\n\n"
+                    continue
+
+                event = json.loads(message["data"].decode("utf-8"))
+                if event["seq"] <= last_sequence:
+                    continue
+                last_sequence = event["seq"]
+                last_sent = time.time()
+                yield format_event(event)
+                if event["state"] in READY_STATES:
+                    return
+        finally:
+            pubsub.close()
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
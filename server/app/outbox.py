@@ -0,0 +1,350 @@
+"""
+Mail outbox
+
+Emails are not sent by the request that causes them, nor by a task of their own. They are queued
+in Redis and a drain task sends them in batches, each batch over a single SMTP connection, so a
+mass mailing costs one SMTP handshake per batch instead of one per email.
+
+The queue is durable. Messages being sent are moved to a processing list with RPOPLPUSH and only
+removed from it once they have been handed to the SMTP server, if a worker dies half way through
+a batch the next drain puts them back in the queue. Only one drain runs at a time, which is also
+what makes the rate limit global.
+
+A message the server refuses, that can not be rendered, or that can not be sent because the
+connection failed, is retried with an exponential backoff. Messages wait in a sorted set scored by the time of their next attempt
+and go to a dead letter list once they have been tried MAIL_OUTBOX_MAX_ATTEMPTS times.
+
+Counters of queued, sent, retried and failed messages, connection errors and the throughput of
+the last drain are kept in a Redis hash, see MailOutbox.metrics.
+"""
+import json
+import random
+import smtplib
+import time
+import uuid
+
+from flask import current_app
+from flask_mail import Message
+
+from app import celery, mail, redis_db
+from app.email_templates import email_templates
+
+
+class RateLimiter(object):
+    """
+    Spaces calls evenly so that no more than 'rate' happen per second
+    :cvar rate: calls per second, 0 for no limit
+    """
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.clock = clock
+        self.sleep = sleep
+        self._next = None
+
+    def wait(self):
+        """
+        Blocks until the next call is allowed
+        """
+        if not self.rate:
+            return
+        now = self.clock()
+        if self._next is not None and self._next > now:
+            self.sleep(self._next - now)
+            now = self._next
+        self._next = now + 1.0 / self.rate
+
+
+class MailOutbox(object):
+    """
+    Durable queue of emails sent in batches
+    :cvar key_prefix: prefix of the Redis keys used by the outbox
+    """
+    key_prefix = "mail-outbox:"
+
+    # errors for a single message, the connection can be used for the next one
+    MESSAGE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                      smtplib.SMTPDataError)
+
+    def __init__(self, app=None):
+        self.batch_size = 100
+        self.rate = 10
+        self.max_attempts = 5
+        self.retry_delay = 30
+        self.max_retry_delay = 3600
+        self.drain_seconds = 240
+        self.lock_timeout = 300
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Reads the outbox settings from the application configuration
+        :param app: current flask application
+        """
+        self.batch_size = app.config.get("MAIL_OUTBOX_BATCH_SIZE", 100)
+        self.rate = app.config.get("MAIL_OUTBOX_RATE", 10)
+        self.max_attempts = app.config.get("MAIL_OUTBOX_MAX_ATTEMPTS", 5)
+        self.retry_delay = app.config.get("MAIL_OUTBOX_RETRY_DELAY", 30)
+        self.max_retry_delay = app.config.get("MAIL_OUTBOX_MAX_RETRY_DELAY", 3600)
+        self.drain_seconds = app.config.get("MAIL_OUTBOX_DRAIN_SECONDS", 240)
+        # the lock has to outlive the longest drain
+        self.lock_timeout = max(app.config.get("MAIL_OUTBOX_LOCK_TIMEOUT", 300),
+                                self.drain_seconds + 60)
+        app.extensions["mail_outbox"] = self
+
+    def key(self, name):
+        return self.key_prefix + name
+
+    def message(self, to, subject, template, **context):
+        """
+        Creates a message to queue, the template is rendered when the message is sent
+        :param to: recipient
+        :param subject: subject of the email, without the MAIL_SUBJECT_PREFIX
+        :param template: template of the HTML body
+        :param context: JSON serializable variables of the template
+        :rtype: dict
+        """
+        return dict(id=uuid.uuid4().hex, to=to, subject=subject, template=template,
+                    context=context, attempts=0, queued_at=time.time())
+
+    def enqueue(self, to, subject, template, **context):
+        """
+        Queues an email and makes sure a drain is on its way
+        :return: id of the message
+        :rtype: str
+        """
+        message = self.message(to, subject, template, **context)
+        self.enqueue_many([message])
+        return message["id"]
+
+    def enqueue_many(self, messages, chunk_size=1000):
+        """
+        Queues many emails at once, e.g. for a mass mailing, in as few round trips as possible
+        :param messages: messages created with message
+        :param chunk_size: number of messages pushed per round trip
+        :return: number of messages queued
+        :rtype: int
+        """
+        client = redis_db.get_client()
+        count = 0
+        for start in range(0, len(messages), chunk_size):
+            chunk = [json.dumps(message) for message in messages[start:start + chunk_size]]
+            pipe = client.pipeline(transaction=False)
+            pipe.lpush(self.key("queue"), *chunk)
+            pipe.hincrby(self.key("metrics"), "queued", len(chunk))
+            pipe.execute()
+            count += len(chunk)
+
+        if count:
+            self.schedule_drain()
+        return count
+
+    def schedule_drain(self):
+        """
+        Dispatches a drain task, unless one has been dispatched and has not started yet
+        """
+        if redis_db.get_client().set(self.key("scheduled"), 1, nx=True, ex=self.lock_timeout):
+            drain_mail_outbox.apply_async()
+
+    def drain(self):
+        """
+        Sends queued messages in batches until the queue is empty or MAIL_OUTBOX_DRAIN_SECONDS have
+        passed, then dispatches another drain if messages are left
+        :return: number of messages sent, None if another drain is running
+        """
+        client = redis_db.get_client()
+        token = uuid.uuid4().hex
+        if not client.set(self.key("lock"), token, nx=True, ex=self.lock_timeout):
+            return None
+
+        sent = 0
+        started = time.time()
+        try:
+            # messages queued from now on need another drain
+            client.delete(self.key("scheduled"))
+
+            # messages left behind by a drain that died are sent again
+            while client.rpoplpush(self.key("processing"), self.key("queue")) is not None:
+                pass
+
+            limiter = RateLimiter(self.rate)
+            while time.time() - started < self.drain_seconds:
+                self.promote_retries()
+                batch = []
+                for _ in range(self.batch_size):
+                    raw = client.rpoplpush(self.key("queue"), self.key("processing"))
+                    if raw is None:
+                        break
+                    batch.append(raw)
+                if not batch:
+                    break
+                sent += self.send_batch(batch, limiter)
+        finally:
+            elapsed = time.time() - started
+            pipe = client.pipeline(transaction=False)
+            pipe.hincrby(self.key("metrics"), "drains", 1)
+            pipe.hset(self.key("metrics"), "last_drain_sent", sent)
+            pipe.hset(self.key("metrics"), "last_drain_seconds", round(elapsed, 3))
+            pipe.hset(self.key("metrics"), "last_drain_rate",
+                      round(sent / elapsed, 3) if elapsed else 0)
+            pipe.execute()
+            self.release_lock(token)
+
+        if client.llen(self.key("queue")):
+            self.schedule_drain()
+        return sent
+
+    def send_batch(self, batch, limiter):
+        """
+        Sends a batch of messages over one SMTP connection
+        :param batch: raw messages, as they are in the processing list
+        :param limiter: rate limiter shared by the batches of a drain
+        :return: number of messages sent
+        :rtype: int
+        """
+        client = redis_db.get_client()
+        remaining = list(batch)
+        sent = 0
+
+        try:
+            with mail.connect() as connection:
+                while remaining:
+                    raw = remaining[0]
+                    message = json.loads(raw.decode("utf-8"))
+                    try:
+                        email = self.build(message)
+                    except Exception as e:
+                        # left in the processing list, it would fail every drain from now on
+                        current_app.logger.warning(
+                            "Mail outbox could not render {}: {}".format(message["template"], e))
+                        self.retry(message, e)
+                        client.lrem(self.key("processing"), 1, raw)
+                        remaining.pop(0)
+                        continue
+                    limiter.wait()
+                    try:
+                        connection.send(email)
+                    except self.MESSAGE_ERRORS as e:
+                        self.retry(message, e)
+                    else:
+                        sent += 1
+                        client.hincrby(self.key("metrics"), "sent", 1)
+                    client.lrem(self.key("processing"), 1, raw)
+                    remaining.pop(0)
+        except (smtplib.SMTPException, OSError) as e:
+            # the connection failed, whatever was not sent is retried later
+            client.hincrby(self.key("metrics"), "connection_errors", 1)
+            current_app.logger.warning("Mail outbox connection failed: {}".format(e))
+            for raw in remaining:
+                self.retry(json.loads(raw.decode("utf-8")), e)
+                client.lrem(self.key("processing"), 1, raw)
+        return sent
+
+    def build(self, message):
+        """
+        Renders a queued message into an email
+        :param message: queued message
+        :rtype: Message
+        """
+        email = Message(
+            subject="{} {}".format(current_app.config.get("MAIL_SUBJECT_PREFIX", ""),
+                                   message["subject"]).strip(),
+            sender=current_app.config.get("MAIL_DEFAULT_SENDER"),
+            recipients=[message["to"]],
+        )
+        email.html = email_templates.render(message["template"], **message["context"])
+        return email
+
+    def retry(self, message, error):
+        """
+        Schedules another attempt at sending a message, with an exponential backoff, or moves it to
+        the dead letter list if it has been tried too often
+        :param message: queued message
+        :param error: error the last attempt failed with
+        """
+        client = redis_db.get_client()
+        message = dict(message, attempts=message.get("attempts", 0) + 1, error=str(error))
+
+        if message["attempts"] >= self.max_attempts:
+            pipe = client.pipeline(transaction=False)
+            pipe.lpush(self.key("dead"), json.dumps(message))
+            pipe.hincrby(self.key("metrics"), "failed", 1)
+            pipe.execute()
+            return
+
+        delay = min(self.retry_delay * 2 ** (message["attempts"] - 1), self.max_retry_delay)
+        # spread the retries of a failed batch instead of retrying them all at once
+        delay *= random.uniform(0.5, 1.5)
+        pipe = client.pipeline(transaction=False)
+        pipe.zadd(self.key("retry"), {json.dumps(message): time.time() + delay})
+        pipe.hincrby(self.key("metrics"), "retried", 1)
+        pipe.execute()
+
+    def promote_retries(self, now=None):
+        """
+        Moves the messages whose next attempt is due back to the queue
+        :param now: current time, defaults to now
+        :return: number of messages moved
+        :rtype: int
+        """
+        client = redis_db.get_client()
+        due = client.zrangebyscore(self.key("retry"), 0, now or time.time(), start=0,
+                                   num=self.batch_size)
+        moved = 0
+        for raw in due:
+            if client.zrem(self.key("retry"), raw):
+                client.lpush(self.key("queue"), raw)
+                moved += 1
+        return moved
+
+    def release_lock(self, token):
+        client = redis_db.get_client()
+        holder = client.get(self.key("lock"))
+        if holder is not None and holder.decode("utf-8") == token:
+            client.delete(self.key("lock"))
+
+    def metrics(self):
+        """
+        Counters of the outbox and the current length of its queues
+        :rtype: dict
+        """
+        client = redis_db.get_client()
+        pipe = client.pipeline(transaction=False)
+        pipe.hgetall(self.key("metrics"))
+        pipe.llen(self.key("queue"))
+        pipe.llen(self.key("processing"))
+        pipe.zcard(self.key("retry"))
+        pipe.llen(self.key("dead"))
+        counters, queued, processing, retrying, dead = pipe.execute()
+
+        metrics = {name.decode("utf-8"): float(value) if b"." in value else int(value)
+                   for name, value in counters.items()}
+        metrics.update(queue_length=queued, processing=processing, retrying=retrying, dead=dead)
+        return metrics
+
+
+def outbox_schedule():
+    """
+    Celery beat schedule draining the outbox every minute, which sends the retries that are due
+    :rtype: dict
+    """
+    return {
+        "drain-mail-outbox": {
+            "task": drain_mail_outbox.name,
+            "schedule": 60.0,
+        }
+    }
+
+
+@celery.task
+def drain_mail_outbox():
+    """
+    Sends the queued emails
+    :return: number of emails sent
+    """
+    return mail_outbox.drain()
+
+
+mail_outbox = MailOutbox()
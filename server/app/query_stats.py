@@ -0,0 +1,428 @@
+"""
+Instrumentation of the SQL queries
+
+Every statement the engines execute is timed with SQLAlchemy's cursor events and reduced to a
+fingerprint, its text with the literals and bind parameters replaced by '?', so that the same query
+with other values is counted as one. For each request the number of queries, the time spent in the
+database and the fingerprints are recorded under the request's endpoint, and a fingerprint executed
+QUERY_N_PLUS_ONE_THRESHOLD times or more by a single request is reported as a likely N+1, a query
+run once per row of a previous one. Statements slower than QUERY_SLOW_THRESHOLD are logged.
+
+The statistics are aggregated in process and added every QUERY_STATS_FLUSH_INTERVAL seconds to
+slots of QUERY_STATS_SLOT seconds in QUERY_STATS_BACKEND, 'memory' for this process only or
+'redis' to combine all the workers. The report covers the slots of the last QUERY_STATS_WINDOW
+seconds, the endpoints by database time and the QUERY_STATS_TOP slowest fingerprints, see
+manage.py query_report and the admin blueprint.
+"""
+import hashlib
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from functools import lru_cache
+
+from flask import current_app, request, g, has_app_context, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import redis_db
+
+# replaced in order, literals and parameters first so that the lists of values they leave collapse
+FINGERPRINT_PATTERNS = (
+    # string literals
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    # bind parameters of the drivers' parameter styles
+    (re.compile(r"%\(\w+\)s|%s|(?<!:):\w+|\$\d+"), "?"),
+    # numbers that are not part of a name
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    # lists of values, e.g. IN (?, ?, ?) and multi row VALUES
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*"), "(?)"),
+    (re.compile(r"\s+"), " "),
+)
+
+# statements whose text is kept for the reports, an application only has so many distinct ones
+MAX_STATEMENTS = 10000
+
+
+@lru_cache(maxsize=2048)
+def fingerprint(statement):
+    """
+    Normalizes a statement, the statements of an application are few, so they are cached
+    :param statement: SQL statement
+    :return: the normalized statement and its id
+    :rtype: tuple
+    """
+    normalized = statement
+    for pattern, replacement in FINGERPRINT_PATTERNS:
+        normalized = pattern.sub(replacement, normalized)
+    normalized = normalized.strip()
+    return normalized, hashlib.sha1(normalized.encode("utf-8")).hexdigest()[:16]
+
+
+def new_aggregate():
+    """
+    Empty aggregate of query statistics
+    :return: dictionary of the endpoints' statistics, the slow fingerprints' statistics and the
+     statements of the fingerprints
+    :rtype: dict
+    """
+    return dict(endpoints={}, slow={}, statements={})
+
+
+def merge_aggregates(aggregate, other):
+    """
+    Adds the statistics of an aggregate to another
+    :param aggregate: aggregate that is updated
+    :param other: aggregate that is added
+    :return: the updated aggregate
+    :rtype: dict
+    """
+    for endpoint, stats in other["endpoints"].items():
+        totals = aggregate["endpoints"].setdefault(endpoint, dict(
+            requests=0, queries=0, seconds=0.0, n_plus_one=0, fingerprints=Counter()))
+        for name in ("requests", "queries", "seconds", "n_plus_one"):
+            totals[name] += stats[name]
+        totals["fingerprints"].update(stats["fingerprints"])
+
+    for fingerprint_id, stats in other["slow"].items():
+        totals = aggregate["slow"].setdefault(fingerprint_id, dict(
+            count=0, seconds=0.0, max_seconds=0.0, endpoint=stats["endpoint"]))
+        totals["count"] += stats["count"]
+        totals["seconds"] += stats["seconds"]
+        totals["max_seconds"] = max(totals["max_seconds"], stats["max_seconds"])
+
+    aggregate["statements"].update(other["statements"])
+    return aggregate
+
+
+class MemoryQueryStatsBackend(object):
+    """
+    Keeps the slots of query statistics in process
+    """
+
+    def __init__(self):
+        self.slots = {}
+        self.expires = {}
+        self._lock = threading.Lock()
+
+    def add(self, slot, aggregate, ttl):
+        now = time.time()
+        with self._lock:
+            merge_aggregates(self.slots.setdefault(slot, new_aggregate()), aggregate)
+            self.expires[slot] = now + ttl
+            for expired in [old for old, expires in self.expires.items() if expires <= now]:
+                del self.slots[expired], self.expires[expired]
+
+    def load(self, slots):
+        with self._lock:
+            return [merge_aggregates(new_aggregate(), self.slots[slot]) for slot in slots
+                    if slot in self.slots]
+
+    def clear(self):
+        with self._lock:
+            self.slots.clear()
+            self.expires.clear()
+
+
+class RedisQueryStatsBackend(object):
+    """
+    Keeps the slots of query statistics in Redis, combining the statistics of all workers. Each
+    slot is a hash of the endpoints' counters, a hash of the slow fingerprints' counters and a
+    sorted set of their longest durations
+    :cvar key_prefix: prefix of the keys of the slots
+    """
+    key_prefix = "query-stats:"
+
+    def __init__(self, client):
+        self.client = client
+
+    def add(self, slot, aggregate, ttl):
+        endpoints = "{}{}:endpoints".format(self.key_prefix, slot)
+        slow = "{}{}:slow".format(self.key_prefix, slot)
+        longest = "{}{}:longest".format(self.key_prefix, slot)
+        statements = self.key_prefix + "statements"
+
+        pipeline = self.client.pipeline()
+        for endpoint, stats in aggregate["endpoints"].items():
+            for name in ("requests", "queries", "n_plus_one"):
+                pipeline.hincrby(endpoints, "{}|{}".format(endpoint, name), stats[name])
+            pipeline.hincrbyfloat(endpoints, "{}|seconds".format(endpoint), stats["seconds"])
+            for fingerprint_id, count in stats["fingerprints"].items():
+                pipeline.hincrby(endpoints, "{}|fingerprint|{}".format(endpoint, fingerprint_id),
+                                 count)
+
+        if aggregate["slow"]:
+            # the longest durations are merged with ZUNIONSTORE, which keeps the maximum
+            new = "{}new:{}".format(self.key_prefix, uuid.uuid4().hex)
+            for fingerprint_id, stats in aggregate["slow"].items():
+                pipeline.hincrby(slow, "{}|count".format(fingerprint_id), stats["count"])
+                pipeline.hincrbyfloat(slow, "{}|seconds".format(fingerprint_id), stats["seconds"])
+                pipeline.hset(slow, "{}|endpoint".format(fingerprint_id), stats["endpoint"])
+                pipeline.zadd(new, {fingerprint_id: stats["max_seconds"]})
+            pipeline.zunionstore(longest, [longest, new], aggregate="MAX")
+            pipeline.delete(new)
+
+        if aggregate["statements"]:
+            pipeline.hset(statements, mapping=aggregate["statements"])
+            pipeline.expire(statements, ttl)
+        for key in (endpoints, slow, longest):
+            pipeline.expire(key, ttl)
+        pipeline.execute()
+
+    def load(self, slots):
+        slots = list(slots)
+        pipeline = self.client.pipeline()
+        for slot in slots:
+            pipeline.hgetall("{}{}:endpoints".format(self.key_prefix, slot))
+            pipeline.hgetall("{}{}:slow".format(self.key_prefix, slot))
+            pipeline.zrange("{}{}:longest".format(self.key_prefix, slot), 0, -1, withscores=True)
+        pipeline.hgetall(self.key_prefix + "statements")
+        replies = pipeline.execute()
+        statements = {key.decode("utf-8"): value.decode("utf-8")
+                      for key, value in replies[-1].items()}
+
+        aggregates = []
+        for index in range(len(slots)):
+            endpoints, slow, longest = replies[3 * index:3 * index + 3]
+            aggregate = new_aggregate()
+            aggregate["statements"] = statements
+            for field, value in endpoints.items():
+                endpoint, name = field.decode("utf-8").split("|", 1)
+                stats = aggregate["endpoints"].setdefault(endpoint, dict(
+                    requests=0, queries=0, seconds=0.0, n_plus_one=0, fingerprints=Counter()))
+                if name.startswith("fingerprint|"):
+                    stats["fingerprints"][name.split("|", 1)[1]] = int(value)
+                else:
+                    stats[name] = float(value) if name == "seconds" else int(value)
+            for member, score in longest:
+                fingerprint_id = member.decode("utf-8")
+                prefix = fingerprint_id.encode("utf-8") + b"|"
+                aggregate["slow"][fingerprint_id] = dict(
+                    count=int(slow.get(prefix + b"count", 0)),
+                    seconds=float(slow.get(prefix + b"seconds", 0)), max_seconds=score,
+                    endpoint=slow.get(prefix + b"endpoint", b"").decode("utf-8"))
+            aggregates.append(aggregate)
+        return aggregates
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.key_prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+class QueryStats(object):
+    """
+    Times the queries of every request and aggregates them by endpoint and by fingerprint
+    :cvar enabled: whether queries are instrumented, QUERY_STATS_ENABLED
+    :cvar slow_threshold: seconds from which a query is slow, QUERY_SLOW_THRESHOLD
+    :cvar n_plus_one_threshold: executions of a fingerprint in one request that are reported as an
+     N+1, QUERY_N_PLUS_ONE_THRESHOLD
+    :cvar top: number of slow fingerprints in the report, QUERY_STATS_TOP
+    :cvar slot_seconds: seconds covered by a slot of statistics, QUERY_STATS_SLOT
+    :cvar window: number of slots covered by the report
+    :cvar flush_interval: seconds the statistics are aggregated in process before they are added to
+     the backend, QUERY_STATS_FLUSH_INTERVAL
+    :cvar headers: whether responses get X-Query-Count and X-Query-Time headers
+    """
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.slow_threshold = 0.5
+        self.n_plus_one_threshold = 10
+        self.top = 20
+        self.slot_seconds = 3600
+        self.window = 24
+        self.flush_interval = 10
+        self.headers = False
+        self.backend = None
+        # normalized statements by fingerprint id, for the reports
+        self._statements = {}
+        self._pending = new_aggregate()
+        self._pending_since = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Configures the instrumentation, creates the backend and listens to the cursor events of
+        every engine
+        :param app: current flask application
+        """
+        self.enabled = app.config.get("QUERY_STATS_ENABLED", True)
+        self.slow_threshold = app.config.get("QUERY_SLOW_THRESHOLD", self.slow_threshold)
+        self.n_plus_one_threshold = app.config.get("QUERY_N_PLUS_ONE_THRESHOLD",
+                                                   self.n_plus_one_threshold)
+        self.top = app.config.get("QUERY_STATS_TOP", self.top)
+        self.slot_seconds = app.config.get("QUERY_STATS_SLOT", self.slot_seconds)
+        self.window = max(1, app.config.get("QUERY_STATS_WINDOW", 86400) // self.slot_seconds)
+        self.flush_interval = app.config.get("QUERY_STATS_FLUSH_INTERVAL", self.flush_interval)
+        self.headers = app.config.get("QUERY_STATS_HEADERS", False)
+
+        backend = app.config.get("QUERY_STATS_BACKEND", "memory")
+        if backend == "redis":
+            self.backend = RedisQueryStatsBackend(redis_db.get_client(app))
+        else:
+            self.backend = MemoryQueryStatsBackend()
+        with self._lock:
+            self._pending, self._pending_since = new_aggregate(), None
+
+        # the listeners are added to the Engine class once, for every engine of every application
+        if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+            event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+
+        app.after_request(self.finish_request)
+        app.extensions["query_stats"] = self
+
+    def record_query(self, statement, seconds):
+        """
+        Records an executed statement in the current request's statistics, and in the slow queries
+        if it took longer than the threshold
+        :param statement: SQL statement
+        :param seconds: time the statement took
+        """
+        if not self.enabled:
+            return
+        normalized, fingerprint_id = fingerprint(statement)
+        if fingerprint_id not in self._statements and len(self._statements) < MAX_STATEMENTS:
+            self._statements[fingerprint_id] = normalized
+        endpoint = (request.endpoint or "unknown") if has_request_context() else "no request"
+
+        if has_request_context():
+            current = g.get("query_stats")
+            if current is None:
+                current = g.query_stats = dict(queries=0, seconds=0.0, fingerprints=Counter())
+            current["queries"] += 1
+            current["seconds"] += seconds
+            current["fingerprints"][fingerprint_id] += 1
+
+        if seconds >= self.slow_threshold:
+            current_app.logger.warning("Slow query ({:.3f}s) in {}: {}".format(
+                seconds, endpoint, normalized))
+            slow = dict(count=1, seconds=seconds, max_seconds=seconds, endpoint=endpoint)
+            self._add(dict(endpoints={}, slow={fingerprint_id: slow},
+                           statements={fingerprint_id: normalized}))
+
+    def finish_request(self, response):
+        """
+        Adds the statistics of the request to its endpoint's and warns about N+1 queries
+        :param response: response of the view
+        :return: the response, with the query headers if they are enabled
+        """
+        current = g.pop("query_stats", None) or dict(queries=0, seconds=0.0,
+                                                     fingerprints=Counter())
+        if not self.enabled:
+            return response
+        endpoint = request.endpoint or "unknown"
+
+        n_plus_one = 0
+        for fingerprint_id, count in current["fingerprints"].items():
+            if count >= self.n_plus_one_threshold:
+                n_plus_one += 1
+                current_app.logger.warning("Possible N+1 query in {}, executed {} times: {}".format(
+                    endpoint, count, self._statements.get(fingerprint_id, fingerprint_id)))
+
+        self._add(dict(endpoints={endpoint: dict(
+            requests=1, queries=current["queries"], seconds=current["seconds"],
+            n_plus_one=n_plus_one, fingerprints=current["fingerprints"])}, slow={}, statements={}))
+
+        if self.headers:
+            response.headers["X-Query-Count"] = str(current["queries"])
+            response.headers["X-Query-Time"] = "{:.2f}".format(current["seconds"] * 1000)
+        return response
+
+    def _add(self, aggregate):
+        """
+        Adds statistics to the pending aggregate and flushes it once it is due
+        """
+        with self._lock:
+            merge_aggregates(self._pending, aggregate)
+            if self._pending_since is None:
+                self._pending_since = time.time()
+            due = time.time() - self._pending_since >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Adds the pending statistics to the current slot of the backend
+        """
+        with self._lock:
+            pending, self._pending, self._pending_since = self._pending, new_aggregate(), None
+        if not pending["endpoints"] and not pending["slow"]:
+            return
+        # statements of every fingerprint counted, so that the report can show them
+        for stats in pending["endpoints"].values():
+            for fingerprint_id in stats["fingerprints"]:
+                if fingerprint_id in self._statements:
+                    pending["statements"][fingerprint_id] = self._statements[fingerprint_id]
+        try:
+            self.backend.add(int(time.time() // self.slot_seconds), pending,
+                             self.window * self.slot_seconds)
+        except Exception as e:
+            current_app.logger.warning("Failed to flush query statistics: {}".format(e))
+
+    def report(self, top=None):
+        """
+        Report of the queries over the window, including this process' pending statistics
+        :param top: number of slow fingerprints, defaults to QUERY_STATS_TOP
+        :return: dictionary with the endpoints sorted by database time, each with its most frequent
+         fingerprints, and the slowest fingerprints
+        :rtype: dict
+        """
+        self.flush()
+        slot = int(time.time() // self.slot_seconds)
+        aggregate = new_aggregate()
+        for other in self.backend.load(range(slot - self.window + 1, slot + 1)):
+            merge_aggregates(aggregate, other)
+        statements = aggregate["statements"]
+
+        endpoints = []
+        for endpoint, stats in aggregate["endpoints"].items():
+            requests = max(stats["requests"], 1)
+            endpoints.append(dict(
+                endpoint=endpoint, requests=stats["requests"], queries=stats["queries"],
+                seconds=stats["seconds"], queries_per_request=stats["queries"] / requests,
+                milliseconds_per_request=stats["seconds"] * 1000 / requests,
+                n_plus_one=stats["n_plus_one"],
+                fingerprints=[dict(fingerprint=fingerprint_id, count=count,
+                                   statement=statements.get(fingerprint_id))
+                              for fingerprint_id, count in stats["fingerprints"].most_common(5)]))
+        endpoints.sort(key=lambda stats: stats["seconds"], reverse=True)
+
+        slow = [dict(fingerprint=fingerprint_id, statement=statements.get(fingerprint_id),
+                     endpoint=stats["endpoint"], count=stats["count"],
+                     max_seconds=stats["max_seconds"],
+                     average_seconds=stats["seconds"] / max(stats["count"], 1))
+                for fingerprint_id, stats in aggregate["slow"].items()]
+        slow.sort(key=lambda stats: stats["max_seconds"], reverse=True)
+
+        return dict(window=self.window * self.slot_seconds, endpoints=endpoints,
+                    slow=slow[:top or self.top])
+
+    def clear(self):
+        """
+        Removes all statistics
+        """
+        with self._lock:
+            self._pending, self._pending_since = new_aggregate(), None
+        self.backend.clear()
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["query_stats_started"] = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop("query_stats_started", None)
+    if started is None or not has_app_context():
+        return
+    stats = current_app.extensions.get("query_stats")
+    if stats is not None:
+        stats.record_query(statement, time.perf_counter() - started)
+
+
+query_stats = QueryStats()
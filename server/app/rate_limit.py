@@ -0,0 +1,185 @@
+"""
+Rate limiting of the authentication endpoints
+
+Every login attempt costs a password check, which is deliberately expensive, and every registration
+or password reset sends an email. A client hammering these endpoints therefore takes the hashing
+processes and the mail outbox away from everybody else, and credential stuffing only needs enough
+attempts. Views decorated with rate_limit draw a token from one bucket per key of the request, its
+client's IP address, the email it names and the endpoint, and are answered with a 429 and a
+Retry-After header while any of the buckets is empty.
+
+The buckets are token buckets kept in Redis, so they are shared by all workers. A bucket holds up
+to `capacity` tokens and refills at capacity / period tokens per second. All the buckets of a
+request are checked and drawn from by a single Lua script, atomically, and only if every one of
+them has a token, so requests refused by the IP limit do not drain the buckets of the emails an
+attacker cycles through. If Redis is unavailable requests are let through rather than refused.
+"""
+import hashlib
+import math
+import time
+from functools import wraps
+
+from flask import current_app, request, jsonify
+from redis.exceptions import RedisError
+
+from app import redis_db
+
+# KEYS are the buckets, ARGV the current time, the cost of the request and the capacity and refill
+# rate of each bucket. Returns whether the request is allowed and, if not, the seconds until it
+# would be
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local tokens = {}
+local retry_after = 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[2 * i + 1])
+    local rate = tonumber(ARGV[2 * i + 2])
+    local bucket = redis.call("HMGET", key, "tokens", "updated_at")
+    local available = tonumber(bucket[1]) or capacity
+    local elapsed = math.max(0, now - (tonumber(bucket[2]) or now))
+    available = math.min(capacity, available + elapsed * rate)
+    if available < cost then
+        retry_after = math.max(retry_after, (cost - available) / rate)
+    end
+    tokens[i] = available
+end
+if retry_after > 0 then
+    return {0, tostring(retry_after)}
+end
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[2 * i + 1])
+    local rate = tonumber(ARGV[2 * i + 2])
+    redis.call("HMSET", key, "tokens", tostring(tokens[i] - cost), "updated_at", tostring(now))
+    redis.call("EXPIRE", key, math.ceil(capacity / rate) + 1)
+end
+return {1, "0"}
+"""
+
+
+class RateLimiter(object):
+    """
+    Token buckets in Redis limiting the requests to the views decorated with rate_limit
+    :cvar enabled: whether requests are limited, RATE_LIMIT_ENABLED
+    :cvar limits: limits of each view, RATE_LIMITS
+    :cvar key_prefix: prefix of the buckets' keys
+    """
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.limits = {}
+        self.key_prefix = "rate-limit:"
+        self.client = None
+        self.script = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Configures the limits and registers the token bucket script with the application's Redis
+        client
+        :param app: current flask application
+        """
+        self.enabled = app.config.get("RATE_LIMIT_ENABLED", True)
+        self.limits = app.config.get("RATE_LIMITS", {})
+        self.key_prefix = app.config.get("RATE_LIMIT_KEY_PREFIX", self.key_prefix)
+        self.client = redis_db.get_client(app)
+        self.script = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+        app.extensions["rate_limiter"] = self
+
+    def hit(self, buckets, cost=1, now=None):
+        """
+        Draws from the given buckets if every one of them has enough tokens
+        :param buckets: list of (key, capacity, period) tuples, a bucket holds up to capacity
+         tokens and is refilled in period seconds
+        :param cost: tokens the request costs
+        :param now: current time, the time is passed to the script as scripts must not read it
+        :return: whether the request is allowed and the seconds until it would be
+        :rtype: tuple
+        """
+        if not buckets:
+            return True, 0.0
+        arguments = [now if now is not None else time.time(), cost]
+        for _, capacity, period in buckets:
+            arguments.extend([capacity, float(capacity) / period])
+        allowed, retry_after = self.script(keys=[key for key, _, _ in buckets], args=arguments)
+        return bool(allowed), float(retry_after)
+
+    def buckets(self, name):
+        """
+        Buckets of the current request for the limit with the given name. The email is hashed, so
+        that the keys do not hold the users' addresses, and requests without one skip its bucket
+        :param name: name of the limit in RATE_LIMITS
+        :return: list of (key, capacity, period) tuples
+        :rtype: list
+        """
+        buckets = []
+        for kind, capacity, period in self.limits.get(name, ()):
+            if kind == "ip":
+                value = request.remote_addr or "unknown"
+            elif kind == "email":
+                email = (request.values.get("email") or "").strip().lower()
+                if not email:
+                    continue
+                value = hashlib.sha1(email.encode("utf-8")).hexdigest()
+            elif kind == "route":
+                value = request.endpoint
+            else:
+                raise ValueError("Unknown rate limit key {}".format(kind))
+            buckets.append(("{}{}:{}:{}".format(self.key_prefix, name, kind, value), capacity,
+                            period))
+        return buckets
+
+    def check(self, name):
+        """
+        Draws a token for the current request from the buckets of the named limit
+        :param name: name of the limit in RATE_LIMITS
+        :return: whether the request is allowed and the seconds until it would be
+        :rtype: tuple
+        """
+        if not self.enabled:
+            return True, 0.0
+        try:
+            return self.hit(self.buckets(name))
+        except RedisError as e:
+            # an unavailable limiter must not lock everybody out of their accounts
+            current_app.logger.warning("Rate limit {} not checked: {}".format(name, e))
+            return True, 0.0
+
+    def clear(self):
+        """
+        Removes all the buckets
+        """
+        keys = list(self.client.scan_iter(match=self.key_prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+def rate_limit(name, methods=("POST",)):
+    """
+    Limits the requests to a view with the buckets configured for it in RATE_LIMITS, requests over
+    the limit are answered with a 429 and a Retry-After header
+    :param name: name of the limit in RATE_LIMITS
+    :param methods: methods that are limited, by default only the requests doing the work
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method not in methods:
+                return view(*args, **kwargs)
+            allowed, retry_after = rate_limiter.check(name)
+            if allowed:
+                return view(*args, **kwargs)
+            seconds = max(1, int(math.ceil(retry_after)))
+            response = jsonify(dict(message="Too many requests", success=False,
+                                    response_code=429, retry_after=seconds))
+            response.status_code = 429
+            response.headers["Retry-After"] = str(seconds)
+            return response
+        return wrapper
+    return decorator
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,49 @@
+"""
+Shared Redis client
+
+A single connection pool per application is configured from REDIS_SERVER, REDIS_PORT and REDIS_DB
+and shared by everything that talks to Redis, e.g. sessions and caches, instead of each of them
+opening its own connections. redis-py pools are fork safe, connections are opened lazily in each
+worker process.
+"""
+import redis
+from flask import current_app
+
+
+class RedisStore(object):
+    """
+    Flask extension holding the application's Redis client
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app, client=None):
+        """
+        Creates the connection pool and client for the application
+        :param app: current flask application
+        :param client: client to use instead of one connected to the configured server, e.g. in
+         tests
+        """
+        if client is None:
+            pool = redis.ConnectionPool(
+                host=app.config.get("REDIS_SERVER") or "localhost",
+                port=int(app.config.get("REDIS_PORT") or 6379),
+                db=int(app.config.get("REDIS_DB") or 0),
+                max_connections=app.config.get("REDIS_MAX_CONNECTIONS"),
+                socket_timeout=app.config.get("REDIS_SOCKET_TIMEOUT"))
+            client = redis.StrictRedis(connection_pool=pool)
+        app.extensions["redis"] = client
+
+    @staticmethod
+    def get_client(app=None):
+        """
+        Gets the Redis client of the given or current application
+        :param app: flask application, defaults to the current one
+        :rtype: redis.StrictRedis
+        """
+        return (app or current_app).extensions["redis"]
+
+    def __getattr__(self, name):
+        return getattr(self.get_client(), name)
@@ -0,0 +1,274 @@
+"""
+Read replica routing
+
+The sessions of the application are RoutingSessions, see CroesusSQLAlchemy. They send the SELECT
+statements of the ORM, e.g. load_user and the lookups of the login and the dashboard, to one of the
+DATABASE_REPLICA_URIS, and everything else, flushes, updates, SELECT ... FOR UPDATE and textual
+statements, to the primary SQLALCHEMY_DATABASE_URI. Without replicas every statement goes to the
+primary, as before.
+
+The replica is chosen with DATABASE_REPLICA_POLICY, 'round_robin' or 'least_lag'. The lag of every
+replica is measured every DATABASE_REPLICA_LAG_INTERVAL seconds by a background thread of each
+process, so that no request waits for a replica that does not answer, and replicas lagging more
+than DATABASE_REPLICA_MAX_LAG seconds behind or failing to answer are left out until the next
+measure. When none is left, or none was measured yet, reads go to the primary.
+
+A replica may not have received the rows a request just wrote yet, so reads are sticky: once a
+session flushed changes or ran anything but a SELECT, every statement of that session goes to the
+primary, and after it commits, the reads of the following requests of the same user do as well for
+DATABASE_REPLICA_STICKY_SECONDS, through a timestamp in the user's session. Requests authenticated
+with a bearer token have no session, so only the first kind applies to them.
+
+The replicas are Flask-SQLAlchemy binds named replica_<index>, so their engines get the pool
+settings of app.database, but no model is bound to them and create_all leaves them alone.
+"""
+import itertools
+from contextlib import contextmanager
+import os
+import threading
+import time
+
+from flask import session as user_session, has_request_context
+from flask_sqlalchemy import SignallingSession, get_state
+from sqlalchemy import event
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql.expression import Select, CompoundSelect
+
+# key of the user's session holding the time until which its reads go to the primary
+STICKY_SESSION_KEY = "_db_primary_until"
+
+# replay lag of a postgresql standby, 0 when it replayed everything it received
+POSTGRES_LAG_QUERY = ("SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() "
+                      "THEN 0 ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) "
+                      "END")
+
+
+def measure_lag(engine):
+    """
+    Seconds a replica is behind the primary, other databases than postgresql have no lag
+    :param engine: engine of the replica
+    :return: the lag, infinity if the replica can not be reached
+    :rtype: float
+    """
+    try:
+        with engine.connect() as connection:
+            if engine.dialect.name != "postgresql":
+                connection.execute("SELECT 1")
+                return 0.0
+            return float(connection.execute(POSTGRES_LAG_QUERY).scalar() or 0.0)
+    except SQLAlchemyError:
+        return float("inf")
+
+
+class ReplicaRouter(object):
+    """
+    Chooses the database of the statements of the RoutingSessions
+    :cvar binds: bind keys of the replicas
+    :cvar policy: how a replica is chosen, DATABASE_REPLICA_POLICY
+    :cvar max_lag: seconds a replica may lag behind, DATABASE_REPLICA_MAX_LAG
+    :cvar lag_interval: seconds between two measures of the lag, DATABASE_REPLICA_LAG_INTERVAL
+    :cvar sticky_seconds: seconds the reads of a user go to the primary after a commit,
+     DATABASE_REPLICA_STICKY_SECONDS
+    :cvar lags: lag of every replica as last measured, replicas not measured yet are not read
+    """
+
+    POLICIES = ("round_robin", "least_lag")
+
+    def __init__(self, app=None):
+        self.binds = []
+        self.policy = "round_robin"
+        self.max_lag = 10.0
+        self.lag_interval = 5.0
+        self.sticky_seconds = 10.0
+        self.lags = {}
+        self.measured_at = 0.0
+        self._cycle = itertools.count()
+        self._lock = threading.Lock()
+        self._monitor = None
+        self._monitor_pid = None
+        self._stopped = threading.Event()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Adds the replicas to the binds of the application
+        :param app: current flask application
+        """
+        self.policy = app.config.get("DATABASE_REPLICA_POLICY", self.policy)
+        if self.policy not in self.POLICIES:
+            raise ValueError("DATABASE_REPLICA_POLICY must be one of {}, not {!r}".format(
+                ", ".join(self.POLICIES), self.policy))
+        self.max_lag = app.config.get("DATABASE_REPLICA_MAX_LAG", self.max_lag)
+        self.lag_interval = app.config.get("DATABASE_REPLICA_LAG_INTERVAL", self.lag_interval)
+        self.sticky_seconds = app.config.get("DATABASE_REPLICA_STICKY_SECONDS",
+                                             self.sticky_seconds)
+
+        binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+        self.binds = []
+        for index, uri in enumerate(app.config.get("DATABASE_REPLICA_URIS") or []):
+            key = "replica_{}".format(index)
+            binds[key] = uri
+            self.binds.append(key)
+        if self.binds:
+            app.config["SQLALCHEMY_BINDS"] = binds
+        # the thread of a previous application would go on measuring its replicas
+        with self._lock:
+            self._stopped.set()
+            self._stopped = threading.Event()
+            self._monitor = None
+            self.lags = {}
+            self.measured_at = 0.0
+        app.extensions["replica_router"] = self
+
+    def replica(self, db, app):
+        """
+        Engine of the replica the next read goes to
+        :param db: Flask-SQLAlchemy extension
+        :param app: current flask application
+        :return: the engine, None if no replica is available
+        """
+        if not self.binds:
+            return None
+        self._ensure_monitor(db, app)
+        lags = self.lags
+        available = [key for key in self.binds if lags.get(key, float("inf")) <= self.max_lag]
+        if not available:
+            return None
+        if self.policy == "least_lag":
+            key = min(available, key=lambda bind: lags[bind])
+        else:
+            key = available[next(self._cycle) % len(available)]
+        return db.get_engine(app, bind=key)
+
+    def measure(self, db, app, stopped=None):
+        """
+        Measures the lag of the replicas
+        :param db: Flask-SQLAlchemy extension
+        :param app: current flask application
+        :param stopped: event of the monitor thread measuring, the lags are dropped once it is set
+        """
+        lags = {key: measure_lag(db.get_engine(app, bind=key)) for key in self.binds}
+        with self._lock:
+            if stopped is None or not stopped.is_set():
+                self.lags = lags
+                self.measured_at = time.time()
+
+    def _ensure_monitor(self, db, app):
+        """
+        Starts the background thread measuring the lag of the replicas. This is started lazily so
+        that each forked worker gets its own thread
+        """
+        if self._monitor is not None and self._monitor_pid == os.getpid() and \
+                self._monitor.is_alive():
+            return
+
+        with self._lock:
+            if self._monitor is not None and self._monitor_pid == os.getpid() and \
+                    self._monitor.is_alive():
+                return
+            # the sessions hold the current_app proxy, which the thread can not resolve
+            app = getattr(app, "_get_current_object", lambda: app)()
+            self._monitor_pid = os.getpid()
+            self._monitor = threading.Thread(target=self._run_monitor,
+                                             args=(db, app, self._stopped),
+                                             name="replica-lag-monitor", daemon=True)
+            self._monitor.start()
+
+    def _run_monitor(self, db, app, stopped):
+        """
+        Measures the lag every lag_interval seconds until the router is configured again
+        """
+        while not stopped.wait(self._seconds_until_due()):
+            try:
+                # the engines made by the sessions of the requests look their application up
+                with app.app_context():
+                    self.measure(db, app, stopped)
+            except Exception as e:
+                # the replicas are left out until the next measure rather than measured in a loop
+                with self._lock:
+                    if not stopped.is_set():
+                        self.lags = {}
+                        self.measured_at = time.time()
+                app.logger.warning("Failed to measure the lag of the replicas: {}".format(e))
+
+    def _seconds_until_due(self):
+        """
+        Time the monitor sleeps for, until the last measure is lag_interval seconds old
+        :rtype: float
+        """
+        return max(0.0, self.measured_at + self.lag_interval - time.time())
+
+    def stick(self):
+        """
+        Sends the reads of the current user to the primary for the next sticky_seconds
+        """
+        if self.binds and self.sticky_seconds and has_request_context():
+            user_session[STICKY_SESSION_KEY] = time.time() + self.sticky_seconds
+
+    def sticky(self):
+        """
+        Whether the reads of the current user go to the primary
+        :rtype: bool
+        """
+        return has_request_context() and user_session.get(STICKY_SESSION_KEY, 0) > time.time()
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session sending its reads to the replicas and its writes to the primary, see ReplicaRouter
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        # once the session wrote, all its statements go to the primary until it is removed at the
+        # end of the request, textual statements may write as well
+        if self._flushing or (clause is not None and not is_read(clause)):
+            self.info["wrote"] = True
+        if self.info.get("wrote") or self.info.get("primary"):
+            return SignallingSession.get_bind(self, mapper, clause)
+
+        router = self.app.extensions.get("replica_router")
+        if router is None or not router.binds or clause is None or router.sticky():
+            return SignallingSession.get_bind(self, mapper, clause)
+        return router.replica(get_state(self.app).db, self.app) or \
+            SignallingSession.get_bind(self, mapper, clause)
+
+
+@contextmanager
+def primary(session):
+    """
+    Sends the reads of a session to the primary within the block, for reads that must not be stale
+    :param session: session, or the scoped session of the db
+    """
+    previous = session.info.get("primary")
+    session.info["primary"] = True
+    try:
+        yield session
+    finally:
+        session.info["primary"] = previous
+
+
+def is_read(clause):
+    """
+    Whether a statement only reads and can run on a replica
+    :param clause: statement
+    :rtype: bool
+    """
+    if isinstance(clause, CompoundSelect):
+        return all(is_read(select) for select in clause.selects)
+    return isinstance(clause, Select) and clause._for_update_arg is None
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def stick_after_commit(session):
+    """
+    Keeps the reads of the user on the primary after a commit of changes
+    """
+    if session.info.get("wrote"):
+        router = session.app.extensions.get("replica_router")
+        if router is not None:
+            router.stick()
+
+
+replica_router = ReplicaRouter()
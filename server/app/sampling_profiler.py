@@ -0,0 +1,262 @@
+"""
+Sampling profiler of the requests
+
+Profiling every call of every request, like cProfile does, slows the requests down several times
+and can not be left running on real traffic. Instead, while a profiling session runs, a thread of
+the worker looks at the stacks of the requests being sampled every PROFILER_INTERVAL seconds and
+counts them by endpoint. The requests themselves are not slowed down beyond the time the sampler
+thread holds the interpreter lock, which is a few microseconds per sample.
+
+A session is started in a single worker process, for a number of seconds and for a share of the
+requests, either with the PROFILER_SIGNAL signal, e.g. `kill -URG <worker pid>`, or `pkill -URG -P
+$(pgrep -o -f manage:app)` for all the workers of the gunicorn master, or with the admin endpoint
+of the worker that answers it. The signals gunicorn handles can not be used, USR2 would have the
+master exec a new master, while SIGURG is ignored by the processes that do not handle it, the
+master included. When it ends the stacks of each endpoint are written in the collapsed stack
+format, one `frame;frame;frame count` line per stack, to
+PROFILER_OUTPUT_DIR/<time>-<pid>/<endpoint>.folded, which flamegraph.pl and speedscope turn into
+flame graphs.
+
+Samples are only taken of requests running in threads, greenlets of gevent workers are not seen.
+"""
+import os
+import random
+import re
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from flask import request
+
+
+# signals gunicorn handles in its master or its workers
+GUNICORN_SIGNALS = ("SIGHUP", "SIGQUIT", "SIGINT", "SIGTERM", "SIGTTIN", "SIGTTOU", "SIGUSR1",
+                    "SIGUSR2", "SIGWINCH", "SIGCHLD", "SIGABRT")
+
+# labels of the code objects seen, formatting them again for every sample would cost more than
+# walking the stack
+LABELS = {}
+
+
+def collapse(frame, max_depth=128):
+    """
+    Collapsed stack of a frame, its outermost caller first
+    :param frame: innermost frame of the stack
+    :param max_depth: number of innermost frames kept
+    :rtype: str
+    """
+    labels = []
+    while frame is not None and len(labels) < max_depth:
+        code = frame.f_code
+        label = LABELS.get(code)
+        if label is None:
+            label = LABELS[code] = "{}:{}".format(frame.f_globals.get("__name__", "?"),
+                                                  code.co_name)
+        labels.append(label)
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stacks of the requests of this worker while a profiling session runs
+    :cvar interval: seconds between two samples, PROFILER_INTERVAL
+    :cvar output_dir: directory the sessions are written to, PROFILER_OUTPUT_DIR
+    :cvar max_depth: number of innermost frames kept of every stack
+    :cvar session: current or last session, with its start, end, rate, number of samples and
+     output files
+    """
+
+    def __init__(self, app=None):
+        self.interval = 0.01
+        self.output_dir = "profiles"
+        self.max_depth = 128
+        self.signal_seconds = 30
+        self.signal_rate = 1.0
+        self.session = None
+        # a signal may start a session while the main thread holds the lock
+        self._lock = threading.RLock()
+        self._threads = {}
+        self._stacks = {}
+        self._until = None
+        self._rate = 0.0
+        self._sampler = None
+        self._sampler_pid = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Configures the profiler, marks the sampled requests and installs the signal handler that
+        starts a session
+        :param app: current flask application
+        """
+        self.interval = app.config.get("PROFILER_INTERVAL", self.interval)
+        self.output_dir = app.config.get("PROFILER_OUTPUT_DIR", self.output_dir)
+        self.signal_seconds = app.config.get("PROFILER_SIGNAL_SECONDS", self.signal_seconds)
+        self.signal_rate = app.config.get("PROFILER_SIGNAL_RATE", self.signal_rate)
+
+        app.before_request(self.start_request)
+        app.teardown_request(self.end_request)
+
+        name = app.config.get("PROFILER_SIGNAL")
+        if name in GUNICORN_SIGNALS:
+            raise ValueError("PROFILER_SIGNAL can not be {}, gunicorn handles it".format(name))
+        # handlers can only be installed by the main thread, gunicorn workers load the
+        # application in theirs
+        if name and threading.current_thread() is threading.main_thread():
+            signal.signal(getattr(signal, name), self.on_signal)
+        app.extensions["sampling_profiler"] = self
+
+    @property
+    def active(self):
+        """
+        Whether a session is running
+        :rtype: bool
+        """
+        until = self._until
+        return until is not None and time.time() < until
+
+    def start(self, seconds=30, rate=1.0):
+        """
+        Starts a profiling session in this worker
+        :param seconds: duration of the session
+        :param rate: share of the requests that are sampled, between 0 and 1
+        :return: the session, or None if one is already running
+        :rtype: dict
+        """
+        with self._lock:
+            if self.active:
+                return None
+            self._stacks = {}
+            self._rate = rate
+            self._until = time.time() + seconds
+            self.session = dict(pid=os.getpid(), started_at=time.time(), seconds=seconds,
+                                rate=rate, samples=0, files=[], running=True)
+            if self._sampler is None or self._sampler_pid != os.getpid() or \
+                    not self._sampler.is_alive():
+                self._sampler_pid = os.getpid()
+                self._sampler = threading.Thread(target=self._run, name="sampling-profiler",
+                                                 daemon=True)
+                self._sampler.start()
+            return dict(self.session)
+
+    def stop(self):
+        """
+        Ends the current session and writes its stacks
+        :return: the session with its output files, None if no session was started
+        :rtype: dict
+        """
+        with self._lock:
+            if self.session is None or not self.session["running"]:
+                return dict(self.session) if self.session is not None else None
+            stacks, self._stacks, self._until = self._stacks, {}, None
+            self._threads.clear()
+            self.session.update(running=False, files=self.write(stacks))
+            return dict(self.session)
+
+    def on_signal(self, signum, frame):
+        self.start(self.signal_seconds, self.signal_rate)
+
+    def start_request(self):
+        if self._until is not None and self.active and random.random() < self._rate:
+            self._threads[threading.get_ident()] = request.endpoint or "unknown"
+
+    def end_request(self, exception=None):
+        if self._threads:
+            self._threads.pop(threading.get_ident(), None)
+
+    def sample(self):
+        """
+        Counts the current stack of every sampled request
+        """
+        frames = sys._current_frames()
+        with self._lock:
+            for ident, endpoint in list(self._threads.items()):
+                frame = frames.get(ident)
+                if frame is not None:
+                    self._stacks.setdefault(endpoint, Counter())[collapse(frame,
+                                                                          self.max_depth)] += 1
+                    self.session["samples"] += 1
+
+    def _run(self):
+        """
+        Samples until the session ends, then writes it
+        """
+        while True:
+            until = self._until
+            if until is None:
+                return
+            if time.time() >= until:
+                self.stop()
+                return
+            self.sample()
+            time.sleep(self.interval)
+
+    def write(self, stacks):
+        """
+        Writes the stacks of every endpoint in the collapsed stack format
+        :param stacks: dictionary of endpoints and the counts of their stacks
+        :return: paths of the written files
+        :rtype: list
+        """
+        if not stacks:
+            return []
+        directory = os.path.join(self.output_dir, "{:%Y%m%d-%H%M%S}-{}".format(
+            datetime.now(), os.getpid()))
+        os.makedirs(directory, exist_ok=True)
+
+        files = []
+        for endpoint, counts in stacks.items():
+            path = os.path.join(directory, "{}.folded".format(re.sub(r"[^\w.-]", "_", endpoint)))
+            with open(path, "w") as output:
+                for stack, count in counts.most_common():
+                    output.write("{} {}\n".format(stack, count))
+            files.append(path)
+        return files
+
+
+def benchmark(app, path="/home", count=2000, interval=0.01, rounds=10):
+    """
+    Measures the requests per second of a test client with and without a profiling session. The
+    runs alternate in rounds, so that both are equally affected by anything else the machine does
+    :param app: application to send the requests to
+    :param path: path requested
+    :param count: number of requests of each run
+    :param interval: sampling interval of the profiled run
+    :param rounds: number of rounds the requests of each run are split in
+    :return: list of dictionaries with the name of the run, its requests per second and, for the
+     profiled run, the number of samples taken
+    :rtype: list
+    """
+    client = app.test_client()
+    profiler = app.extensions["sampling_profiler"]
+    profiler.interval = interval
+    for _ in range(min(count, 100)):
+        client.get(path)
+
+    elapsed = dict(unprofiled=0.0, profiled=0.0)
+    samples = 0
+    for _ in range(rounds):
+        for name in ("unprofiled", "profiled"):
+            if name == "profiled":
+                profiler.start(seconds=3600, rate=1.0)
+            started = time.perf_counter()
+            for _ in range(count // rounds):
+                client.get(path)
+            elapsed[name] += time.perf_counter() - started
+            if name == "profiled":
+                samples += profiler.stop()["samples"]
+
+    requests = count // rounds * rounds
+    return [dict(name="unprofiled", requests_per_second=requests / elapsed["unprofiled"],
+                 samples=0),
+            dict(name="profiled", requests_per_second=requests / elapsed["profiled"],
+                 samples=samples)]
+
+
+sampling_profiler = SamplingProfiler()
@@ -0,0 +1,186 @@
+"""
+Session interfaces for the application
+
+Requests authenticated with a bearer token are stateless, they must neither create nor refresh a
+session, otherwise every API call would write a session cookie.
+
+Sessions can also be kept server side in Redis, in which case the cookie only holds a random
+session id. Session data is only fetched from Redis when the session is first used during a
+request, it is only written back when it has been modified, and the expiry of the key slides
+forward with every request. The session id changes when the user logs in or out, an id planted in
+the browser of a victim before it logs in does not give access to its session afterwards.
+"""
+import base64
+import os
+
+from flask import g, session as current_session
+from flask.sessions import SecureCookieSessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+
+class TokenAwareSessionInterface(SecureCookieSessionInterface):
+    """
+    Signed cookie sessions that are never saved for requests authenticated with a bearer token
+    """
+
+    def save_session(self, app, session, response):
+        if g.get("login_via_token"):
+            return
+        return super(TokenAwareSessionInterface, self).save_session(app, session, response)
+
+
+class RedisSession(CallbackDict, SessionMixin):
+    """
+    Session stored in Redis whose data is loaded on first access
+    :cvar sid: session id, also the suffix of the Redis key
+    :cvar new: True if there was no session for this request yet
+    :cvar loaded: True once the data has been read from Redis
+    :cvar previous_sid: id the session had before it was regenerated, deleted when it is saved
+    """
+
+    def __init__(self, sid, loader=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        CallbackDict.__init__(self, on_update=on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.previous_sid = None
+        self._loader = loader
+
+    @property
+    def loaded(self):
+        return self._loader is None
+
+    def load(self):
+        """
+        Reads the session data from Redis, if it has not been read yet
+        """
+        if self._loader is not None:
+            loader, self._loader = self._loader, None
+            data = loader()
+            if data:
+                dict.update(self, data)
+
+    def regenerate(self):
+        """
+        Moves the session data to a new session id
+        """
+        self.load()
+        if not self.new and self.previous_sid is None:
+            self.previous_sid = self.sid
+        self.sid = RedisSessionInterface.generate_sid()
+        self.modified = True
+
+
+def _load_first(name):
+    """
+    Wraps a dictionary method so that the session data is loaded before it runs
+    """
+    method = getattr(CallbackDict, name)
+
+    def wrapper(self, *args, **kwargs):
+        self.load()
+        return method(self, *args, **kwargs)
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+for _name in ("__getitem__", "__setitem__", "__delitem__", "__contains__", "__iter__",
+              "__len__", "__repr__", "__eq__", "get", "keys", "values", "items", "pop",
+              "popitem", "setdefault", "update", "clear", "copy"):
+    setattr(RedisSession, _name, _load_first(_name))
+
+
+class RedisSessionInterface(TokenAwareSessionInterface):
+    """
+    Server side sessions kept in Redis
+    :cvar key_prefix: prefix of the Redis keys holding the sessions
+    """
+
+    def __init__(self, client, key_prefix="session:"):
+        self.client = client
+        self.key_prefix = key_prefix
+
+    @staticmethod
+    def generate_sid():
+        return base64.urlsafe_b64encode(os.urandom(32)).decode("ascii").rstrip("=")
+
+    def get_expiration_seconds(self, app):
+        return int(app.permanent_session_lifetime.total_seconds())
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if not sid:
+            return RedisSession(self.generate_sid(), new=True)
+
+        session = RedisSession(sid)
+
+        def loader():
+            data = self.client.get(self.key_prefix + sid)
+            if data is not None:
+                try:
+                    return self.serializer.loads(data.decode("utf-8"))
+                except ValueError:
+                    pass
+            # the id is unknown or has expired, an id chosen by the client is never reused
+            session.sid = self.generate_sid()
+            session.new = True
+            return None
+
+        session._loader = loader
+        return session
+
+    def save_session(self, app, session, response):
+        if g.get("login_via_token"):
+            return
+
+        # the data of a regenerated session has moved to its new id
+        if session.previous_sid is not None:
+            self.client.delete(self.key_prefix + session.previous_sid)
+
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        key = self.key_prefix + session.sid
+        ttl = self.get_expiration_seconds(app)
+
+        # an emptied session is removed from Redis along with its cookie
+        if session.modified and session.loaded and not dict.__len__(session):
+            if not session.new:
+                self.client.delete(key)
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+
+        if session.modified:
+            # data and expiry are written together by a single SETEX
+            self.client.setex(key, ttl, self.serializer.dumps(dict(session)))
+        elif session.new:
+            # nothing was stored, so there is nothing to refresh
+            return
+        elif app.config.get("SESSION_REFRESH_EACH_REQUEST", True):
+            # slide the expiry of the stored session forward without reading or rewriting it
+            self.client.expire(key, ttl)
+            # the cookie of a permanent session is refreshed too, which needs the session data
+            if not (session.loaded and session.permanent):
+                return
+        else:
+            return
+
+        response.set_cookie(app.session_cookie_name, session.sid,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path, secure=self.get_cookie_secure(app))
+
+
+def regenerate_session(app, user=None):
+    """
+    Gives the session of the current request a new id when the user logs in or out. Signed cookie
+    sessions have no id, their content changes with the user
+    :param app: the current flask app
+    :param user: the user logging in or out
+    """
+    regenerate = getattr(current_session, "regenerate", None)
+    if regenerate is not None:
+        regenerate()
@@ -0,0 +1,94 @@
+"""
+Startup profiling
+
+Every gunicorn worker and celery worker creates the application, and whatever it imports is loaded
+before the workers fork. StartupProfiler times the steps of create_app, the configuration, every
+extension and every blueprint, and counts the modules each of them loads.
+
+profile_startup runs in a fresh interpreter, so that nothing is imported yet, and measures the
+import of the main dependencies and of the app package as well, see manage.py startup_profile.
+"""
+import json
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+# imported one by one before the app package, so that their share of its import time shows
+DEPENDENCIES = ("jinja2", "flask", "sqlalchemy", "flask_sqlalchemy", "flask_login", "flask_mail",
+                "redis", "celery")
+
+# run by profile_startup in a fresh interpreter, with the configuration name and the dependencies
+# as arguments
+CHILD = """
+import json, sys, time
+steps = []
+for name in sys.argv[2:] + ["app"]:
+    before, started = len(sys.modules), time.perf_counter()
+    __import__(name)
+    steps.append(dict(kind="import", name=name, seconds=time.perf_counter() - started,
+                      modules=len(sys.modules) - before))
+from app.startup import profile_create_app
+print(json.dumps(steps + profile_create_app(sys.argv[1])))
+"""
+
+
+class StartupProfiler(object):
+    """
+    Times the steps of the application's startup
+    :cvar enabled: whether steps are timed, create_app uses a disabled profiler by default
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.steps = []
+
+    @contextmanager
+    def step(self, kind, name):
+        """
+        Times a step and counts the modules imported during it
+        :param kind: kind of step, e.g. 'extension' or 'blueprint'
+        :param name: name of the step
+        """
+        if not self.enabled:
+            yield
+            return
+
+        before, started = len(sys.modules), time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps.append(dict(kind=kind, name=name, seconds=time.perf_counter() - started,
+                                   modules=len(sys.modules) - before))
+
+
+def profile_create_app(config_name):
+    """
+    Creates an application with a startup profiler
+    :param config_name: configuration to create the application with
+    :return: steps of create_app, the last one being create_app as a whole, followed by the number
+     of modules loaded in the end
+    :rtype: list
+    """
+    from app import create_app
+
+    profiler = StartupProfiler()
+    with profiler.step("app", "create_app"):
+        create_app(config_name, profiler=profiler)
+    return profiler.steps + [dict(kind="total", name="modules loaded", seconds=None,
+                                  modules=len(sys.modules))]
+
+
+def profile_startup(config_name, cwd=None, dependencies=DEPENDENCIES):
+    """
+    Profiles the startup of the application in a fresh interpreter
+    :param config_name: configuration to create the application with
+    :param cwd: directory the interpreter runs in, the one containing the app package
+    :param dependencies: modules whose import is timed before the app package's
+    :return: timed steps, imports first, then the steps of create_app
+    :rtype: list
+    """
+    output = subprocess.check_output([sys.executable, "-c", CHILD, config_name] +
+                                     list(dependencies), cwd=cwd)
+    # anything printed while the application starts comes before the report
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
@@ -0,0 +1,130 @@
+"""
+Template caches
+
+Jinja compiles a template to Python source and then to bytecode the first time it is loaded. The
+compiled templates are kept in the environment's cache, an LRU of JINJA_CACHE_SIZE templates, and
+their bytecode in a bytecode cache that outlives the process, so that a new worker process only
+unmarshals the bytecode of a template instead of compiling it again.
+
+The bytecode cache is either a directory, JINJA_BYTECODE_CACHE = 'filesystem', or Redis,
+JINJA_BYTECODE_CACHE = 'redis', for hosts that do not share a disk. Jinja checks the bytecode
+against the checksum of the template's source, an edited template is compiled again.
+
+compile_templates fills the bytecode cache with every template of the application, the global ones
+and those of every blueprint, see manage.py compile_templates. While building an image, where
+there is no database, `python -m app.template_cache` does the same outside of an application
+context, which would open a database session when it ends.
+"""
+import logging
+import os
+
+from jinja2 import BytecodeCache, FileSystemBytecodeCache, TemplateSyntaxError
+from redis import RedisError
+
+logger = logging.getLogger(__name__)
+
+
+class RedisBytecodeCache(BytecodeCache):
+    """
+    Bytecode cache kept in Redis. Failing to reach Redis only costs a compilation
+    :cvar key_prefix: prefix of the keys of the cached bytecode
+    :cvar timeout: seconds the bytecode of a template is kept, None to keep it forever
+    """
+
+    def __init__(self, app, key_prefix="jinja:", timeout=None):
+        self.app = app
+        self.key_prefix = key_prefix
+        self.timeout = timeout
+
+    @property
+    def client(self):
+        from app import redis_db
+        return redis_db.get_client(self.app)
+
+    def load_bytecode(self, bucket):
+        try:
+            code = self.client.get(self.key_prefix + bucket.key)
+        except RedisError as e:
+            logger.warning("Failed to load template bytecode: {}".format(e))
+            return
+        if code is not None:
+            bucket.bytecode_from_string(code)
+
+    def dump_bytecode(self, bucket):
+        key, code = self.key_prefix + bucket.key, bucket.bytecode_to_string()
+        try:
+            if self.timeout:
+                self.client.setex(key, self.timeout, code)
+            else:
+                self.client.set(key, code)
+        except RedisError as e:
+            logger.warning("Failed to store template bytecode: {}".format(e))
+
+    def clear(self):
+        client = self.client
+        for key in client.scan_iter(match=self.key_prefix + "*"):
+            client.delete(key)
+
+
+def create_bytecode_cache(app):
+    """
+    Creates the bytecode cache configured by JINJA_BYTECODE_CACHE
+    :param app: current flask application
+    :return: bytecode cache or None if templates are compiled in every process
+    :rtype: BytecodeCache
+    """
+    backend = app.config.get("JINJA_BYTECODE_CACHE")
+    if backend == "filesystem":
+        directory = app.config["JINJA_BYTECODE_CACHE_DIR"]
+        os.makedirs(directory, exist_ok=True)
+        return FileSystemBytecodeCache(directory)
+    if backend == "redis":
+        return RedisBytecodeCache(app, timeout=app.config.get("JINJA_BYTECODE_CACHE_TTL"))
+    if backend:
+        raise ValueError("Unknown JINJA_BYTECODE_CACHE {}".format(backend))
+    return None
+
+
+def compile_templates(app, extensions=("html", "txt", "xml")):
+    """
+    Compiles every template of the application, which stores its bytecode in the bytecode cache
+    :param app: current flask application
+    :param extensions: extensions of the files in the template folders that are templates
+    :return: names of the compiled templates and the templates that failed to compile, with their
+     error
+    :rtype: tuple
+    """
+    environment = app.jinja_env
+    compiled, failed = [], []
+
+    for name in environment.list_templates(extensions=extensions):
+        try:
+            environment.get_template(name)
+        except TemplateSyntaxError as e:
+            failed.append((name, e))
+        else:
+            compiled.append(name)
+    return compiled, failed
+
+
+def main(config_name):
+    """
+    Compiles the templates of an application created with the given configuration and prints
+    those that failed, which are left to be reported when they are rendered
+    :param config_name: name of the configuration
+    """
+    from app import create_app
+
+    app = create_app(config_name)
+    if app.jinja_env.bytecode_cache is None:
+        print("No JINJA_BYTECODE_CACHE configured, templates are compiled in every process")
+        return
+
+    compiled, failed = compile_templates(app)
+    print("Compiled {} templates".format(len(compiled)))
+    for name, error in failed:
+        print("Failed to compile {}: {}".format(name, error))
+
+
+if __name__ == "__main__":
+    main(os.getenv("FLASK_CONFIG") or "default")
@@ -7,14 +7,22 @@ the context necessary for the Flask background tasks to run.
 This creates a Flask application and pushes an application context, which will remain set
  through the entire life of the process.
 
+With METRICS_ENABLED, the queue time and runtime of the tasks, recorded by the pool processes, are
+served by the main process on CELERY_METRICS_PORT, which Prometheus scrapes besides the metrics
+endpoint of the application.
+
 :usage:
 (venv) $ celery worker -A celery_worker.celery --loglevel=info 
 """
 import os
+import tempfile
+
+from celery.signals import worker_init, worker_process_shutdown
 
 # celery import is necessary, even though it will not be used here. it is vital for celery
 # to run
 from app import create_app, celery
+from app.metrics import clear_multiprocess_dir, serve_worker_metrics
 from setup_environment import setup_environment_variables
 import click
 
@@ -24,5 +32,39 @@ setup_environment_variables()
 # log info
 click.echo(click.style("Running celery worker", fg="yellow", bg="black", bold=True))
 
+# the tasks run in the pool processes, which write their metrics to a directory of their own, apart
+# from the one of gunicorn, see app.metrics. prometheus_client reads it when create_app imports it
+metrics_dir = os.environ.get("CELERY_METRICS_DIR") or \
+    os.path.join(tempfile.gettempdir(), "croesus-celery-metrics")
+os.environ["PROMETHEUS_MULTIPROC_DIR"] = os.environ["prometheus_multiproc_dir"] = metrics_dir
+os.makedirs(metrics_dir, exist_ok=True)
+
 app = create_app(os.environ.get("FLASK_CONFIG", "default"))
 app.app_context().push()
+
+# the web processes import the crawler lazily, the workers load it before they fork
+from app.mod_blog.crawler import get_crawler
+get_crawler(app)
+
+
+@worker_init.connect
+def serve_metrics(**kwargs):
+    """
+    Serves the metrics of the pool processes from the main process of the worker, beat does not
+    start a worker and serves none
+    """
+    if app.config["METRICS_ENABLED"]:
+        clear_multiprocess_dir(metrics_dir, keep=os.getpid())
+        if app.config["CELERY_METRICS_PORT"]:
+            serve_worker_metrics(app.config["CELERY_METRICS_PORT"])
+
+
+@worker_process_shutdown.connect
+def mark_process_dead(pid=None, **kwargs):
+    """
+    Drops the live gauges of a pool process when it exits
+    """
+    if app.config["METRICS_ENABLED"]:
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(pid, metrics_dir)
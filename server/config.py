@@ -29,6 +29,9 @@ class Config(object):
     __metaclass__ = ABCMeta
     SSL_DISABLE = False
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'arco'
+    # previous secret keys, tokens signed with them are still accepted while keys are rotated
+    SECRET_KEY_FALLBACKS = [key for key in os.environ.get("SECRET_KEY_FALLBACKS", "").split(",")
+                            if key]
 
     # DATABASE CONFIGS
     SQLALCHEMY_COMMIT_ON_TEARDOWN = True
@@ -38,10 +41,106 @@ class Config(object):
     POSTGRES_USER = os.environ.get("POSTGRES_USER")
     POSTGRES_DB = os.environ.get("POSTGRES_DB")
     POSTGRES_PASSWORD = os.environ.get("POSTGRES_PASSWORD")
+    # arguments of the database driver's connect()
     DATABASE_CONNECT_OPTIONS = {}
 
+    # connection pool of every process, see app.database. SQLALCHEMY_POOL_SIZE connections are
+    # kept, SQLALCHEMY_MAX_OVERFLOW more are opened under load and a checkout waits at most
+    # SQLALCHEMY_POOL_TIMEOUT seconds. Connections are tested before use with
+    # DATABASE_POOL_PRE_PING and replaced after SQLALCHEMY_POOL_RECYCLE seconds, and statements are
+    # cancelled after DATABASE_STATEMENT_TIMEOUT milliseconds (0 never). DATABASE_PGBOUNCER is set
+    # when connecting through PgBouncer in transaction pooling mode
+    SQLALCHEMY_POOL_SIZE = int(os.environ.get("SQLALCHEMY_POOL_SIZE", 5))
+    SQLALCHEMY_MAX_OVERFLOW = int(os.environ.get("SQLALCHEMY_MAX_OVERFLOW", 10))
+    SQLALCHEMY_POOL_TIMEOUT = int(os.environ.get("SQLALCHEMY_POOL_TIMEOUT", 10))
+    SQLALCHEMY_POOL_RECYCLE = int(os.environ.get("SQLALCHEMY_POOL_RECYCLE", 1800))
+    DATABASE_POOL_PRE_PING = os.environ.get("DATABASE_POOL_PRE_PING", "true").lower() == "true"
+    DATABASE_STATEMENT_TIMEOUT = int(os.environ.get("DATABASE_STATEMENT_TIMEOUT", 30000))
+    DATABASE_PGBOUNCER = os.environ.get("DATABASE_PGBOUNCER", "false").lower() == "true"
+
+    # read replicas, see app.replicas. The reads of the ORM go to the comma separated
+    # DATABASE_REPLICA_URIS, chosen 'round_robin' or by 'least_lag' with DATABASE_REPLICA_POLICY,
+    # skipping those more than DATABASE_REPLICA_MAX_LAG seconds behind, measured every
+    # DATABASE_REPLICA_LAG_INTERVAL seconds. After a commit the reads of the user go to the primary
+    # for DATABASE_REPLICA_STICKY_SECONDS
+    DATABASE_REPLICA_URIS = [uri for uri in os.environ.get("DATABASE_REPLICA_URIS", "").split(",")
+                             if uri]
+    DATABASE_REPLICA_POLICY = os.environ.get("DATABASE_REPLICA_POLICY", "round_robin")
+    DATABASE_REPLICA_MAX_LAG = float(os.environ.get("DATABASE_REPLICA_MAX_LAG", 10))
+    DATABASE_REPLICA_LAG_INTERVAL = float(os.environ.get("DATABASE_REPLICA_LAG_INTERVAL", 5))
+    DATABASE_REPLICA_STICKY_SECONDS = float(os.environ.get("DATABASE_REPLICA_STICKY_SECONDS", 10))
+
     SECURITY_PASSWORD_SALT = os.environ.get("SECURITY_PASSWORD_SALT") or 'precious_arco'
 
+    # password hashing settings. hashes created with another method or number of iterations are
+    # upgraded when the user logs in. PASSWORD_HASH_POOL_SIZE processes do the hashing, 0 hashes on
+    # the request thread
+    PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "pbkdf2:sha256")
+    PASSWORD_HASH_ITERATIONS = int(os.environ.get("PASSWORD_HASH_ITERATIONS", 150000))
+    PASSWORD_SALT_LENGTH = int(os.environ.get("PASSWORD_SALT_LENGTH", 8))
+    PASSWORD_HASH_POOL_SIZE = int(os.environ.get("PASSWORD_HASH_POOL_SIZE", 2))
+
+    # bearer token authentication settings, verified tokens are cached for AUTH_TOKEN_CACHE_TTL
+    # seconds at most
+    AUTH_TOKEN_EXPIRATION = int(os.environ.get("AUTH_TOKEN_EXPIRATION", 3600))
+    AUTH_TOKEN_CACHE_SIZE = int(os.environ.get("AUTH_TOKEN_CACHE_SIZE", 4096))
+    AUTH_TOKEN_CACHE_TTL = int(os.environ.get("AUTH_TOKEN_CACHE_TTL", 30))
+
+    # last seen write-behind settings. timestamps are flushed to the database at most
+    # LAST_SEEN_FLUSH_INTERVAL seconds after they are recorded, or as soon as
+    # LAST_SEEN_MAX_PENDING users are waiting to be written
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get("LAST_SEEN_FLUSH_INTERVAL", 60))
+    LAST_SEEN_MAX_PENDING = int(os.environ.get("LAST_SEEN_MAX_PENDING", 500))
+
+    # user loader cache settings, the backend is one of 'memory', 'redis' or None to disable it
+    USER_CACHE_BACKEND = os.environ.get("USER_CACHE_BACKEND", "memory")
+    USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 1024))
+    USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", 300))
+
+    # news sources crawled by celery beat, every source is refreshed each 'interval' seconds, after
+    # a random delay of up to 'jitter' seconds so that the refreshes do not all start at once.
+    # 'limit' is the maximum number of articles kept per source. Articles are found on the source's
+    # 'categories' pages, or on its home page if there are none, and in its RSS or Atom 'feeds'
+    NEWS_SOURCES = {
+        "investopedia": dict(url="http://www.investopedia.com/", interval=900, jitter=60, limit=50),
+    }
+    # number of articles on a page of the blog feed, clients can ask for up to BLOG_MAX_PAGE_SIZE
+    BLOG_PAGE_SIZE = 20
+    BLOG_MAX_PAGE_SIZE = 100
+
+    # news crawler settings, at most NEWS_CRAWLER_WORKERS pages are fetched at the same time and at
+    # most NEWS_CRAWLER_PER_HOST of them from the same host
+    NEWS_CRAWLER_WORKERS = int(os.environ.get("NEWS_CRAWLER_WORKERS", 16))
+    NEWS_CRAWLER_PER_HOST = int(os.environ.get("NEWS_CRAWLER_PER_HOST", 4))
+    NEWS_CRAWLER_TIMEOUT = int(os.environ.get("NEWS_CRAWLER_TIMEOUT", 10))
+    # whether a request finding no cached news for a source starts a crawl of that source, beat
+    # normally keeps the cache warm so the blog view only reads from it
+    NEWS_REFRESH_ON_MISS = os.environ.get("NEWS_REFRESH_ON_MISS", "true").lower() == "true"
+
+    # whether the crawler and its parsers are only imported when a crawl runs, in the celery workers,
+    # instead of by every process that creates the application
+    LAZY_IMPORTS = os.environ.get("LAZY_IMPORTS", "true").lower() == "true"
+
+    # news cache settings, cached news are served fresh for NEWS_CACHE_TTL seconds and then stale
+    # until NEWS_CACHE_STALE_TTL seconds have passed. NEWS_CACHE_LOCK_TIMEOUT has to cover the
+    # jitter and the duration of a crawl
+    NEWS_CACHE_TTL = int(os.environ.get("NEWS_CACHE_TTL", 900))
+    NEWS_CACHE_STALE_TTL = int(os.environ.get("NEWS_CACHE_STALE_TTL", 3600))
+    NEWS_CACHE_LOCK_TIMEOUT = int(os.environ.get("NEWS_CACHE_LOCK_TIMEOUT", 300))
+
+    # task progress settings, the last progress event of a task is kept for TASK_PROGRESS_TTL
+    # seconds. Progress streams send a keep-alive every TASK_STREAM_HEARTBEAT seconds and are closed
+    # after TASK_STREAM_TIMEOUT seconds, when the client reconnects. Each open stream holds a redis
+    # connection and a worker thread, see gunicorn_config.py
+    TASK_PROGRESS_TTL = int(os.environ.get("TASK_PROGRESS_TTL", 3600))
+    TASK_STREAM_HEARTBEAT = int(os.environ.get("TASK_STREAM_HEARTBEAT", 15))
+    TASK_STREAM_TIMEOUT = int(os.environ.get("TASK_STREAM_TIMEOUT", 60))
+
+    # task ledger settings, every celery task is recorded while TASK_LEDGER_ENABLED is set and the
+    # entries are compacted into daily totals after TASK_LEDGER_RETENTION_DAYS days
+    TASK_LEDGER_ENABLED = os.environ.get("TASK_LEDGER_ENABLED", "true").lower() == "true"
+    TASK_LEDGER_RETENTION_DAYS = int(os.environ.get("TASK_LEDGER_RETENTION_DAYS", 30))
+
     # task configurations
     CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_URL")
     CELERY_RESULT_BACKEND = os.environ.get("CELERY_RESULT_BACKEND")
@@ -52,6 +151,76 @@ class Config(object):
     REDIS_SERVER = os.environ.get("REDIS_SERVER")
     REDIS_PORT = os.environ.get("REDIS_PORT")
     REDIS_DB = os.environ.get("REDIS_DB")
+    REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 50))
+
+    # http cache settings, successful GET responses get an ETag while HTTP_CACHE_ETAGS is set. The
+    # responses of views decorated with cached_response are kept in HTTP_CACHE_BACKEND, 'memory',
+    # an LRU of HTTP_CACHE_SIZE responses per process, 'redis' or None to not keep them
+    HTTP_CACHE_ETAGS = os.environ.get("HTTP_CACHE_ETAGS", "true").lower() == "true"
+    HTTP_CACHE_BACKEND = os.environ.get("HTTP_CACHE_BACKEND", "memory") or None
+    HTTP_CACHE_SIZE = int(os.environ.get("HTTP_CACHE_SIZE", 1024))
+    # seconds the API information and the pages of the blog feed may be cached
+    HOME_CACHE_TTL = int(os.environ.get("HOME_CACHE_TTL", 3600))
+    BLOG_CACHE_TTL = int(os.environ.get("BLOG_CACHE_TTL", 60))
+
+    # rate limits of the authentication endpoints, token buckets in redis keyed by the client's IP
+    # address ('ip'), the email of the request ('email') or the endpoint ('route'). Each limit is a
+    # list of (key, capacity, period) buckets, a bucket allows bursts of capacity requests and
+    # refills in period seconds
+    RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "true").lower() == "true"
+    RATE_LIMIT_KEY_PREFIX = "rate-limit:"
+    RATE_LIMITS = {
+        "login": [("ip", 20, 60), ("email", 5, 300)],
+        "register": [("ip", 5, 3600)],
+        "reset_password": [("ip", 5, 3600), ("email", 3, 3600)],
+    }
+
+    # query statistics, every query is timed and fingerprinted by endpoint, queries slower than
+    # QUERY_SLOW_THRESHOLD seconds are logged and a fingerprint executed QUERY_N_PLUS_ONE_THRESHOLD
+    # times by one request is reported as an N+1. The statistics are added to QUERY_STATS_BACKEND,
+    # 'memory' or 'redis', every QUERY_STATS_FLUSH_INTERVAL seconds, in slots of QUERY_STATS_SLOT
+    # seconds, and the report covers the last QUERY_STATS_WINDOW seconds
+    QUERY_STATS_ENABLED = os.environ.get("QUERY_STATS_ENABLED", "true").lower() == "true"
+    QUERY_STATS_BACKEND = os.environ.get("QUERY_STATS_BACKEND", "memory")
+    QUERY_SLOW_THRESHOLD = float(os.environ.get("QUERY_SLOW_THRESHOLD", 0.5))
+    QUERY_N_PLUS_ONE_THRESHOLD = int(os.environ.get("QUERY_N_PLUS_ONE_THRESHOLD", 10))
+    QUERY_STATS_TOP = int(os.environ.get("QUERY_STATS_TOP", 20))
+    QUERY_STATS_FLUSH_INTERVAL = int(os.environ.get("QUERY_STATS_FLUSH_INTERVAL", 10))
+    QUERY_STATS_SLOT = int(os.environ.get("QUERY_STATS_SLOT", 3600))
+    QUERY_STATS_WINDOW = int(os.environ.get("QUERY_STATS_WINDOW", 86400))
+    # responses carry their number of queries and database time in X-Query-Count and X-Query-Time
+    QUERY_STATS_HEADERS = os.environ.get("QUERY_STATS_HEADERS", "false").lower() == "true"
+
+    # prometheus metrics of the requests, the database pool, the celery tasks and the caches,
+    # exposed on METRICS_PATH. Under gunicorn PROMETHEUS_MULTIPROC_DIR must be set to a directory
+    # shared by the workers, see gunicorn_config.py
+    METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+    METRICS_PATH = os.environ.get("METRICS_PATH", "/metrics")
+    # the celery worker serves the metrics of its tasks on a port of its own, see celery_worker.py
+    CELERY_METRICS_PORT = int(os.environ.get("CELERY_METRICS_PORT", 9540))
+
+    # sampling profiler, while a session runs the stacks of the sampled requests are sampled every
+    # PROFILER_INTERVAL seconds and written by endpoint to PROFILER_OUTPUT_DIR. PROFILER_SIGNAL
+    # starts a session of PROFILER_SIGNAL_SECONDS seconds sampling PROFILER_SIGNAL_RATE of the
+    # requests in the worker it is sent to, gunicorn handles SIGUSR1 and SIGUSR2 itself
+    PROFILER_INTERVAL = float(os.environ.get("PROFILER_INTERVAL", 0.01))
+    PROFILER_OUTPUT_DIR = os.environ.get("PROFILER_OUTPUT_DIR", os.path.join(basedir, "profiles"))
+    PROFILER_SIGNAL = os.environ.get("PROFILER_SIGNAL", "SIGURG") or None
+    PROFILER_SIGNAL_SECONDS = int(os.environ.get("PROFILER_SIGNAL_SECONDS", 30))
+    PROFILER_SIGNAL_RATE = float(os.environ.get("PROFILER_SIGNAL_RATE", 1.0))
+
+    # sessions are kept in signed cookies ('cookie') or server side in redis ('redis')
+    SESSION_TYPE = os.environ.get("SESSION_TYPE", "cookie")
+    SESSION_KEY_PREFIX = "session:"
+
+    # template settings, at most JINJA_CACHE_SIZE compiled templates are kept per process and
+    # their bytecode is kept across processes in JINJA_BYTECODE_CACHE, one of 'filesystem', in
+    # JINJA_BYTECODE_CACHE_DIR, 'redis' or None to compile the templates in every process
+    JINJA_CACHE_SIZE = int(os.environ.get("JINJA_CACHE_SIZE", 400))
+    JINJA_BYTECODE_CACHE = os.environ.get("JINJA_BYTECODE_CACHE", "filesystem") or None
+    JINJA_BYTECODE_CACHE_DIR = os.environ.get("JINJA_BYTECODE_CACHE_DIR",
+                                              os.path.join(basedir, ".jinja_cache"))
+    JINJA_BYTECODE_CACHE_TTL = int(os.environ.get("JINJA_BYTECODE_CACHE_TTL", 0)) or None
 
     ROOT_DIR = APP_ROOT
     WTF_CSRF_ENABLED = True
@@ -71,6 +240,19 @@ class Config(object):
     MAIL_SENDER = 'Arco Admin <arcoadmin@arco.com>'
     MAIL_DEFAULT_SENDER = os.environ.get("MAIL_DEFAULT_SENDER")
 
+    # mail outbox settings, queued emails are sent MAIL_OUTBOX_BATCH_SIZE at a time over one SMTP
+    # connection, at most MAIL_OUTBOX_RATE per second. Refused emails are retried with a backoff
+    # starting at MAIL_OUTBOX_RETRY_DELAY seconds, MAIL_OUTBOX_MAX_ATTEMPTS times
+    MAIL_OUTBOX_BATCH_SIZE = int(os.environ.get("MAIL_OUTBOX_BATCH_SIZE", 100))
+    MAIL_OUTBOX_RATE = float(os.environ.get("MAIL_OUTBOX_RATE", 10))
+    MAIL_OUTBOX_MAX_ATTEMPTS = int(os.environ.get("MAIL_OUTBOX_MAX_ATTEMPTS", 5))
+    MAIL_OUTBOX_RETRY_DELAY = int(os.environ.get("MAIL_OUTBOX_RETRY_DELAY", 30))
+    MAIL_OUTBOX_MAX_RETRY_DELAY = int(os.environ.get("MAIL_OUTBOX_MAX_RETRY_DELAY", 3600))
+    MAIL_OUTBOX_DRAIN_SECONDS = int(os.environ.get("MAIL_OUTBOX_DRAIN_SECONDS", 240))
+    MAIL_OUTBOX_LOCK_TIMEOUT = int(os.environ.get("MAIL_OUTBOX_LOCK_TIMEOUT", 300))
+    # base of the urls in emails rendered outside of a request, e.g. by the outbox's drain task
+    MAIL_BASE_URL = os.environ.get("MAIL_BASE_URL", "http://localhost")
+
     # # credentials for external service accounts
     # OAUTH_CREDENTIALS = {
     #     "facebook": {
@@ -94,6 +276,10 @@ class DevelopmentConfig(Config):
 
     DEBUG = True
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
+    QUERY_STATS_HEADERS = True
+    # the development server handles a request at a time
+    SQLALCHEMY_POOL_SIZE = int(os.environ.get("SQLALCHEMY_POOL_SIZE", 2))
+    SQLALCHEMY_MAX_OVERFLOW = int(os.environ.get("SQLALCHEMY_MAX_OVERFLOW", 2))
 
 
 class TestingConfig(Config):
@@ -107,6 +293,17 @@ class TestingConfig(Config):
     WTF_CSRF_ENABLED = False
     CSRF_ENABLED = False
     PRESERVE_CONTEXT_ON_EXCEPTION = False
+    LAST_SEEN_FLUSH_INTERVAL = 0
+    JINJA_BYTECODE_CACHE = None
+    HTTP_CACHE_BACKEND = None
+    RATE_LIMIT_ENABLED = False
+    METRICS_ENABLED = False
+    PROFILER_SIGNAL = None
+    QUERY_STATS_FLUSH_INTERVAL = 0
+    DATABASE_REPLICA_URIS = []
+    QUERY_STATS_HEADERS = True
+    PASSWORD_HASH_ITERATIONS = 1000
+    PASSWORD_HASH_POOL_SIZE = 0
 
 
 class ProductionConfig(Config):
@@ -116,6 +313,20 @@ class ProductionConfig(Config):
 
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
     ADMINS = [os.environ.get("ADMIN_EMAIL_1")]
+    SESSION_TYPE = os.environ.get("SESSION_TYPE", "redis")
+    NEWS_REFRESH_ON_MISS = os.environ.get("NEWS_REFRESH_ON_MISS", "false").lower() == "true"
+    HTTP_CACHE_BACKEND = os.environ.get("HTTP_CACHE_BACKEND", "redis") or None
+    QUERY_STATS_BACKEND = os.environ.get("QUERY_STATS_BACKEND", "redis")
+    # the user cache of one worker would not see the changes made by the others
+    USER_CACHE_BACKEND = os.environ.get("USER_CACHE_BACKEND", "redis") or None
+    # each of the GUNICORN_THREADS threads of a gunicorn worker, see gunicorn_config.py, needs a
+    # connection, the overflow covers the background threads of the worker, e.g. the last seen
+    # flusher. Statements are cancelled well before the workers' timeout
+    SQLALCHEMY_POOL_SIZE = int(os.environ.get("SQLALCHEMY_POOL_SIZE",
+                                              os.environ.get("GUNICORN_THREADS", 4)))
+    SQLALCHEMY_MAX_OVERFLOW = int(os.environ.get("SQLALCHEMY_MAX_OVERFLOW", 2))
+    SQLALCHEMY_POOL_TIMEOUT = int(os.environ.get("SQLALCHEMY_POOL_TIMEOUT", 5))
+    DATABASE_STATEMENT_TIMEOUT = int(os.environ.get("DATABASE_STATEMENT_TIMEOUT", 15000))
 
     @classmethod
     def init_app(cls, app):
@@ -143,6 +354,12 @@ class ProductionConfig(Config):
 
 class HerokuConfig(ProductionConfig):
     SSL_DISABLE = bool(os.environ.get('SSL_DISABLE'))
+    # small Heroku Postgres plans allow 20 connections for all the dynos and their workers, and
+    # idle connections are closed by the router after 5 minutes. Only 2 connections are kept, the
+    # overflow still gives one to each of the 4 threads of a worker under load
+    SQLALCHEMY_POOL_SIZE = int(os.environ.get("SQLALCHEMY_POOL_SIZE", 2))
+    SQLALCHEMY_MAX_OVERFLOW = int(os.environ.get("SQLALCHEMY_MAX_OVERFLOW", 2))
+    SQLALCHEMY_POOL_RECYCLE = int(os.environ.get("SQLALCHEMY_POOL_RECYCLE", 240))
 
     @classmethod
     def init_app(cls, app):
@@ -0,0 +1,41 @@
+"""
+Gunicorn configuration
+
+Every worker handles GUNICORN_THREADS requests at a time in threads. Task progress streams stay
+open for up to TASK_STREAM_TIMEOUT seconds, a sync worker would be held by a single stream and be
+killed by the master after `timeout` seconds, while a threaded worker keeps notifying the master
+and only gives a thread to each stream. The database pool of ProductionConfig keeps a connection
+for each of the GUNICORN_THREADS threads, see config.py.
+
+The workers share PROMETHEUS_MULTIPROC_DIR, where each of them writes its metrics, so that the
+metrics endpoint reports those of all the workers, see app.metrics. The directory is emptied when
+the master starts, samples of a previous run would be added to the new ones, and the live gauges of
+a worker are dropped when it exits.
+
+:usage:
+$ gunicorn -c gunicorn_config.py manage:app
+"""
+import os
+import shutil
+import tempfile
+
+multiprocess_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR") or \
+    os.environ.get("prometheus_multiproc_dir") or \
+    os.path.join(tempfile.gettempdir(), "croesus-metrics")
+# prometheus_client reads the directory when it is imported, i.e. by the workers
+os.environ["PROMETHEUS_MULTIPROC_DIR"] = os.environ["prometheus_multiproc_dir"] = multiprocess_dir
+
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+
+
+def on_starting(server):
+    shutil.rmtree(multiprocess_dir, ignore_errors=True)
+    os.makedirs(multiprocess_dir)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
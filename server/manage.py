@@ -1,9 +1,11 @@
 import os
+import time
 import better_exceptions
 from flask_migrate import Migrate, MigrateCommand, upgrade
 from flask_script import Manager, Shell, Server
 from setup_environment import setup_environment_variables
 from app import create_app, db, logger
+from app.mod_auth.models import UserAccountStatus, AsyncOperationStatus
 import alembic
 import alembic.config
 import faulthandler
@@ -82,20 +84,43 @@ def test(cover=False):
         cov.erase()
 
 
-@manager.command
-def profile(length=25, profile_dir=None):
+@manager.option("-s", "--seconds", type=float, default=3600, help="duration of the session")
+@manager.option("-r", "--rate", type=float, default=1.0, help="share of the requests sampled")
+@manager.option("-d", "--profile-dir", dest="profile_dir", default=None,
+                help="directory of the collapsed stacks, defaults to PROFILER_OUTPUT_DIR")
+def profile(seconds, rate, profile_dir):
     """
-    This module provides a simple WSGI profiler middleware for finding 
-    bottlenecks in web application. It uses the profile or cProfile 
-    module to do the profiling and writes the stats to the stream provided
-    
-    see: http://werkzeug.pocoo.org/docs/0.9/contrib/profiler/
+    Runs the development server with a sampling profiler session, the stacks of every endpoint
+    are written in the collapsed stack format when the session ends or the server stops. On
+    gunicorn, send PROFILER_SIGNAL to a worker or use the admin endpoint instead, see
+    app.sampling_profiler
     """
-    from werkzeug.contrib.profiler import ProfilerMiddleware
+    from app.sampling_profiler import sampling_profiler
+
+    if profile_dir:
+        sampling_profiler.output_dir = profile_dir
+    sampling_profiler.start(seconds=seconds, rate=rate)
+    try:
+        app.run()
+    finally:
+        session = sampling_profiler.stop()
+        for path in session["files"]:
+            print("Wrote {}".format(path))
+
+
+@manager.option("-n", "--count", type=int, default=2000, help="number of requests of each run")
+@manager.option("-i", "--interval", type=float, default=None,
+                help="seconds between samples, defaults to PROFILER_INTERVAL")
+def benchmark_profiler(count, interval):
+    """measure the requests per second of the api index without and with a profiling session"""
+    from app.sampling_profiler import benchmark
 
-    app.config["PROFILE"] = True
-    app.wsgi_app = ProfilerMiddleware(app.wsgi_app, restrictions=[length], profile_dir=profile_dir)
-    app.run()
+    results = benchmark(app, "/home", count, interval or app.config["PROFILER_INTERVAL"])
+    print("{:<16} {:>14} {:>9}".format("run", "requests/s", "samples"))
+    for result in results:
+        print("{name:<16} {requests_per_second:>14.1f} {samples:>9}".format(**result))
+    print("overhead {:.1%}".format(1 - results[1]["requests_per_second"] /
+                                   results[0]["requests_per_second"]))
 
 
 @manager.option('-m', '--migration', help='create database from migrations',
@@ -114,8 +139,12 @@ def init_db(migration):
         db.session.commit()
         cfg = alembic.config.Config("app/migrations/alembic.ini")
         alembic.command.stamp(cfg, "head")
-        # todo: add default roles
-        # Role.add_default_roles()
+
+    # add the default lookup rows
+    UserAccountStatus.seed_defaults()
+    AsyncOperationStatus.seed_defaults()
+    # todo: add default roles
+    # Role.add_default_roles()
 
 
 # @manager.option('-e', '--email', help='email address', required=True)
@@ -146,6 +175,167 @@ def init_db(migration):
 #         print("User not found")
 
 
+@manager.option("-f", "--file", dest="path", help="CSV or JSON lines file of users", required=True)
+@manager.option("-c", "--chunk-size", dest="chunk_size", type=int, default=1000,
+                help="number of users inserted per transaction")
+@manager.option("-w", "--workers", type=int, default=None,
+                help="number of processes hashing passwords, defaults to the number of cores")
+@manager.option("-r", "--resume", action="store_true", default=False,
+                help="resume from the last committed chunk")
+@manager.option("--confirmed", action="store_true", default=False,
+                help="mark the imported users as having confirmed their email")
+@manager.option("--no-copy", dest="no_copy", action="store_true", default=False,
+                help="use executemany inserts even on PostgreSQL")
+def import_users(path, chunk_size, workers, resume, confirmed, no_copy):
+    """bulk import users from a CSV or JSON lines file"""
+    from app.mod_auth.importer import UserImporter
+
+    importer = UserImporter(path, chunk_size=chunk_size, workers=workers, use_copy=not no_copy,
+                            confirmed=confirmed)
+    report = importer.run(resume=resume)
+    print(report)
+
+
+@manager.option("-i", "--iterations", default="50000,100000,150000,260000",
+                help="comma separated pbkdf2 iteration counts to measure")
+@manager.option("-d", "--duration", type=float, default=2.0, help="seconds spent on each cost")
+def benchmark_hashing(iterations, duration):
+    """measure logins per second per core at each password hashing cost"""
+    from app.mod_auth.hashing import benchmark
+
+    print("{:<30} {:>12} {:>16}".format("method", "ms/login", "logins/s/core"))
+    for result in benchmark([int(cost) for cost in iterations.split(",")], duration,
+                            method=app.config.get("PASSWORD_HASH_METHOD", "pbkdf2:sha256")):
+        print("{method:<30} {milliseconds:>12.2f} {logins_per_second:>16.1f}".format(**result))
+
+
+@manager.option("-n", "--count", type=int, default=10000, help="number of tokens to create")
+def benchmark_tokens(count):
+    """measure tokens per second with a serializer per call and with the token service"""
+    from app.mod_auth.tokens import benchmark
+
+    print("{:<40} {:>14}".format("method", "tokens/s"))
+    for result in benchmark(app.config["SECRET_KEY"], app.config["SECURITY_PASSWORD_SALT"],
+                            count):
+        print("{name:<40} {tokens_per_second:>14.1f}".format(**result))
+
+
+@manager.option("-w", "--workers", default="1,4,16", help="comma separated numbers of workers")
+@manager.option("-d", "--delay", type=float, default=0.02,
+                help="seconds every response of the fixture server is delayed by")
+def benchmark_crawler(workers, delay):
+    """measure articles crawled per second against a local fixture news site"""
+    from app.mod_blog.crawler_benchmark import benchmark
+
+    print("{:>8} {:<12} {:>9} {:>9} {:>9} {:>12}".format("workers", "run", "articles",
+                                                         "requests", "304s", "articles/s"))
+    for result in benchmark([int(count) for count in workers.split(",")], delay=delay):
+        print("{workers:>8} {run:<12} {articles:>9} {requests:>9} {not_modified:>9} "
+              "{articles_per_second:>12.1f}".format(**result))
+
+
+@manager.option("-n", "--count", type=int, default=10000, help="number of emails to render")
+def benchmark_email_templates(count):
+    """measure confirmation emails rendered per second with render_template and precompiled"""
+    from app.email_templates import benchmark
+
+    print("{:<40} {:>14}".format("method", "emails/s"))
+    for result in benchmark("auth.confirm_email.html", count, confirm_url="http://localhost/auth/confirm/"):
+        print("{name:<40} {emails_per_second:>14.1f}".format(**result))
+
+
+@manager.option("-u", "--users", type=int, default=50, help="number of users logging in")
+@manager.option("-a", "--attack-ratio", dest="attack_ratio", type=int, default=20,
+                help="attempts of the attacker per login")
+def benchmark_rate_limit(users, attack_ratio):
+    """measure logins served per second under a credential stuffing attack with and without the
+    rate limiter"""
+    from app import redis_db
+    from app.mod_auth.rate_limit_benchmark import benchmark
+
+    print("{:<14} {:>9} {:>9} {:>9} {:>7} {:>10} {:>10}".format(
+        "run", "requests", "429s", "checks", "logins", "requests/s", "logins/s"))
+    for result in benchmark(redis_db.get_client(app), app.config["PASSWORD_HASH_ITERATIONS"],
+                            users, attack_ratio):
+        print("{:<14} {requests:>9} {refused:>9} {password_checks:>9} {logins:>7} "
+              "{requests_per_second:>10.1f} {logins_per_second:>10.1f}".format(
+                "rate limited" if result["limited"] else "unprotected", **result))
+
+
+@manager.command
+def compile_templates():
+    """compile every template into the jinja bytecode cache, e.g. while building an image"""
+    from app.template_cache import compile_templates
+
+    if app.jinja_env.bytecode_cache is None:
+        print("No JINJA_BYTECODE_CACHE configured, templates are compiled in every process")
+        return
+
+    started = time.perf_counter()
+    compiled, failed = compile_templates(app)
+    print("Compiled {} templates in {:.2f}s".format(len(compiled), time.perf_counter() - started))
+    for name, error in failed:
+        print("Failed to compile {}: {}".format(name, error))
+
+
+@manager.option("-c", "--config", dest="config_name", default=None,
+                help="configuration to start with, defaults to FLASK_CONFIG")
+def startup_profile(config_name):
+    """time the imports, extensions and blueprints of the application's startup"""
+    from app.startup import profile_startup
+
+    steps = profile_startup(config_name or os.getenv("FLASK_CONFIG") or "default",
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    print("{:<10} {:<24} {:>10} {:>9}".format("kind", "name", "ms", "modules"))
+    for step in steps:
+        milliseconds = "" if step["seconds"] is None else "{:.1f}".format(step["seconds"] * 1000)
+        print("{kind:<10} {name:<24} {:>10} {modules:>9}".format(milliseconds, **step))
+
+
+@manager.option("-t", "--top", type=int, default=None,
+                help="number of slow queries, defaults to QUERY_STATS_TOP")
+def query_report(top):
+    """print the endpoints by database time and the slowest queries of the statistics window"""
+    from app.query_stats import query_stats
+
+    if app.config.get("QUERY_STATS_BACKEND") != "redis":
+        print("QUERY_STATS_BACKEND is not 'redis', only this process' queries are reported")
+    with app.app_context():
+        report = query_stats.report(top=top)
+
+    print("{:<36} {:>9} {:>9} {:>12} {:>10} {:>5}".format(
+        "endpoint", "requests", "queries", "queries/req", "ms/req", "n+1"))
+    for stats in report["endpoints"]:
+        print("{endpoint:<36} {requests:>9} {queries:>9} {queries_per_request:>12.1f} "
+              "{milliseconds_per_request:>10.1f} {n_plus_one:>5}".format(**stats))
+
+    print("\n{:>10} {:>10} {:>7}  {}".format("max ms", "avg ms", "count", "query"))
+    for stats in report["slow"]:
+        print("{:>10.1f} {:>10.1f} {count:>7}  {statement} ({endpoint})".format(
+            stats["max_seconds"] * 1000, stats["average_seconds"] * 1000, **stats))
+
+
+@manager.option("-u", "--url", default=None,
+                help="database URL, defaults to a temporary SQLite file")
+@manager.option("-t", "--threads", type=int, default=20, help="number of concurrent requests")
+@manager.option("-n", "--requests", type=int, default=400, help="number of requests of each run")
+@manager.option("-H", "--hold", type=float, default=0.01,
+                help="seconds every request holds its connection")
+def benchmark_pool(url, threads, requests, hold):
+    """measure requests per second and checkout waits of the pool with different settings"""
+    import tempfile
+    from app.database import benchmark
+
+    with tempfile.TemporaryDirectory() as directory:
+        url = url or "sqlite:///{}".format(os.path.join(directory, "pool.db"))
+        print("{:<28} {:>10} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+            "settings", "requests/s", "wait ms", "p99 ms", "timeouts", "connects", "failures"))
+        for result in benchmark(url, threads, requests, hold):
+            print("{name:<28} {requests_per_second:>10.1f} {wait_milliseconds:>9.2f} "
+                  "{p99_wait_milliseconds:>9.2f} {timeouts:>9} {connects:>9} "
+                  "{failures:>9}".format(**result))
+
+
 @manager.command
 def drop_db():
     """drop all databases, instantiate schemas"""
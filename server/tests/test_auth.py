@@ -5,11 +5,12 @@ from flask_login import current_user
 from unittest.mock import patch
 
 from app import db
-from app.mod_auth.models import UserAccount
+from app.mod_auth.models import UserAccount, UserAccountStatus, UserProfile
+from app.mod_auth.last_seen import last_seen_tracker
+from sqlalchemy import event
 from app.mod_auth.security import generate_confirmation_token, confirm_token
 from tests import BaseTestCase
 import json
-from app.mod_auth.security import send_mail_async
 
 
 class TestRegistration(BaseTestCase):
@@ -28,14 +29,102 @@ class TestRegistration(BaseTestCase):
         self.assertIsInstance(data, dict)
         self.assertEqual(len(data), 0)
 
-    @patch("app.mod_auth.security.send_mail_async")
-    def test_post_request_returns_200(self, send_email_async):
+    @patch("app.mod_auth.views.queue_mail")
+    def test_post_request_returns_200(self, queue_mail):
         """Test post request to register route returns 200"""
         response = self.client.post("auth/register", data=dict(email="croesus@example.com",
                                     first_name="Croesus", last_name="Inc",
                                     username="croesus", password="croesus_password"))
         self.assert200(response)
 
+    @patch("app.mod_auth.views.queue_mail")
+    def test_registering_existing_user_fails(self, queue_mail):
+        """Test registering an email that already exists returns an error and no new rows"""
+        data = dict(email="croesus@example.com", first_name="Croesus", last_name="Inc",
+                    username="croesus", password="croesus_password")
+        self.client.post("auth/register", data=data)
+        response = self.client.post("auth/register", data=data)
+
+        self.assertEqual(json.loads(response.get_data(as_text=True))["message"],
+                         "User already exists")
+        self.assertEqual(UserAccount.query.filter_by(email="croesus@example.com").count(), 1)
+        self.assertEqual(queue_mail.call_count, 1)
+
+    @patch("app.mod_auth.views.queue_mail")
+    def test_registering_without_required_fields_fails(self, queue_mail):
+        """Test a registration missing a required field is a plain 400, not an existing user"""
+        response = self.client.post("auth/register", data=dict(
+            email="croesus@example.com", username="croesus", password="croesus_password"))
+
+        self.assert400(response)
+        self.assertEqual(response.json["fields"], ["first_name", "last_name"])
+        self.assertEqual(UserAccount.query.filter_by(email="croesus@example.com").count(), 0)
+        self.assertFalse(queue_mail.called)
+
+    @patch("app.mod_auth.views.queue_mail")
+    def test_registrations_reuse_account_status(self, queue_mail):
+        """Test new registrations share the EMAIL_NON_CONFIRMED account status row"""
+        for name in ("croesus", "midas"):
+            self.client.post("auth/register", data=dict(
+                email="{}@example.com".format(name), first_name=name, last_name="Inc",
+                username=name, password="{}_password".format(name)))
+
+        self.assertEqual(UserAccountStatus.query.count(), 1)
+        statuses = {user.user_account_status_id for user in UserAccount.query.all()}
+        self.assertEqual(len(statuses), 1)
+
+    @patch("app.mod_auth.views.queue_mail")
+    def test_registration_token_confirms_email(self, queue_mail):
+        """Test the token stored for a new user is accepted by the confirmation flow"""
+        self.client.post("auth/register", data=dict(
+            email="croesus@example.com", first_name="Croesus", last_name="Inc",
+            username="croesus", password="croesus_password"))
+
+        user = UserAccount.query.filter_by(email="croesus@example.com").first()
+        self.assertEqual(confirm_token(user.email_confirmation_token), "croesus@example.com")
+
+
+class TestTokenAuthentication(BaseTestCase):
+    """
+    Tests for stateless bearer token authentication
+    """
+
+    def setUp(self):
+        super(TestTokenAuthentication, self).setUp()
+        profile = UserProfile.query.filter_by(email="test1hadithi@hadithi.com").first()
+        user = UserAccount(email=profile.email, username="test1", password="password",
+                           user_profile_id=profile.id)
+        db.session.add(user)
+        db.session.commit()
+        self.token = user.generate_auth_token(3600)
+
+        # keep last seen timestamps buffered, so that only the request itself is measured
+        last_seen_tracker.flush_interval = 3600
+
+    def test_bearer_token_authenticates_without_database_or_session(self):
+        """Test a request with a valid bearer token runs without queries or a session cookie"""
+        statements = []
+
+        def count_statement(*args):
+            statements.append(args)
+
+        event.listen(db.engine, "before_cursor_execute", count_statement)
+        try:
+            response = self.client.get("auth/logout",
+                                       headers={"Authorization": "Bearer " + self.token})
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count_statement)
+
+        self.assert200(response)
+        self.assertEqual(statements, [])
+        self.assertNotIn("Set-Cookie", response.headers)
+
+    def test_invalid_bearer_token_is_rejected(self):
+        """Test a request with an invalid bearer token is not authenticated"""
+        response = self.client.get("auth/logout",
+                                   headers={"Authorization": "Bearer " + self.token + "x"})
+        self.assertNotEqual(response.status_code, 200)
+
 
 @unittest.skip
 class TestAuthentication(BaseTestCase):
@@ -0,0 +1,186 @@
+import time
+import unittest
+from datetime import datetime
+from unittest.mock import patch
+
+import fakeredis
+
+from app import db, redis_db
+from app.mod_blog.blog_tasks import news_refresh_schedule, refresh_news_source, fetch_news
+from app.mod_blog.crawler import url_hash
+from app.mod_blog.models import Article
+from app.mod_blog.news_cache import news_cache
+from tests import BaseTestCase
+
+
+def article(url, published_at):
+    return dict(url=url, url_hash=url_hash(url), title=url, published_at=published_at)
+
+
+class NewsCacheTestCases(BaseTestCase):
+    """
+    Tests for the news cache and the top news view
+    """
+
+    def setUp(self):
+        super(NewsCacheTestCases, self).setUp()
+        client = fakeredis.FakeStrictRedis()
+        client.flushall()
+        redis_db.init_app(self.app, client=client)
+        self.app.config["NEWS_SOURCES"] = {
+            "markets": dict(url="http://markets.example.com", interval=600, jitter=30, limit=10),
+            "economy": dict(url="http://economy.example.com", interval=1800, jitter=0),
+        }
+        self.app.config["NEWS_REFRESH_ON_MISS"] = True
+
+    @patch("app.mod_blog.views.fetch_news.apply_async")
+    def test_cold_cache_dispatches_a_single_fetch_per_source(self, apply_async):
+        """Test concurrent requests on an empty cache share one fetch task per source"""
+        first = self.client.get("/blog/")
+        second = self.client.get("/blog/")
+
+        self.assertEqual(first.status_code, 202)
+        self.assertEqual(apply_async.call_count, 2)
+        self.assertEqual(first.json["tasks"], second.json["tasks"])
+        self.assertEqual(set(first.json["tasks"]), {"markets", "economy"})
+
+    @patch("app.mod_blog.views.fetch_news.apply_async")
+    def test_view_only_reads_when_refresh_on_miss_is_off(self, apply_async):
+        """Test the view never dispatches a crawl if NEWS_REFRESH_ON_MISS is off"""
+        self.app.config["NEWS_REFRESH_ON_MISS"] = False
+
+        response = self.client.get("/blog/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["items"], [])
+        apply_async.assert_not_called()
+
+    @patch("app.mod_blog.views.fetch_news.apply_async")
+    def test_stale_sources_are_reported(self, apply_async):
+        """Test the freshness of every crawled source is returned, refreshing is left to beat"""
+        news_cache.set("markets", [])
+        news_cache.set("economy", [])
+
+        with patch("app.mod_blog.news_cache.time.time", return_value=time.time() + news_cache.ttl):
+            response = self.client.get("/blog/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json["sources"]["markets"]["stale"])
+        apply_async.assert_not_called()
+
+    def test_schedule_has_an_entry_per_source(self):
+        """Test celery beat refreshes every source at its configured interval"""
+        schedule = news_refresh_schedule(self.app.config["NEWS_SOURCES"])
+
+        self.assertEqual(schedule["refresh-news-markets"]["schedule"], 600)
+        self.assertEqual(schedule["refresh-news-economy"]["args"], ("economy",))
+        self.assertEqual(schedule["refresh-news-markets"]["task"], refresh_news_source.name)
+
+    @patch("app.mod_blog.blog_tasks.fetch_news.apply_async")
+    def test_refresh_is_jittered_and_coalesced(self, apply_async):
+        """Test beat refreshes are delayed by up to the source's jitter and not duplicated"""
+        with patch("app.mod_blog.blog_tasks.random.uniform", return_value=12.5) as uniform:
+            task_id = refresh_news_source("markets")
+            self.assertEqual(refresh_news_source("markets"), task_id)
+
+        uniform.assert_called_with(0, 30)
+        self.assertEqual(apply_async.call_count, 1)
+        self.assertEqual(apply_async.call_args[1]["countdown"], 12.5)
+        self.assertEqual(apply_async.call_args[1]["args"],
+                         ("markets", "http://markets.example.com", 10))
+
+    def test_lock_is_only_released_by_its_holder(self):
+        """Test a task does not release a refresh lock held by another task"""
+        self.assertTrue(news_cache.acquire("markets", "task-1"))
+        self.assertFalse(news_cache.acquire("markets", "task-2"))
+
+        news_cache.release("markets", "task-2")
+        self.assertEqual(news_cache.in_flight("markets"), "task-1")
+
+        news_cache.release("markets", "task-1")
+        self.assertIsNone(news_cache.in_flight("markets"))
+
+    @patch("app.mod_blog.views.fetch_news.apply_async", side_effect=IOError)
+    def test_lock_is_released_if_dispatch_fails(self, apply_async):
+        """Test the refresh lock is released when the fetch task can not be dispatched"""
+        with self.assertRaises(IOError):
+            news_cache.refresh("markets", fetch_news, "markets", "http://markets.example.com")
+        self.assertIsNone(news_cache.in_flight("markets"))
+
+
+class ArticleStoreTestCases(BaseTestCase):
+    """
+    Tests for the article store and the pages of the blog feed
+    """
+
+    def setUp(self):
+        super(ArticleStoreTestCases, self).setUp()
+        client = fakeredis.FakeStrictRedis()
+        client.flushall()
+        redis_db.init_app(self.app, client=client)
+        self.app.config["NEWS_REFRESH_ON_MISS"] = False
+
+        Article.upsert_many("markets", [article("http://m/{}".format(day),
+                                                "2017-05-0{}T10:00:00".format(day))
+                                        for day in range(1, 6)])
+        Article.upsert_many("economy", [article("http://e/1", "2017-05-03T10:00:00")])
+
+    def test_upsert_is_idempotent(self):
+        """Test storing the same articles again updates them instead of adding rows"""
+        updated = dict(article("http://m/1", "2017-05-01T10:00:00"), title="Updated")
+        Article.upsert_many("markets", [updated, updated])
+
+        self.assertEqual(Article.query.count(), 6)
+        self.assertEqual(Article.query.filter_by(url="http://m/1").one().title, "Updated")
+
+    def test_undated_articles_keep_their_position(self):
+        """Test an article without a publication date keeps the date it was first stored with"""
+        Article.upsert_many("markets", [article("http://m/undated", None)])
+        first = Article.query.filter_by(url="http://m/undated").one().published_at
+
+        with patch("app.mod_blog.models.datetime") as mock_datetime:
+            mock_datetime.utcnow.return_value = datetime(2030, 1, 1)
+            mock_datetime.strptime = datetime.strptime
+            Article.upsert_many("markets", [article("http://m/undated", None)])
+
+        db.session.expire_all()
+        self.assertEqual(Article.query.filter_by(url="http://m/undated").one().published_at, first)
+
+    def test_pages_follow_each_other(self):
+        """Test following the cursors returns every article once, newest first"""
+        urls, cursor = [], None
+        while True:
+            query = "/blog/?limit=2" + ("&cursor=" + cursor if cursor else "")
+            response = self.client.get(query)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.json["items"]), 2)
+            urls.extend(item["url"] for item in response.json["items"])
+            cursor = response.json["next_cursor"]
+            if cursor is None:
+                break
+
+        # articles published at the same time are ordered by id, the latest stored first
+        self.assertEqual(urls, ["http://m/5", "http://m/4", "http://e/1", "http://m/3",
+                                "http://m/2", "http://m/1"])
+
+    def test_limit_is_at_least_one(self):
+        """Test a negative limit returns a page of a single article"""
+        response = self.client.get("/blog/?limit=-2")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item["url"] for item in response.json["items"]], ["http://m/5"])
+        self.assertIsNotNone(response.json["next_cursor"])
+
+    def test_pages_can_be_filtered_by_source(self):
+        """Test only the articles of the requested source are returned"""
+        response = self.client.get("/blog/?source=economy")
+        self.assertEqual([item["source"] for item in response.json["items"]], ["economy"])
+
+    def test_invalid_cursor_is_rejected(self):
+        """Test a cursor that was not returned by the feed is answered with a 400"""
+        response = self.client.get("/blog/?cursor=not-a-cursor")
+        self.assertEqual(response.status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+
+from app.mod_blog.crawler import Crawler, normalize_date, parse_article, parse_feed, parse_links
+from app.mod_blog.crawler_benchmark import FixtureServer
+
+
+class CrawlerParsingTestCases(unittest.TestCase):
+    """
+    Tests for the parsing of category pages, feeds and articles
+    """
+
+    def test_only_article_links_on_the_same_host_are_kept(self):
+        """Test links to other hosts, sections and images are not taken for articles"""
+        content = b"""<html><body>
+            <a href="/markets/">Markets</a>
+            <a href="/news/2017/markets-rally#comments">Markets rally</a>
+            <a href="/news/2017/markets-rally">Markets rally</a>
+            <a href="/articles/12345">Article</a>
+            <a href="/img/chart-1.png">Chart</a>
+            <a href="http://other.example.com/news/other-story">Elsewhere</a>
+        </body></html>"""
+
+        links = parse_links("http://news.example.com/markets/", content)
+
+        self.assertEqual(links, ["http://news.example.com/news/2017/markets-rally",
+                                 "http://news.example.com/articles/12345"])
+
+    def test_rss_and_atom_feeds_are_parsed(self):
+        """Test feed entries become articles with normalized dates"""
+        rss = b"""<rss><channel><item><title>Rally</title><link>http://a.example.com/rally</link>
+            <description>Stocks up</description><pubDate>Mon, 01 May 2017 10:00:00 +0200</pubDate>
+            </item></channel></rss>"""
+        atom = b"""<feed xmlns="http://www.w3.org/2005/Atom"><entry><title>Dip</title>
+            <link href="/dip"/><updated>2017-05-02T08:00:00Z</updated>
+            <author><name>Arco</name></author></entry></feed>"""
+
+        rally, = parse_feed("http://a.example.com/feed", rss)
+        dip, = parse_feed("http://a.example.com/atom", atom)
+
+        self.assertEqual((rally["title"], rally["published_at"]), ("Rally", "2017-05-01T08:00:00"))
+        self.assertEqual(dip["url"], "http://a.example.com/dip")
+        self.assertEqual(dip["authors"], ["Arco"])
+
+    def test_article_metadata_is_read_from_meta_tags(self):
+        """Test articles are identified by their canonical url and described by their meta tags"""
+        content = b"""<html><head><title>Fallback</title>
+            <link rel="canonical" href="/news/rally"/>
+            <meta property="og:title" content="Markets rally"/>
+            <meta name="description" content="Stocks are up"/>
+            <meta property="og:image" content="/img/rally.png"/>
+            <meta property="article:published_time" content="2017-05-01T10:00:00Z"/>
+            </head><body><p>Text</p></body></html>"""
+
+        article = parse_article("http://a.example.com/news/rally?utm_source=feed", content)
+
+        self.assertEqual(article["url"], "http://a.example.com/news/rally")
+        self.assertEqual(article["title"], "Markets rally")
+        self.assertEqual(article["summary"], "Stocks are up")
+        self.assertEqual(article["image"], "http://a.example.com/img/rally.png")
+        self.assertEqual(article["published_at"], "2017-05-01T10:00:00")
+
+    def test_unparseable_dates_are_dropped(self):
+        """Test dates in unknown formats are ignored"""
+        self.assertIsNone(normalize_date("yesterday"))
+        self.assertEqual(normalize_date("2017-05-01"), "2017-05-01T00:00:00")
+
+
+class CrawlerTestCases(unittest.TestCase):
+    """
+    Tests for the crawler against the local fixture news site
+    """
+
+    def setUp(self):
+        self.server = FixtureServer(categories=2, articles_per_category=5, feed_items=3).start()
+        self.crawler = Crawler(max_workers=4, per_host=2)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_sources_are_merged_and_deduplicated(self):
+        """Test articles found on several pages and sources are only returned once"""
+        source = self.server.source()
+        articles = self.crawler.crawl({"first": source, "second": dict(source)})
+
+        urls = [article["url"] for article in articles]
+        self.assertEqual(len(urls), len(set(urls)))
+        self.assertEqual(len(urls), 2 * 5 + 3)
+        dates = [article["published_at"] for article in articles]
+        self.assertEqual(dates, sorted(dates, reverse=True))
+
+    def test_limit_is_applied_per_source(self):
+        """Test no more articles than the source's limit are fetched"""
+        articles = self.crawler.crawl({"fixture": self.server.source(limit=4)})
+        self.assertEqual(len(articles), 4)
+
+    def test_unchanged_pages_are_not_downloaded_again(self):
+        """Test a second crawl uses conditional requests and still returns every article"""
+        first = self.crawler.crawl({"fixture": self.server.source()})
+        second = self.crawler.crawl({"fixture": self.server.source()})
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.crawler.stats()["not_modified"], self.crawler.stats()["requests"] / 2)
+
+    def test_unreachable_pages_are_skipped(self):
+        """Test pages that can not be fetched are counted as errors and skipped"""
+        source = dict(self.server.source(), categories=[self.server.url + "/missing"])
+        articles = self.crawler.crawl({"fixture": source})
+
+        self.assertEqual(len(articles), 3)
+        self.assertEqual(self.crawler.stats()["errors"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
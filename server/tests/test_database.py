@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+from app.database import engine_options, pool_stats, load_test, benchmark
+from app.mod_auth.models import UserAccount
+from tests import BaseTestCase
+
+
+class DatabaseTestCases(BaseTestCase):
+    """
+    Tests for the connection pool settings and their load test
+    """
+
+    def setUp(self):
+        super(DatabaseTestCases, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.url = "sqlite:///{}".format(os.path.join(self.directory, "pool.db"))
+        self.config = dict(DATABASE_POOL_PRE_PING=True, DATABASE_STATEMENT_TIMEOUT=15000,
+                           DATABASE_PGBOUNCER=False, DATABASE_CONNECT_OPTIONS={})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        super(DatabaseTestCases, self).tearDown()
+
+    def test_postgres_sessions_get_a_statement_timeout(self):
+        """Test postgres connections are pinged and set a statement timeout when they connect"""
+        options = engine_options(self.config, make_url("postgresql://localhost/croesus"),
+                                 dict(pool_size=5, max_overflow=10))
+
+        self.assertTrue(options["pool_pre_ping"])
+        self.assertEqual(options["connect_args"]["options"], "-c statement_timeout=15000")
+        self.assertEqual(options["pool_size"], 5)
+
+    def test_pgbouncer_sets_the_timeout_per_transaction(self):
+        """Test connections through PgBouncer set the timeout per transaction in a small pool"""
+        self.config["DATABASE_PGBOUNCER"] = True
+        options = engine_options(self.config, make_url("postgresql://localhost/croesus"),
+                                 dict(pool_size=5, max_overflow=10))
+
+        self.assertNotIn("connect_args", options)
+        self.assertEqual(options["execution_options"]["local_statement_timeout"], 15000)
+        self.assertEqual(options["pool_size"], 2)
+
+    def test_sqlite_keeps_its_pool(self):
+        """Test SQLite engines get no pool options, Flask-SQLAlchemy picks their pool"""
+        options = engine_options(self.config, make_url(self.url),
+                                 dict(pool_size=5, max_overflow=10, pool_recycle=1800))
+
+        self.assertEqual(options, {})
+
+    def test_missing_database_url_keeps_the_options(self):
+        """Test no database URL leaves the options alone, e.g. while templates are compiled"""
+        options = engine_options(self.config, None, dict(pool_size=5))
+
+        self.assertEqual(options, dict(pool_size=5))
+
+    def test_pool_stats(self):
+        """Test the usage of a queue pool is reported"""
+        engine = create_engine(self.url, poolclass=QueuePool, pool_size=3, max_overflow=1)
+        connection = engine.connect()
+        stats = pool_stats(engine)
+        connection.close()
+        engine.dispose()
+
+        self.assertEqual(stats["pool"], "QueuePool")
+        self.assertEqual(stats["size"], 3)
+        self.assertEqual(stats["checked_out"], 1)
+
+    def test_exhausted_pool_times_out(self):
+        """Test checkouts waiting longer than the pool timeout fail instead of queueing"""
+        result = load_test(self.url, threads=8, requests=40, hold=0.05, poolclass=QueuePool,
+                           pool_size=1, max_overflow=0, pool_timeout=0.01,
+                           connect_args=dict(check_same_thread=False))
+
+        self.assertGreater(result["timeouts"], 0)
+        self.assertEqual(result["failures"], 0)
+        self.assertEqual(result["connects"], 1)
+
+    def test_benchmark_compares_the_scenarios(self):
+        """Test every scenario is load tested and recycling connections opens new ones"""
+        scenarios = (("size 4", dict(pool_size=4, max_overflow=0, pool_timeout=30)),
+                     ("size 4, recycle", dict(pool_size=4, max_overflow=0, pool_timeout=30,
+                                              pool_recycle=0.01)))
+        plain, recycled = benchmark(self.url, threads=4, requests=40, hold=0.005,
+                                    scenarios=scenarios)
+
+        self.assertEqual(plain["name"], "size 4")
+        self.assertLessEqual(plain["connects"], 4)
+        self.assertGreater(recycled["connects"], plain["connects"])
+        self.assertEqual(plain["timeouts"] + plain["failures"], 0)
+
+    def test_admin_endpoint_reports_the_pool(self):
+        """Test administrators get the pool usage and settings of the worker"""
+        user = UserAccount(email="admin@example.com", password="password", username="admin",
+                           admin=True)
+        self.db.session.add(user)
+        self.db.session.commit()
+        self.client.post("/auth/signup", data=dict(email=user.email, password="password"))
+
+        response = self.client.get("/admin/pool")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("pool", response.json)
+        self.assertEqual(response.json["settings"]["sqlalchemy_pool_size"],
+                         self.app.config["SQLALCHEMY_POOL_SIZE"])
+
+
+if __name__ == "__main__":
+    unittest.main()
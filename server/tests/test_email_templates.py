@@ -0,0 +1,84 @@
+import unittest
+
+from flask import render_template
+from jinja2 import DictLoader
+
+from app.email_templates import EmailTemplates, benchmark
+from tests import BaseTestCase
+
+
+class EmailTemplatesTestCases(BaseTestCase):
+    """
+    Tests for the precompiled email templates
+    """
+
+    def setUp(self):
+        super(EmailTemplatesTestCases, self).setUp()
+        self.app.jinja_env.auto_reload = False
+        self.templates = EmailTemplates(self.app)
+
+    def render_template(self, template, **context):
+        with self.app.test_request_context(base_url=self.app.config["MAIL_BASE_URL"]):
+            return render_template(template, **context)
+
+    def test_precompiled_email_matches_jinja(self):
+        """Test a precompiled email is the same as the one rendered by Jinja"""
+        for template, variable in (("auth.confirm_email.html", "confirm_url"),
+                                   ("auth.reset_email.html", "recover_url")):
+            context = {variable: "http://localhost/auth/confirm/token"}
+            self.assertEqual(self.templates.render(template, **context),
+                             self.render_template(template, **context))
+
+    def test_template_is_compiled_once(self):
+        """Test the static parts of a template are rendered once and reused for every email"""
+        self.templates.render("auth.reset_email.html", recover_url="http://localhost/a")
+        compiled = self.templates.compiled("auth.reset_email.html", dict(recover_url=""))
+
+        self.assertEqual(compiled.variables, ("recover_url", "recover_url"))
+        self.assertEqual(len(self.templates._compiled), 1)
+        self.assertIn("http://localhost/b",
+                      self.templates.render("auth.reset_email.html", recover_url="http://localhost/b"))
+
+    def test_values_are_escaped(self):
+        """Test per recipient values are HTML escaped like Jinja does"""
+        html = self.templates.render("auth.reset_email.html",
+                                     recover_url="http://localhost/?a=1&b=<2>")
+
+        self.assertIn("http://localhost/?a=1&amp;b=&lt;2&gt;", html)
+        self.assertNotIn("<2>", html)
+
+    def test_render_many(self):
+        """Test bulk rendering personalizes every email"""
+        urls = ["http://localhost/reset/{}".format(index) for index in range(50)]
+        emails = self.templates.render_many("auth.reset_email.html",
+                                            [dict(recover_url=url) for url in urls])
+
+        self.assertEqual(len(emails), 50)
+        for url, html in zip(urls, emails):
+            self.assertEqual(html, self.render_template("auth.reset_email.html", recover_url=url))
+
+    def test_variables_used_in_logic_are_rendered_by_jinja(self):
+        """Test templates that test their variables are not precompiled"""
+        self.app.jinja_loader.loaders[1].mapping["test"] = DictLoader({
+            "email.html": "{% if name %}Hi {{ name }}{% else %}Hi there{% endif %}"})
+
+        self.assertIsNone(self.templates.compiled("test.email.html", dict(name="")))
+        self.assertEqual(self.templates.render("test.email.html", name=""), "Hi there")
+        self.assertEqual(self.templates.render("test.email.html", name="Croesus"), "Hi Croesus")
+
+    def test_auto_reload_renders_with_jinja(self):
+        """Test templates are not precompiled while they are reloaded on change"""
+        self.app.jinja_env.auto_reload = True
+
+        self.assertIsNone(self.templates.compiled("auth.reset_email.html", dict(recover_url="")))
+
+    def test_benchmark(self):
+        """Test the benchmark measures every method"""
+        results = benchmark("auth.reset_email.html", count=20, recover_url="http://localhost/")
+
+        self.assertEqual([result["name"] for result in results],
+                         ["render_template", "precompiled", "precompiled, render_many"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+
+from app.mod_auth.hashing import PasswordHasher, password_hasher
+from app.mod_auth.models import UserAccount
+from tests import BaseTestCase
+
+
+class PasswordHasherTestCases(BaseTestCase):
+    """
+    Tests for the password hashing service
+    """
+
+    def test_hash_uses_configured_cost(self):
+        """Test hashes are created with the configured method and iterations"""
+        password_hash = password_hasher.hash("cat")
+        self.assertTrue(password_hash.startswith("pbkdf2:sha256:1000$"))
+        self.assertFalse(password_hasher.needs_rehash(password_hash))
+
+    def test_outdated_hash_is_upgraded_on_verify(self):
+        """Test verifying a password hashed with an older cost replaces the hash"""
+        old_hasher = PasswordHasher()
+        old_hasher.iterations = 500
+        user = UserAccount(password_hash=old_hasher.hash("cat"))
+
+        self.assertTrue(password_hasher.needs_rehash(user.password_hash))
+        self.assertTrue(user.verify_password("cat"))
+        self.assertTrue(user.password_hash.startswith("pbkdf2:sha256:1000$"))
+
+    def test_wrong_password_does_not_upgrade_hash(self):
+        """Test a failed verification leaves the stored hash untouched"""
+        old_hasher = PasswordHasher()
+        old_hasher.iterations = 500
+        old_hash = old_hasher.hash("cat")
+        user = UserAccount(password_hash=old_hash)
+
+        self.assertFalse(user.verify_password("dog"))
+        self.assertEqual(user.password_hash, old_hash)
+
+    def test_hashing_on_process_pool(self):
+        """Test hashes created on the process pool can be verified"""
+        hasher = PasswordHasher()
+        hasher.iterations = 1000
+        hasher.pool_size = 1
+        try:
+            password_hash = hasher.hash("cat")
+            self.assertTrue(hasher.verify(password_hash, "cat"))
+            self.assertFalse(hasher.verify(password_hash, "dog"))
+        finally:
+            hasher.shutdown()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+import unittest
+from unittest.mock import patch
+
+import fakeredis
+from flask import jsonify
+
+from app import redis_db
+from app.http_cache import http_cache, cached_response, MemoryResponseCacheBackend, \
+    RedisResponseCacheBackend
+from app.mod_auth.models import UserAccount
+from tests import BaseTestCase
+
+
+class HttpCacheTestCases(BaseTestCase):
+    """
+    Tests for the ETags, conditional requests and cached responses
+    """
+
+    def setUp(self):
+        super(HttpCacheTestCases, self).setUp()
+        client = fakeredis.FakeStrictRedis()
+        client.flushall()
+        redis_db.init_app(self.app, client=client)
+        http_cache.backend = MemoryResponseCacheBackend(100)
+        self.calls = 0
+
+        @cached_response(30)
+        def counter():
+            self.calls += 1
+            return jsonify(calls=self.calls)
+
+        @cached_response(30, scope="user")
+        def whoami():
+            self.calls += 1
+            return jsonify(calls=self.calls)
+
+        self.app.add_url_rule("/test/counter", "counter", counter, methods=["GET", "POST"])
+        self.app.add_url_rule("/test/whoami", "whoami", whoami)
+
+    def tearDown(self):
+        http_cache.backend = None
+        super(HttpCacheTestCases, self).tearDown()
+
+    def test_responses_have_strong_etags(self):
+        """Test a GET response gets an ETag and a matching conditional GET an empty 304"""
+        response = self.client.get("/home")
+        etag = response.headers["ETag"]
+
+        self.assertFalse(etag.startswith("W/"))
+        conditional = self.client.get("/home", headers={"If-None-Match": etag})
+        self.assertEqual(conditional.status_code, 304)
+        self.assertEqual(conditional.data, b"")
+
+        changed = self.client.get("/home", headers={"If-None-Match": '"other"'})
+        self.assertEqual(changed.status_code, 200)
+
+    def test_declared_ttl_sets_cache_control(self):
+        """Test the decorator's ttl becomes the response's max-age"""
+        response = self.client.get("/test/counter")
+
+        self.assertEqual(response.cache_control.max_age, 30)
+        self.assertTrue(response.cache_control.public)
+
+    def test_responses_are_cached(self):
+        """Test the view runs once while its response is cached"""
+        first = self.client.get("/test/counter")
+        second = self.client.get("/test/counter")
+
+        self.assertEqual(first.headers["X-Cache"], "MISS")
+        self.assertEqual(second.headers["X-Cache"], "HIT")
+        self.assertEqual(second.json, dict(calls=1))
+        self.assertEqual(first.headers["ETag"], second.headers["ETag"])
+        self.assertIn("Age", second.headers)
+
+    def test_cache_is_keyed_by_arguments(self):
+        """Test responses to different query arguments are cached apart"""
+        self.client.get("/test/counter?page=1")
+        response = self.client.get("/test/counter?page=2")
+
+        self.assertEqual(response.json, dict(calls=2))
+        self.assertEqual(self.client.get("/test/counter?page=1").json, dict(calls=1))
+
+    def test_post_is_never_cached(self):
+        """Test only GET responses are cached"""
+        self.client.get("/test/counter")
+        response = self.client.post("/test/counter")
+
+        self.assertEqual(response.json, dict(calls=2))
+        self.assertNotIn("ETag", response.headers)
+
+    def test_user_responses_are_cached_per_user(self):
+        """Test responses scoped to the user are not shared between users"""
+        anonymous = self.client.get("/test/whoami")
+
+        user = UserAccount(email="croesus@example.com", password="croesus_password",
+                           username="croesus")
+        self.db.session.add(user)
+        self.db.session.commit()
+        with patch("app.http_cache.current_user", user):
+            authenticated = self.client.get("/test/whoami")
+
+        self.assertEqual(anonymous.json, dict(calls=1))
+        self.assertEqual(authenticated.json, dict(calls=2))
+        self.assertTrue(authenticated.cache_control.private)
+
+    @patch("app.mod_blog.views.fetch_news.apply_async")
+    def test_pages_starting_a_crawl_are_not_cached(self, apply_async):
+        """Test a blog page that dispatched crawls is not reused"""
+        self.app.config["NEWS_REFRESH_ON_MISS"] = True
+
+        response = self.client.get("/blog/")
+
+        self.assertTrue(response.cache_control.no_store)
+        self.assertNotIn("X-Cache", response.headers)
+
+    def test_redis_backend_is_shared(self):
+        """Test responses cached in redis are served by another worker's cache"""
+        http_cache.backend = RedisResponseCacheBackend(redis_db.get_client())
+        self.client.get("/test/counter")
+        http_cache.backend = RedisResponseCacheBackend(redis_db.get_client())
+
+        response = self.client.get("/test/counter")
+
+        self.assertEqual(response.headers["X-Cache"], "HIT")
+        self.assertEqual(response.json, dict(calls=1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import csv
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from app.mod_auth.importer import UserImporter
+from app.mod_auth.models import UserAccount, UserProfile
+from tests import BaseTestCase
+
+
+class UserImporterTestCases(BaseTestCase):
+    """
+    Tests for the bulk user importer
+    """
+
+    def setUp(self):
+        super(UserImporterTestCases, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(UserImporterTestCases, self).tearDown()
+
+    def write_csv(self, records):
+        path = os.path.join(self.directory, "users.csv")
+        with open(path, "w", newline="") as users_file:
+            writer = csv.DictWriter(users_file, fieldnames=["email", "username", "first_name",
+                                                             "last_name", "password"])
+            writer.writeheader()
+            writer.writerows(records)
+        return path
+
+    @staticmethod
+    def records(count, start=0):
+        return [dict(email="user{}@example.com".format(index), username="user{}".format(index),
+                     first_name="User", last_name=str(index), password="password")
+                for index in range(start, start + count)]
+
+    def test_import_creates_profiles_and_accounts(self):
+        """Test every record of the file creates a linked profile and account"""
+        path = self.write_csv(self.records(5))
+        report = UserImporter(path, chunk_size=2, workers=1, log=lambda message: None).run()
+
+        self.assertEqual((report.imported, report.skipped, report.chunks), (5, 0, 3))
+        account = UserAccount.query.filter_by(email="user3@example.com").first()
+        self.assertEqual(account.user_profile.last_name, "3")
+        self.assertTrue(account.verify_password("password"))
+
+    def test_import_skips_existing_and_invalid_users(self):
+        """Test users that already exist, duplicates and records without a password are skipped"""
+        records = self.records(3)
+        records.append(dict(records[0]))
+        records.append(dict(email="nopassword@example.com", username="nopassword",
+                            first_name="", last_name="", password=""))
+        records.append(dict(email="test1hadithi@hadithi.com", username="test1",
+                            first_name="", last_name="", password="password"))
+        path = self.write_csv(records)
+
+        report = UserImporter(path, workers=1, log=lambda message: None).run()
+
+        self.assertEqual((report.imported, report.skipped), (3, 3))
+        self.assertEqual(UserProfile.query.count(), 7)
+
+    def test_import_resumes_from_checkpoint(self):
+        """Test a resumed import starts after the last committed chunk"""
+        path = self.write_csv(self.records(4))
+        with open(path + ".checkpoint", "w") as checkpoint:
+            json.dump(dict(path=os.path.abspath(path), rows=2), checkpoint)
+
+        report = UserImporter(path, chunk_size=2, workers=1,
+                              log=lambda message: None).run(resume=True)
+
+        self.assertEqual(report.imported, 2)
+        self.assertIsNone(UserAccount.query.filter_by(email="user0@example.com").first())
+        self.assertIsNotNone(UserAccount.query.filter_by(email="user3@example.com").first())
+        with open(path + ".checkpoint") as checkpoint:
+            self.assertEqual(json.load(checkpoint)["rows"], 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
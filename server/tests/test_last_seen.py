@@ -0,0 +1,95 @@
+import time
+import unittest
+from datetime import datetime, timedelta
+
+from app import db
+from app.mod_auth.last_seen import LastSeenTracker
+from app.mod_auth.models import UserAccount, UserProfile
+from tests import BaseTestCase
+
+
+class LastSeenTrackerTestCases(BaseTestCase):
+    """
+    Tests for the write-behind last seen tracker
+    """
+
+    def create_user_account(self, email, username):
+        profile = UserProfile.query.filter_by(email=email).first()
+        user = UserAccount(email=email, username=username, password="password",
+                           user_profile_id=profile.id)
+        db.session.add(user)
+        db.session.commit()
+        return user
+
+    def test_touch_does_not_dirty_the_session(self):
+        """Test touching a user does not add a pending update to the request session"""
+        tracker = LastSeenTracker()
+        tracker.init_app(self.app)
+        tracker.flush_interval = 3600
+
+        user = self.create_user_account("test1hadithi@hadithi.com", "test1")
+        tracker.touch(user)
+
+        self.assertIsNotNone(user.last_seen)
+        self.assertNotIn(user, db.session.dirty)
+        self.assertEqual(tracker.flush(), 1)
+
+    def test_timestamps_are_buffered_until_flushed(self):
+        """Test timestamps are only written to the database when the tracker is flushed"""
+        tracker = LastSeenTracker()
+        tracker.init_app(self.app)
+        tracker.flush_interval = 3600
+
+        user1 = self.create_user_account("test1hadithi@hadithi.com", "test1")
+        user2 = self.create_user_account("test2hadithi@hadithi.com", "test2")
+        earlier, later = datetime(2017, 1, 1), datetime(2017, 1, 1) + timedelta(minutes=5)
+
+        tracker.touch(user1, earlier)
+        tracker.touch(user1, later)
+        tracker.touch(user2, earlier)
+
+        db.session.expire_all()
+        self.assertIsNone(UserAccount.query.get(user1.id).last_seen)
+
+        self.assertEqual(tracker.flush(), 2)
+
+        db.session.expire_all()
+        self.assertEqual(UserAccount.query.get(user1.id).last_seen, later)
+        self.assertEqual(UserAccount.query.get(user2.id).last_seen, earlier)
+
+    def test_flushes_when_max_pending_is_reached(self):
+        """Test the tracker flushes once the number of pending users reaches the threshold"""
+        tracker = LastSeenTracker()
+        tracker.init_app(self.app)
+        tracker.flush_interval = 3600
+        tracker.max_pending = 2
+
+        user1 = self.create_user_account("test1hadithi@hadithi.com", "test1")
+        user2 = self.create_user_account("test2hadithi@hadithi.com", "test2")
+
+        tracker.touch(user1)
+        tracker.touch(user2)
+
+        db.session.expire_all()
+        self.assertIsNotNone(UserAccount.query.get(user1.id).last_seen)
+        self.assertIsNotNone(UserAccount.query.get(user2.id).last_seen)
+
+    def test_flusher_wakes_when_the_oldest_timestamp_is_due(self):
+        """Test the flusher sleeps until the staleness bound of the oldest timestamp, not longer"""
+        tracker = LastSeenTracker()
+        tracker.init_app(self.app)
+        tracker.flush_interval = 60
+
+        self.assertEqual(tracker._seconds_until_due(), 60)
+
+        tracker._pending[1] = datetime.now()
+        tracker._oldest_pending = time.time() - 45
+        self.assertAlmostEqual(tracker._seconds_until_due(), 15, delta=1)
+
+        tracker._oldest_pending = time.time() - 90
+        self.assertEqual(tracker._seconds_until_due(), 0)
+        tracker._pending.clear()
+
+
+if __name__ == "__main__":
+    unittest.main()
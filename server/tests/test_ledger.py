@@ -0,0 +1,105 @@
+import unittest
+from datetime import datetime, timedelta
+
+from celery.signals import before_task_publish
+
+from app import db
+from app.mod_auth.last_seen import last_seen_tracker
+from app.mod_auth.models import AsyncOperation, AsyncOperationStatus, AsyncOperationSummary, \
+    UserAccount, UserProfile
+from app.mod_tasks.ledger import task_ledger
+from tests import BaseTestCase
+
+
+class TaskLedgerTestCases(BaseTestCase):
+    """
+    Tests for the ledger of background tasks
+    """
+
+    def setUp(self):
+        super(TaskLedgerTestCases, self).setUp()
+        self.profile = UserProfile.query.filter_by(email="test1hadithi@hadithi.com").first()
+        self.now = datetime(2017, 5, 10, 12, 0, 0)
+
+    def operation(self, task_id):
+        db.session.expire_all()
+        return AsyncOperation.query.filter_by(task_id=task_id).one()
+
+    def test_task_life_is_recorded(self):
+        """Test queue time and duration are computed from the enqueue, start and finish dates"""
+        task_ledger.enqueued("task-1", "app.tasks.example", self.profile.id, when=self.now)
+        task_ledger.started("task-1", "app.tasks.example", when=self.now + timedelta(seconds=2))
+        task_ledger.finished("task-1", "app.tasks.example", "SUCCESS", 42,
+                             when=self.now + timedelta(seconds=5))
+
+        operation = self.operation("task-1")
+        self.assertEqual(operation.status.code, AsyncOperationStatus.OK)
+        self.assertEqual(operation.queue_time, 2)
+        self.assertEqual(operation.duration, 3)
+        self.assertEqual(operation.user_profile_id, self.profile.id)
+        self.assertIsNone(operation.error)
+
+    def test_failures_and_retries_are_recorded(self):
+        """Test a task sent again counts a retry and a failure keeps its error"""
+        task_ledger.enqueued("task-2", "app.tasks.example", when=self.now)
+        task_ledger.enqueued("task-2", "app.tasks.example", when=self.now)
+        task_ledger.started("task-2", "app.tasks.example", when=self.now)
+        task_ledger.finished("task-2", "app.tasks.example", "FAILURE", ValueError("boom"),
+                             when=self.now)
+
+        operation = self.operation("task-2")
+        self.assertEqual(operation.retries, 1)
+        self.assertEqual(operation.status.code, AsyncOperationStatus.ERROR)
+        self.assertIn("boom", operation.error)
+
+    def test_tasks_not_seen_when_sent_are_recorded_when_started(self):
+        """Test a task the ledger did not see being sent is recorded once it starts"""
+        task_ledger.started("task-3", "app.tasks.example", when=self.now)
+
+        operation = self.operation("task-3")
+        self.assertEqual(operation.status.code, AsyncOperationStatus.STARTED)
+        self.assertIsNone(operation.queue_time)
+
+    def test_publishing_in_a_request_records_the_user(self):
+        """Test tasks sent while handling a request are linked to the user's profile"""
+        user = UserAccount(email=self.profile.email, username="test1", password="password",
+                           user_profile_id=self.profile.id)
+        db.session.add(user)
+        db.session.commit()
+        last_seen_tracker.flush_interval = 3600
+        headers = {"Authorization": "Bearer " + user.generate_auth_token(3600)}
+
+        with self.app.test_request_context(headers=headers):
+            before_task_publish.send(sender="app.tasks.example", headers={"id": "task-4"},
+                                     body={})
+
+        self.assertEqual(self.operation("task-4").user_profile_id, self.profile.id)
+
+        response = self.client.get("/tasks/mine", headers=headers)
+        self.assert200(response)
+        self.assertEqual([task["task_id"] for task in response.json["tasks"]], ["task-4"])
+        self.assertEqual(response.json["statistics"][0]["count"], 1)
+
+    def test_old_entries_are_compacted_into_daily_totals(self):
+        """Test entries past the retention period are summed up per day, task and user"""
+        old = self.now - timedelta(days=task_ledger.retention_days + 1)
+        for index, duration in enumerate((1, 3)):
+            task_id = "old-{}".format(index)
+            task_ledger.enqueued(task_id, "app.tasks.example", self.profile.id, when=old)
+            task_ledger.started(task_id, "app.tasks.example", when=old)
+            task_ledger.finished(task_id, "app.tasks.example", "SUCCESS",
+                                 when=old + timedelta(seconds=duration))
+        task_ledger.enqueued("recent", "app.tasks.example", self.profile.id, when=self.now)
+
+        self.assertEqual(task_ledger.compact(now=self.now), 2)
+        self.assertEqual(task_ledger.compact(now=self.now), 0)
+
+        summary = AsyncOperationSummary.query.one()
+        self.assertEqual((summary.count, summary.errors), (2, 0))
+        self.assertEqual(summary.total_duration, 4)
+        self.assertEqual(summary.max_duration, 3)
+        self.assertEqual([operation.task_id for operation in AsyncOperation.query], ["recent"])
+
+
+if __name__ == "__main__":
+    unittest.main()
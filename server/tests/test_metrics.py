@@ -0,0 +1,180 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from sqlalchemy import create_engine
+
+from app.metrics import metrics, TimedQueuePool, clear_multiprocess_dir
+from tests import BaseTestCase
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class MetricsTestCases(BaseTestCase):
+    """
+    Tests for the prometheus metrics and their endpoint
+    """
+
+    def setUp(self):
+        self.app.config["METRICS_ENABLED"] = True
+        metrics.init_app(self.app)
+        super(MetricsTestCases, self).setUp()
+
+    def tearDown(self):
+        metrics.enabled = False
+        super(MetricsTestCases, self).tearDown()
+
+    def sample(self, name, **labels):
+        return metrics.registry.get_sample_value(name, labels) or 0
+
+    def test_requests_are_timed_by_endpoint(self):
+        """Test every request is counted and timed under its endpoint"""
+        count = self.sample("http_request_duration_seconds_count", method="GET",
+                            endpoint="home.index")
+        self.client.get("/home")
+
+        self.assertEqual(self.sample("http_request_duration_seconds_count", method="GET",
+                                     endpoint="home.index"), count + 1)
+        self.assertGreaterEqual(self.sample("http_requests_total", method="GET",
+                                            endpoint="home.index", status="200"), 1)
+        self.assertEqual(self.sample("http_requests_in_flight"), 0)
+
+    def test_metrics_endpoint(self):
+        """Test the metrics are exposed in the prometheus text format"""
+        self.client.get("/home")
+        response = self.client.get("/metrics")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("text/plain", response.content_type)
+        self.assertIn(b'http_request_duration_seconds_bucket{endpoint="home.index"', response.data)
+
+    def test_cache_lookups_are_counted(self):
+        """Test hits and misses are counted by cache"""
+        hits = self.sample("cache_lookups_total", cache="user", result="hit")
+        metrics.cache_lookup("user", True)
+        metrics.cache_lookup("user", False)
+
+        self.assertEqual(self.sample("cache_lookups_total", cache="user", result="hit"),
+                         hits + 1)
+
+    def test_pool_checkouts_are_timed(self):
+        """Test the timed pool records the wait of every checkout"""
+        count = self.sample("db_pool_checkout_seconds_count")
+        engine = create_engine("sqlite://", poolclass=TimedQueuePool)
+        with engine.connect() as connection:
+            connection.execute("SELECT 1")
+
+        self.assertEqual(self.sample("db_pool_checkout_seconds_count"), count + 1)
+
+    def test_pool_connections_are_counted(self):
+        """Test the connections checked out of the pools and opened by them are counted"""
+        opened = self.sample("db_pool_connections_opened_total")
+        checked_out = self.sample("db_pool_connections_checked_out")
+        engine = create_engine("sqlite://", poolclass=TimedQueuePool)
+        with engine.connect():
+            in_use = self.sample("db_pool_connections_checked_out")
+
+        self.assertEqual(in_use, checked_out + 1)
+        self.assertEqual(self.sample("db_pool_connections_checked_out"), checked_out)
+        self.assertEqual(self.sample("db_pool_connections_opened_total"), opened + 1)
+
+    def test_task_queue_time_and_runtime(self):
+        """Test a task's time in the broker and its runtime are recorded"""
+        headers = {}
+        metrics.on_publish(sender="app.tasks.send", headers=headers)
+        task = SimpleNamespace(name="app.tasks.send", request=SimpleNamespace(
+            sent_at=headers["sent_at"] - 2, headers=None))
+
+        metrics.on_prerun(task_id="1", task=task)
+        metrics.on_postrun(task_id="1", task=task, state="SUCCESS")
+
+        self.assertGreaterEqual(self.sample("celery_task_queue_seconds_sum",
+                                            task="app.tasks.send"), 2)
+        self.assertEqual(self.sample("celery_task_runtime_seconds_count", task="app.tasks.send",
+                                     state="SUCCESS"), 1)
+
+
+class MultiprocessMetricsTestCases(unittest.TestCase):
+    """
+    Tests for the aggregation of the metrics of several worker processes
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_workers_are_aggregated(self):
+        """Test the endpoint of one worker reports the requests of every worker"""
+        worker = ("from app import create_app\n"
+                  "from app.metrics import metrics\n"
+                  "app = create_app('testing')\n"
+                  "app.config['METRICS_ENABLED'] = True\n"
+                  "metrics.init_app(app)\n"
+                  "client = app.test_client()\n"
+                  "client.get('/home')\n"
+                  "import sys\n"
+                  "if len(sys.argv) > 1:\n"
+                  "    sys.stdout.write(client.get('/metrics').data.decode('utf-8'))\n")
+        environment = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=self.directory,
+                           prometheus_multiproc_dir=self.directory)
+
+        subprocess.check_call([sys.executable, "-c", worker], cwd=SERVER_DIR, env=environment)
+        output = subprocess.check_output([sys.executable, "-c", worker, "export"],
+                                         cwd=SERVER_DIR, env=environment).decode("utf-8")
+
+        line = next(line for line in output.splitlines() if line.startswith(
+            "http_request_duration_seconds_count") and 'endpoint="home.index"' in line)
+        self.assertEqual(float(line.split()[-1]), 2)
+
+    def test_celery_worker_serves_the_tasks_of_its_pool(self):
+        """Test the main process of a worker serves the task metrics of its pool processes"""
+        worker = ("import multiprocessing, socket, sys, urllib.request\n"
+                  "from types import SimpleNamespace\n"
+                  "from app import create_app\n"
+                  "from app.metrics import metrics, serve_worker_metrics\n"
+                  "app = create_app('testing')\n"
+                  "app.config['METRICS_ENABLED'] = True\n"
+                  "metrics.init_app(app)\n"
+                  "def run():\n"
+                  "    task = SimpleNamespace(name='app.tasks.send', request=SimpleNamespace(\n"
+                  "        sent_at=None, headers=None))\n"
+                  "    metrics.on_prerun(task_id='1', task=task)\n"
+                  "    metrics.on_postrun(task_id='1', task=task, state='SUCCESS')\n"
+                  "child = multiprocessing.Process(target=run)\n"
+                  "child.start()\n"
+                  "child.join()\n"
+                  "probe = socket.socket()\n"
+                  "probe.bind(('127.0.0.1', 0))\n"
+                  "port = probe.getsockname()[1]\n"
+                  "probe.close()\n"
+                  "serve_worker_metrics(port)\n"
+                  "url = 'http://127.0.0.1:{}/'.format(port)\n"
+                  "sys.stdout.write(urllib.request.urlopen(url).read().decode('utf-8'))\n")
+        environment = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=self.directory,
+                           prometheus_multiproc_dir=self.directory)
+
+        output = subprocess.check_output([sys.executable, "-c", worker], cwd=SERVER_DIR,
+                                         env=environment).decode("utf-8")
+
+        line = next(line for line in output.splitlines() if line.startswith(
+            "celery_task_runtime_seconds_count") and 'task="app.tasks.send"' in line)
+        self.assertEqual(float(line.split()[-1]), 1)
+
+    def test_samples_of_previous_runs_are_cleared(self):
+        """Test clearing the directory keeps only the samples of the given process"""
+        for name in ("histogram_1.db", "gauge_livesum_1.db", "histogram_2.db"):
+            open(os.path.join(self.directory, name), "w").close()
+
+        clear_multiprocess_dir(self.directory, keep=2)
+
+        self.assertEqual(os.listdir(self.directory), ["histogram_2.db"])
+
+
+if __name__ == "__main__":
+    unittest.main()
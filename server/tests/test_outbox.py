@@ -0,0 +1,208 @@
+import json
+import socket
+import time
+import unittest
+from unittest.mock import patch
+
+import fakeredis
+from aiosmtpd.controller import Controller
+
+from app import redis_db
+from app.outbox import mail_outbox, RateLimiter
+from tests import BaseTestCase
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class RecordingHandler(object):
+    """
+    SMTP handler keeping the emails it receives, refuses the recipients in 'refused'
+    """
+
+    def __init__(self, refused=()):
+        self.refused = set(refused)
+        self.messages = []
+        self.peers = set()
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address in self.refused:
+            return "550 No such user"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        # one peer per SMTP connection
+        self.peers.add(session.peer)
+        self.messages.append((envelope.rcpt_tos, envelope.content.decode("utf-8", "replace")))
+        return "250 Message accepted for delivery"
+
+
+class MailOutboxTestCases(BaseTestCase):
+    """
+    Tests for the batched delivery of queued emails
+    """
+
+    def setUp(self):
+        super(MailOutboxTestCases, self).setUp()
+        client = fakeredis.FakeStrictRedis()
+        client.flushall()
+        redis_db.init_app(self.app, client=client)
+
+        self.handler = RecordingHandler(refused=["nobody@example.com"])
+        self.smtp = Controller(self.handler, hostname="127.0.0.1", port=free_port())
+        self.smtp.start()
+
+        state = self.app.extensions["mail"]
+        state.server, state.port = self.smtp.hostname, self.smtp.port
+        state.use_tls = state.use_ssl = state.suppress = False
+        state.username = state.password = None
+        self.app.config["MAIL_DEFAULT_SENDER"] = "arco@example.com"
+
+        mail_outbox.rate = 0
+        mail_outbox.batch_size = 100
+        self.drain_task = patch("app.outbox.drain_mail_outbox.apply_async").start()
+
+    def tearDown(self):
+        patch.stopall()
+        self.smtp.stop()
+        super(MailOutboxTestCases, self).tearDown()
+
+    def queue(self, *recipients):
+        return [mail_outbox.enqueue(to, "Please Confirm you email", "auth.confirm_email.html",
+                                    confirm_url="http://localhost/confirm/{}".format(to))
+                for to in recipients]
+
+    def test_queueing_schedules_a_single_drain(self):
+        """Test queueing emails dispatches one drain until it has started"""
+        self.queue("croesus@example.com", "midas@example.com")
+
+        self.assertEqual(self.drain_task.call_count, 1)
+        self.assertEqual(mail_outbox.metrics()["queue_length"], 2)
+
+    def test_batch_is_sent_over_one_connection(self):
+        """Test a drain sends every queued email, a batch over a single connection"""
+        recipients = ["user{}@example.com".format(index) for index in range(10)]
+        self.queue(*recipients)
+
+        sent = mail_outbox.drain()
+
+        self.assertEqual(sent, 10)
+        self.assertEqual(sorted(to for tos, _ in self.handler.messages for to in tos),
+                         sorted(recipients))
+        self.assertEqual(len(self.handler.peers), 1)
+        self.assertIn("http://localhost/confirm/user0@example.com", self.handler.messages[0][1])
+
+        metrics = mail_outbox.metrics()
+        self.assertEqual(metrics["sent"], 10)
+        self.assertEqual(metrics["queue_length"], 0)
+        self.assertEqual(metrics["processing"], 0)
+
+    def test_batches_are_limited_in_size(self):
+        """Test emails beyond the batch size are sent over another connection"""
+        mail_outbox.batch_size = 3
+        self.queue(*["user{}@example.com".format(index) for index in range(7)])
+
+        mail_outbox.drain()
+
+        self.assertEqual(len(self.handler.messages), 7)
+        self.assertEqual(len(self.handler.peers), 3)
+
+    def test_refused_email_is_retried_then_dead_lettered(self):
+        """Test a refused email is retried with a backoff and given up after the last attempt"""
+        mail_outbox.max_attempts = 2
+        self.queue("nobody@example.com", "croesus@example.com")
+
+        self.assertEqual(mail_outbox.drain(), 1)
+        metrics = mail_outbox.metrics()
+        self.assertEqual(metrics["retrying"], 1)
+        self.assertEqual(metrics["retried"], 1)
+
+        # not due yet
+        self.assertEqual(mail_outbox.promote_retries(), 0)
+        self.assertEqual(mail_outbox.promote_retries(now=time.time() + 3600), 1)
+        self.assertEqual(mail_outbox.drain(), 0)
+
+        metrics = mail_outbox.metrics()
+        self.assertEqual(metrics["dead"], 1)
+        self.assertEqual(metrics["failed"], 1)
+        self.assertEqual(metrics["retrying"], 0)
+        dead = json.loads(redis_db.get_client().lindex(mail_outbox.key("dead"), 0).decode("utf-8"))
+        self.assertEqual(dead["to"], "nobody@example.com")
+        self.assertEqual(dead["attempts"], 2)
+
+    def test_message_that_can_not_be_rendered_is_retried(self):
+        """Test a message whose template does not exist is retried and the batch goes on"""
+        mail_outbox.enqueue("midas@example.com", "Missing", "auth.missing.html")
+        self.queue("croesus@example.com")
+
+        self.assertEqual(mail_outbox.drain(), 1)
+
+        metrics = mail_outbox.metrics()
+        self.assertEqual(metrics["retrying"], 1)
+        self.assertEqual(metrics["processing"], 0)
+        raw = redis_db.get_client().zrange(mail_outbox.key("retry"), 0, 0)[0]
+        self.assertEqual(json.loads(raw.decode("utf-8"))["attempts"], 1)
+        self.assertEqual(self.handler.messages[0][0], ["croesus@example.com"])
+
+    def test_connection_failure_retries_the_batch(self):
+        """Test emails that could not be sent because the server is down are retried"""
+        self.queue("croesus@example.com", "midas@example.com")
+        self.app.extensions["mail"].port = free_port()
+
+        self.assertEqual(mail_outbox.drain(), 0)
+
+        metrics = mail_outbox.metrics()
+        self.assertEqual(metrics["connection_errors"], 1)
+        self.assertEqual(metrics["retrying"], 2)
+        self.assertEqual(metrics["processing"], 0)
+
+    def test_interrupted_batch_is_sent_by_the_next_drain(self):
+        """Test emails left in the processing list by a dead worker are sent again"""
+        self.queue("croesus@example.com")
+        client = redis_db.get_client()
+        client.rpoplpush(mail_outbox.key("queue"), mail_outbox.key("processing"))
+
+        self.assertEqual(mail_outbox.drain(), 1)
+        self.assertEqual(mail_outbox.metrics()["processing"], 0)
+
+    def test_only_one_drain_runs_at_a_time(self):
+        """Test a drain does nothing while another one holds the lock"""
+        self.queue("croesus@example.com")
+        redis_db.get_client().set(mail_outbox.key("lock"), "other")
+
+        self.assertIsNone(mail_outbox.drain())
+        self.assertEqual(self.handler.messages, [])
+
+
+class RateLimiterTestCases(unittest.TestCase):
+    """
+    Tests for the pacing of sent emails
+    """
+
+    def test_calls_are_spaced_by_the_rate(self):
+        """Test calls are delayed so that no more than 'rate' happen per second"""
+        now, sleeps = [100.0], []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        limiter = RateLimiter(4, clock=lambda: now[0], sleep=sleep)
+        for _ in range(5):
+            limiter.wait()
+
+        self.assertEqual(sleeps, [0.25] * 4)
+
+    def test_no_rate_does_not_wait(self):
+        """Test a rate of 0 disables the limit"""
+        limiter = RateLimiter(0, sleep=self.fail)
+        limiter.wait()
+        limiter.wait()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+import unittest
+
+import fakeredis
+from flask import jsonify
+
+from app.mod_auth.models import UserAccount
+from app.query_stats import query_stats, fingerprint, new_aggregate, MemoryQueryStatsBackend, \
+    RedisQueryStatsBackend
+from tests import BaseTestCase
+
+
+class QueryStatsTestCases(BaseTestCase):
+    """
+    Tests for the instrumentation of the SQL queries and the query report
+    """
+
+    def setUp(self):
+        super(QueryStatsTestCases, self).setUp()
+        query_stats.clear()
+        query_stats.n_plus_one_threshold = 5
+
+        def users():
+            ids = [user.id for user in UserAccount.query.all()]
+            # one query per user, the N+1 the instrumentation should notice
+            return jsonify(emails=[UserAccount.query.get(user_id).email for user_id in ids])
+
+        self.app.add_url_rule("/test/users", "users", users)
+        for index in range(6):
+            self.db.session.add(UserAccount(email="user{}@example.com".format(index),
+                                            password="password", username="user{}".format(index)))
+        self.db.session.commit()
+
+    def tearDown(self):
+        query_stats.clear()
+        super(QueryStatsTestCases, self).tearDown()
+
+    def test_fingerprint_replaces_values(self):
+        """Test statements differing only by their values have the same fingerprint"""
+        first = fingerprint("SELECT * FROM user_account WHERE id = 1 AND email = 'a@b.c'")
+        second = fingerprint("SELECT *  FROM user_account\nWHERE id = 42 AND email = 'x''y'")
+        listed = fingerprint("SELECT * FROM t WHERE id IN (%(id_1)s, %(id_2)s, %(id_3)s)")
+
+        self.assertEqual(first, second)
+        self.assertEqual(first[0], "SELECT * FROM user_account WHERE id = ? AND email = ?")
+        self.assertEqual(listed[0], "SELECT * FROM t WHERE id IN (?)")
+        self.assertEqual(fingerprint("SELECT anon_1.id FROM t AS anon_1")[0],
+                         "SELECT anon_1.id FROM t AS anon_1")
+
+    def test_responses_report_their_queries(self):
+        """Test a response carries its number of queries and database time"""
+        response = self.client.get("/test/users")
+
+        self.assertEqual(response.headers["X-Query-Count"], "7")
+        self.assertGreater(float(response.headers["X-Query-Time"]), 0)
+
+    def test_report_by_endpoint(self):
+        """Test the report counts the requests, queries and fingerprints of each endpoint"""
+        self.client.get("/test/users")
+        self.client.get("/test/users")
+
+        report = query_stats.report()
+        stats = next(stats for stats in report["endpoints"] if stats["endpoint"] == "users")
+
+        self.assertEqual(stats["requests"], 2)
+        self.assertEqual(stats["queries"], 14)
+        self.assertEqual(stats["queries_per_request"], 7)
+        self.assertEqual(stats["fingerprints"][0]["count"], 12)
+        self.assertIn("WHERE user_account.id = ?", stats["fingerprints"][0]["statement"])
+
+    def test_n_plus_one_is_reported(self):
+        """Test a fingerprint repeated by a request is counted as an N+1 and logged"""
+        with self.assertLogs(self.app.logger, "WARNING") as logs:
+            self.client.get("/test/users")
+
+        stats = next(stats for stats in query_stats.report()["endpoints"]
+                     if stats["endpoint"] == "users")
+        self.assertEqual(stats["n_plus_one"], 1)
+        self.assertIn("Possible N+1 query in users, executed 6 times", logs.output[0])
+
+    def test_slow_queries_are_top_k(self):
+        """Test the slowest fingerprints are reported, longest first, at most top of them"""
+        query_stats.slow_threshold = 0
+        self.client.get("/test/users")
+
+        slow = query_stats.report(top=2)["slow"]
+        query_stats.slow_threshold = 0.5
+
+        self.assertEqual(len(slow), 2)
+        self.assertGreaterEqual(slow[0]["max_seconds"], slow[1]["max_seconds"])
+        self.assertEqual(slow[0]["endpoint"], "users")
+
+    def test_memory_backend_drops_expired_slots(self):
+        """Test slots older than the window are removed"""
+        backend = MemoryQueryStatsBackend()
+        backend.add(1, new_aggregate(), ttl=-1)
+        backend.add(2, new_aggregate(), ttl=60)
+
+        self.assertEqual(list(backend.slots), [2])
+
+    def test_redis_backend_combines_workers(self):
+        """Test the statistics of several workers are summed in redis, keeping the longest query"""
+        backend = RedisQueryStatsBackend(fakeredis.FakeStrictRedis())
+        backend.clear()
+        for seconds in (0.7, 0.9, 0.8):
+            aggregate = new_aggregate()
+            aggregate["endpoints"]["users"] = dict(requests=1, queries=7, seconds=seconds,
+                                                   n_plus_one=1, fingerprints={"abc": 6})
+            aggregate["slow"]["abc"] = dict(count=1, seconds=seconds, max_seconds=seconds,
+                                            endpoint="users")
+            aggregate["statements"]["abc"] = "SELECT ?"
+            backend.add(10, aggregate, ttl=60)
+
+        loaded, = backend.load([10])
+
+        self.assertEqual(loaded["endpoints"]["users"]["requests"], 3)
+        self.assertEqual(loaded["endpoints"]["users"]["fingerprints"]["abc"], 18)
+        self.assertEqual(loaded["slow"]["abc"]["count"], 3)
+        self.assertAlmostEqual(loaded["slow"]["abc"]["max_seconds"], 0.9)
+        self.assertEqual(loaded["statements"]["abc"], "SELECT ?")
+
+    def test_admin_endpoint_requires_an_admin(self):
+        """Test only administrators get the query report"""
+        user = UserAccount.query.filter_by(email="user0@example.com").first()
+        self.client.post("/auth/signup", data=dict(email=user.email, password="password"))
+
+        self.assertEqual(self.client.get("/admin/queries").status_code, 403)
+
+        user.admin = True
+        self.db.session.commit()
+        response = self.client.get("/admin/queries?top=5")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("auth.signup", [stats["endpoint"] for stats in response.json["endpoints"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
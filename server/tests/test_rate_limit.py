@@ -0,0 +1,121 @@
+import unittest
+from unittest.mock import patch
+
+import fakeredis
+from redis.exceptions import ConnectionError
+
+from app import redis_db
+from app.mod_auth.models import UserAccount
+from app.rate_limit import rate_limiter
+from tests import BaseTestCase
+
+
+class RateLimitTestCases(BaseTestCase):
+    """
+    Tests for the token buckets limiting the authentication endpoints
+    """
+
+    def setUp(self):
+        super(RateLimitTestCases, self).setUp()
+        client = fakeredis.FakeStrictRedis()
+        client.flushall()
+        redis_db.init_app(self.app, client=client)
+        self.app.config.update(RATE_LIMIT_ENABLED=True, RATE_LIMITS={
+            "login": [("ip", 3, 60), ("email", 2, 60)],
+            "reset_password": [("route", 1, 60)],
+        })
+        rate_limiter.init_app(self.app)
+
+        user = UserAccount(email="croesus@example.com", password="croesus_password",
+                           username="croesus")
+        self.db.session.add(user)
+        self.db.session.commit()
+
+    def login(self, email="croesus@example.com", password="wrong", ip="198.51.100.1"):
+        return self.client.post("/auth/signup", data=dict(email=email, password=password),
+                                environ_base=dict(REMOTE_ADDR=ip))
+
+    def test_bucket_refills_over_time(self):
+        """Test a bucket allows bursts of its capacity and refills at capacity / period"""
+        buckets = [("rate-limit:test", 2, 10)]
+
+        self.assertTrue(rate_limiter.hit(buckets, now=100)[0])
+        self.assertTrue(rate_limiter.hit(buckets, now=100)[0])
+        allowed, retry_after = rate_limiter.hit(buckets, now=101)
+
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(retry_after, 4.0)
+        self.assertTrue(rate_limiter.hit(buckets, now=105)[0])
+
+    def test_refused_requests_do_not_draw_from_other_buckets(self):
+        """Test a request refused by one bucket leaves the tokens of the others"""
+        ip, email = ("rate-limit:ip", 1, 60), ("rate-limit:email", 2, 60)
+        rate_limiter.hit([ip], now=0)
+
+        self.assertFalse(rate_limiter.hit([ip, email], now=0)[0])
+        self.assertTrue(rate_limiter.hit([email], now=0)[0])
+        self.assertTrue(rate_limiter.hit([email], now=0)[0])
+
+    def test_login_is_limited_by_email(self):
+        """Test logins to one account are refused with a 429 and a Retry-After header"""
+        self.login(ip="198.51.100.1")
+        self.login(ip="198.51.100.2")
+        response = self.login(ip="198.51.100.3")
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers["Retry-After"], "30")
+        self.assertEqual(response.json["response_code"], 429)
+        # the same address can still log in to other accounts
+        self.assertEqual(self.login(email="other@example.com", ip="198.51.100.3").status_code,
+                         200)
+
+    def test_login_is_limited_by_ip(self):
+        """Test a client cycling through emails is refused once its address is out of tokens"""
+        statuses = [self.login(email="user{}@example.com".format(index)).status_code
+                    for index in range(4)]
+
+        self.assertEqual(statuses, [200, 200, 200, 429])
+
+    def test_refused_logins_do_not_check_passwords(self):
+        """Test a refused login does not reach the view"""
+        for _ in range(2):
+            self.login()
+
+        with patch.object(UserAccount, "verify_password") as verify_password:
+            self.assertEqual(self.login().status_code, 429)
+        verify_password.assert_not_called()
+
+    @patch("app.mod_auth.views.queue_mail")
+    def test_route_limit_is_shared_by_all_clients(self, queue_mail):
+        """Test a route bucket limits the endpoint for every client"""
+        first = self.client.post("/auth/reset", data=dict(email="a@example.com"),
+                                 environ_base=dict(REMOTE_ADDR="198.51.100.1"))
+        second = self.client.post("/auth/reset", data=dict(email="b@example.com"),
+                                  environ_base=dict(REMOTE_ADDR="198.51.100.2"))
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 429)
+        self.assertEqual(queue_mail.call_count, 1)
+
+    def test_get_requests_are_not_limited(self):
+        """Test only the methods doing the work are limited"""
+        for _ in range(5):
+            self.assertEqual(self.client.get("/auth/signup").status_code, 200)
+
+    def test_unavailable_redis_lets_requests_through(self):
+        """Test requests are allowed while the buckets cannot be reached"""
+        with patch.object(rate_limiter, "hit", side_effect=ConnectionError("down")):
+            for _ in range(5):
+                self.assertEqual(self.login().status_code, 200)
+
+    def test_disabled_limiter_allows_everything(self):
+        """Test RATE_LIMIT_ENABLED turns the limits off"""
+        rate_limiter.enabled = False
+
+        statuses = [self.login().status_code for _ in range(5)]
+
+        self.assertEqual(statuses, [200] * 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
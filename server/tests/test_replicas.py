@@ -0,0 +1,187 @@
+import os
+import shutil
+import tempfile
+import time
+import threading
+import unittest
+from unittest import mock
+
+from sqlalchemy import select
+
+from app.mod_auth.models import UserAccount
+from app.replicas import replica_router, is_read, STICKY_SESSION_KEY
+from tests import BaseTestCase
+
+
+class ReplicaTestCases(BaseTestCase):
+    """
+    Tests for the routing of the reads to the replicas, with SQLite files standing in for the
+    primary and the replicas. Replication is left out, so rows written to the primary are only
+    found on the replicas once a test copies them
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app.config.update(
+            SQLALCHEMY_DATABASE_URI=self.uri("primary"),
+            DATABASE_REPLICA_URIS=[self.uri("replica0"), self.uri("replica1")],
+            DATABASE_REPLICA_POLICY="round_robin", DATABASE_REPLICA_LAG_INTERVAL=3600)
+        replica_router.init_app(self.app)
+        super(ReplicaTestCases, self).setUp()
+        for key in replica_router.binds:
+            self.db.Model.metadata.create_all(self.replica(key))
+        # measured now, the monitor thread of the router waits for the interval
+        replica_router.measure(self.db, self.app)
+        reader = UserAccount(email="reader@example.com", password="password", username="reader")
+        self.db.session.add(reader)
+        self.db.session.commit()
+        self.reader_id = reader.id
+
+    def tearDown(self):
+        for key in replica_router.binds:
+            self.replica(key).dispose()
+        super(ReplicaTestCases, self).tearDown()
+        self.app.config.update(DATABASE_REPLICA_URIS=[], SQLALCHEMY_BINDS=None)
+        replica_router.init_app(self.app)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def uri(self, name):
+        return "sqlite:///{}".format(os.path.join(self.directory, "{}.db".format(name)))
+
+    def replica(self, key):
+        return self.db.get_engine(self.app, bind=key)
+
+    def copy_users(self, key):
+        """Replicates the user accounts to a replica"""
+        rows = [dict(row) for row in self.db.engine.execute(UserAccount.__table__.select())]
+        self.replica(key).execute(UserAccount.__table__.insert(), rows)
+
+    def bind_of_read(self):
+        return self.db.session.get_bind(UserAccount.__mapper__,
+                                        UserAccount.query.filter_by(id=1).statement)
+
+    def test_reads_go_to_the_replicas(self):
+        """Test the ORM reads of a fresh session run on a replica, its writes on the primary"""
+        self.db.session.remove()
+
+        self.assertIsNone(UserAccount.query.filter_by(email="reader@example.com").first())
+        self.assertIsNotNone(self.db.engine.execute(UserAccount.__table__.select().where(
+            UserAccount.email == "reader@example.com")).first())
+
+    def test_round_robin(self):
+        """Test the reads alternate between the replicas"""
+        self.db.session.remove()
+        binds = [self.bind_of_read().url.database for _ in range(4)]
+
+        self.assertEqual(len(set(binds)), 2)
+        self.assertNotEqual(binds[0], binds[1])
+        self.assertEqual(binds[0], binds[2])
+
+    def test_least_lag_skips_lagging_replicas(self):
+        """Test the least lagging replica is read and replicas too far behind are skipped"""
+        replica_router.policy = "least_lag"
+        replica_router.lags = dict(replica_0=4.0, replica_1=1.0)
+        replica_router.measured_at = time.time()
+        self.db.session.remove()
+
+        self.assertEqual(self.bind_of_read(), self.replica("replica_1"))
+
+        replica_router.lags = dict(replica_0=30.0, replica_1=float("inf"))
+        self.assertEqual(self.bind_of_read(), self.db.engine)
+
+    def test_unreachable_replicas_are_skipped(self):
+        """Test a replica that can not be connected to is left out when the lag is measured"""
+        binds = self.app.config["SQLALCHEMY_BINDS"]
+        uri, binds["replica_0"] = binds["replica_0"], "sqlite:////nonexistent/replica.db"
+        replica_router.measure(self.db, self.app)
+        self.db.session.remove()
+        bind = self.bind_of_read()
+        binds["replica_0"] = uri
+
+        self.assertEqual(replica_router.lags["replica_0"], float("inf"))
+        self.assertEqual(replica_router.lags["replica_1"], 0.0)
+        self.assertEqual(bind, self.replica("replica_1"))
+
+    def test_lag_is_measured_in_the_background(self):
+        """Test reads do not wait for the lag to be measured, they go to the primary until it is"""
+        measuring = threading.Event()
+        replica_router.init_app(self.app)
+
+        def measure_lag(engine):
+            measuring.wait(5)
+            return 0.0
+
+        with mock.patch("app.replicas.measure_lag", side_effect=measure_lag):
+            self.db.session.remove()
+            before = self.bind_of_read()
+            measuring.set()
+            deadline = time.time() + 5
+            while len(replica_router.lags) < 2 and time.time() < deadline:
+                time.sleep(0.01)
+
+        self.assertEqual(before, self.db.engine)
+        self.assertNotEqual(self.bind_of_read(), self.db.engine)
+
+    def test_writes_and_locking_reads_go_to_the_primary(self):
+        """Test only plain SELECT statements are reads"""
+        table = UserAccount.__table__
+
+        self.assertTrue(is_read(select([table]).union(select([table]))))
+        self.assertFalse(is_read(select([table]).with_for_update()))
+        self.assertFalse(is_read(table.update().values(username="x")))
+
+    def test_session_sticks_to_the_primary_after_a_write(self):
+        """Test a session reads its own writes once it flushed changes"""
+        self.db.session.remove()
+        self.db.session.add(UserAccount(email="new@example.com", password="password",
+                                        username="new"))
+        self.db.session.flush()
+
+        self.assertIsNotNone(UserAccount.query.filter_by(email="new@example.com").first())
+        self.db.session.commit()
+        self.assertEqual(self.bind_of_read(), self.db.engine)
+
+    def test_user_sticks_to_the_primary_after_a_commit(self):
+        """Test the next requests of a user read from the primary after it committed changes"""
+        with self.app.test_request_context("/"):
+            self.db.session.remove()
+            self.db.session.add(UserAccount(email="new@example.com", password="password",
+                                            username="new"))
+            self.db.session.commit()
+            self.db.session.remove()
+            from flask import session
+
+            self.assertIn(STICKY_SESSION_KEY, session)
+            self.assertEqual(self.bind_of_read(), self.db.engine)
+
+            session[STICKY_SESSION_KEY] = 0
+            self.assertNotEqual(self.bind_of_read(), self.db.engine)
+
+    def test_user_cache_loads_from_the_primary(self):
+        """Test the user cache is filled from the primary, never from a lagging replica"""
+        from app.mod_auth.models import load_user
+        from app.mod_auth.user_cache import user_cache
+
+        user_cache.clear()
+        self.db.session.remove()
+        user = load_user(str(self.reader_id))
+
+        self.assertEqual(user.email, "reader@example.com")
+        self.assertFalse(self.db.session.info.get("primary"))
+
+    def test_login_reads_from_a_replica(self):
+        """Test the login looks the user up on a replica, which finds it once it is replicated"""
+        self.db.session.remove()
+        credentials = dict(email="reader@example.com", password="password")
+        missing = self.client.post("/auth/signup", data=credentials).json
+
+        for key in replica_router.binds:
+            self.copy_users(key)
+        found = self.client.post("/auth/signup", data=credentials).json
+
+        self.assertEqual(missing["message"], "User does not exist")
+        self.assertTrue(found["success"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import unittest
+
+from flask import jsonify
+
+from app.mod_auth.models import UserAccount
+from app.sampling_profiler import sampling_profiler, collapse
+from tests import BaseTestCase
+
+
+def slow_view():
+    time.sleep(0.05)
+    return jsonify(dict(success=True))
+
+
+class SamplingProfilerTestCases(BaseTestCase):
+    """
+    Tests for the sampling profiler and its sessions
+    """
+
+    def setUp(self):
+        super(SamplingProfilerTestCases, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        sampling_profiler.output_dir = self.directory
+        sampling_profiler.interval = 0.002
+        self.app.add_url_rule("/test/slow", "slow", slow_view)
+
+    def tearDown(self):
+        sampling_profiler.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+        super(SamplingProfilerTestCases, self).tearDown()
+
+    def test_collapse_starts_with_the_outermost_frame(self):
+        """Test a collapsed stack lists the callers first and the current function last"""
+        stack = collapse(sys._getframe()).split(";")
+
+        self.assertEqual(stack[-1],
+                         __name__ + ":test_collapse_starts_with_the_outermost_frame")
+        self.assertEqual(len(collapse(sys._getframe(), max_depth=2).split(";")), 2)
+
+    def test_session_writes_stacks_by_endpoint(self):
+        """Test the stacks of the sampled requests are written in the collapsed stack format"""
+        sampling_profiler.start(seconds=60, rate=1.0)
+        for _ in range(3):
+            self.client.get("/test/slow")
+        session = sampling_profiler.stop()
+
+        self.assertGreater(session["samples"], 0)
+        self.assertEqual([os.path.basename(path) for path in session["files"]], ["slow.folded"])
+        with open(session["files"][0]) as folded:
+            stack, count = folded.readline().rsplit(" ", 1)
+        self.assertIn(__name__ + ":slow_view", stack)
+        self.assertGreater(int(count), 0)
+
+    def test_requests_are_sampled_at_the_rate(self):
+        """Test requests left out by the rate are not sampled"""
+        sampling_profiler.start(seconds=60, rate=0.0)
+        self.client.get("/test/slow")
+
+        self.assertEqual(sampling_profiler.stop()["samples"], 0)
+
+    def test_session_ends_after_its_duration(self):
+        """Test a session stops sampling and is written on its own once its time is up"""
+        sampling_profiler.start(seconds=0.2, rate=1.0)
+        self.client.get("/test/slow")
+        time.sleep(0.4)
+
+        self.assertFalse(sampling_profiler.active)
+        self.assertFalse(sampling_profiler.session["running"])
+        self.assertEqual(len(sampling_profiler.session["files"]), 1)
+
+    def test_signal_starts_a_session(self):
+        """Test PROFILER_SIGNAL starts a session in the worker it is sent to"""
+        self.app.config.update(PROFILER_SIGNAL="SIGURG", PROFILER_SIGNAL_SECONDS=60)
+        previous = signal.getsignal(signal.SIGURG)
+        try:
+            sampling_profiler.init_app(self.app)
+            os.kill(os.getpid(), signal.SIGURG)
+            time.sleep(0.01)
+
+            self.assertTrue(sampling_profiler.active)
+            self.assertEqual(sampling_profiler.session["seconds"], 60)
+        finally:
+            signal.signal(signal.SIGURG, previous)
+
+    def test_gunicorn_signals_are_refused(self):
+        """Test the signals gunicorn handles can not start sessions"""
+        self.app.config["PROFILER_SIGNAL"] = "SIGUSR2"
+
+        with self.assertRaises(ValueError):
+            sampling_profiler.init_app(self.app)
+
+    def test_admin_endpoint_controls_sessions(self):
+        """Test administrators start and stop sessions of the worker answering them"""
+        user = UserAccount(email="admin@example.com", password="password", username="admin",
+                           admin=True)
+        self.db.session.add(user)
+        self.db.session.commit()
+        self.client.post("/auth/signup", data=dict(email=user.email, password="password"))
+
+        started = self.client.post("/admin/profiler", data=dict(seconds=60, rate=0.5))
+        again = self.client.post("/admin/profiler")
+        self.client.get("/test/slow")
+        stopped = self.client.delete("/admin/profiler")
+
+        self.assertEqual(started.json["session"]["rate"], 0.5)
+        self.assertEqual(again.status_code, 409)
+        self.assertFalse(stopped.json["session"]["running"])
+        self.assertFalse(self.client.get("/admin/profiler").json["session"]["running"])
+
+
+if __name__ == "__main__":
+    unittest.main()
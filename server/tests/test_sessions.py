@@ -0,0 +1,138 @@
+import unittest
+from unittest.mock import patch
+
+import fakeredis
+from flask import session, jsonify
+
+from app.mod_auth.models import UserAccount
+from app.sessions import RedisSessionInterface
+from tests import BaseTestCase
+
+
+class RedisSessionTestCases(BaseTestCase):
+    """
+    Tests for the Redis session interface
+    """
+
+    def setUp(self):
+        super(RedisSessionTestCases, self).setUp()
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+        self.app.session_interface = RedisSessionInterface(self.redis)
+        # these sessions do not belong to a logged in user, which strong session protection clears
+        self.app.config["SESSION_PROTECTION"] = None
+
+        def set_value():
+            session["value"] = "croesus"
+            return jsonify(dict())
+
+        def get_value():
+            return jsonify(dict(value=session.get("value")))
+
+        def clear_value():
+            session.clear()
+            return jsonify(dict())
+
+        def untouched():
+            return jsonify(dict())
+
+        self.app.add_url_rule("/session-test/set", "session_set", set_value)
+        self.app.add_url_rule("/session-test/get", "session_get", get_value)
+        self.app.add_url_rule("/session-test/clear", "session_clear", clear_value)
+        self.app.add_url_rule("/session-test/untouched", "session_untouched", untouched)
+
+    def session_keys(self):
+        return self.redis.keys("session:*")
+
+    def test_unused_session_is_not_stored(self):
+        """Test a request that does not use the session writes neither Redis nor a cookie"""
+        response = self.client.get("/session-test/untouched")
+        self.assertNotIn("Set-Cookie", response.headers)
+        self.assertEqual(self.session_keys(), [])
+
+    def test_modified_session_is_stored_with_ttl(self):
+        """Test a modified session is written to Redis with an expiry and can be read back"""
+        response = self.client.get("/session-test/set")
+        self.assertIn("Set-Cookie", response.headers)
+
+        keys = self.session_keys()
+        self.assertEqual(len(keys), 1)
+        self.assertGreater(self.redis.ttl(keys[0]), 0)
+
+        response = self.client.get("/session-test/get")
+        self.assertEqual(response.json["value"], "croesus")
+
+    def test_session_is_loaded_lazily(self):
+        """Test the session data is only read from Redis when the session is used"""
+        self.client.get("/session-test/set")
+        sid = self.session_keys()[0].decode("utf-8")[len("session:"):]
+        headers = dict(Cookie="{}={}".format(self.app.session_cookie_name, sid))
+
+        with self.app.test_request_context(headers=headers) as ctx:
+            with patch.object(self.redis, "get", wraps=self.redis.get) as get:
+                redis_session = self.app.session_interface.open_session(self.app, ctx.request)
+                self.assertEqual(get.call_count, 0)
+                self.assertEqual(redis_session["value"], "croesus")
+                self.assertEqual(get.call_count, 1)
+
+    def test_expiry_slides_without_rewriting(self):
+        """Test a request with an unmodified session refreshes its expiry without rewriting it"""
+        self.client.get("/session-test/set")
+        key = self.session_keys()[0]
+        self.redis.expire(key, 10)
+
+        with patch.object(self.redis, "setex", wraps=self.redis.setex) as setex:
+            self.client.get("/session-test/untouched")
+            self.assertEqual(setex.call_count, 0)
+
+        self.assertGreater(self.redis.ttl(key), 10)
+
+    def test_unmodified_session_is_not_rewritten(self):
+        """Test reading a session does not write it back"""
+        self.client.get("/session-test/set")
+
+        with patch.object(self.redis, "setex", wraps=self.redis.setex) as setex:
+            self.client.get("/session-test/get")
+            self.assertEqual(setex.call_count, 0)
+
+    def test_cleared_session_is_deleted(self):
+        """Test clearing the session removes it from Redis"""
+        self.client.get("/session-test/set")
+        self.client.get("/session-test/clear")
+        self.assertEqual(self.session_keys(), [])
+
+    def test_unknown_session_id_is_not_reused(self):
+        """Test an unknown session id sent by the client is replaced by a new one"""
+        self.client.set_cookie("localhost", self.app.session_cookie_name, "chosen-by-client")
+        self.client.get("/session-test/set")
+
+        keys = self.session_keys()
+        self.assertEqual(len(keys), 1)
+        self.assertNotEqual(keys[0], b"session:chosen-by-client")
+
+    def test_session_id_changes_on_login_and_logout(self):
+        """Test logging in and out moves the session to a new id and deletes the old one"""
+        user = UserAccount(email="session@example.com", password="password", username="session")
+        self.db.session.add(user)
+        self.db.session.commit()
+        self.client.get("/session-test/set")
+        planted = self.session_keys()[0]
+
+        response = self.client.post("/auth/signup", data=dict(email=user.email,
+                                                              password="password"))
+        logged_in = self.session_keys()
+        value = self.client.get("/session-test/get").json["value"]
+        self.client.get("/auth/logout")
+        logged_out = self.session_keys()
+
+        self.assertEqual(len(logged_in), 1)
+        self.assertNotEqual(logged_in[0], planted)
+        self.assertIn("={};".format(logged_in[0].decode("utf-8")[len("session:"):]),
+                      response.headers["Set-Cookie"])
+        self.assertEqual(value, "croesus")
+        self.assertNotIn(planted, logged_out)
+        self.assertNotIn(logged_in[0], logged_out)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import subprocess
+import sys
+import unittest
+
+from app import create_app
+from app.startup import StartupProfiler, profile_startup
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class StartupTestCases(unittest.TestCase):
+    """
+    Tests for the startup profiler and the lazily imported crawler
+    """
+
+    def test_profiler_times_every_extension_and_blueprint(self):
+        """Test create_app reports a step for every extension and blueprint, each once"""
+        profiler = StartupProfiler()
+        create_app("testing", profiler=profiler)
+
+        names = [(step["kind"], step["name"]) for step in profiler.steps]
+        for blueprint in ("auth", "home", "dashboard", "blog", "tasks"):
+            self.assertEqual(names.count(("blueprint", blueprint)), 1)
+        self.assertIn(("extension", "db"), names)
+        self.assertIn(("extension", "task_ledger"), names)
+        self.assertTrue(all(step["seconds"] >= 0 for step in profiler.steps))
+
+    def test_request_handlers_are_registered_once(self):
+        """Test the request handlers are not registered twice by create_app"""
+        app = create_app("testing")
+
+        handlers = [function.__name__ for function in app.before_request_funcs.get(None, [])]
+        self.assertEqual(handlers.count("before_request"), 1)
+
+    def test_disabled_profiler_records_nothing(self):
+        """Test the default profiler of create_app does not time anything"""
+        profiler = StartupProfiler(enabled=False)
+        with profiler.step("extension", "db"):
+            pass
+
+        self.assertEqual(profiler.steps, [])
+
+    def test_crawler_is_imported_lazily(self):
+        """Test creating the application does not import the crawler until a crawl needs it"""
+        code = ("import sys\n"
+                "from app import create_app\n"
+                "app = create_app('testing')\n"
+                "print('app.mod_blog.crawler' in sys.modules, 'lxml.html' in sys.modules)\n"
+                "from app.mod_blog.crawler import get_crawler\n"
+                "print(get_crawler(app) is app.extensions['news_crawler'])\n")
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=SERVER_DIR)
+
+        self.assertEqual(output.decode("utf-8").split()[-3:], ["False", "False", "True"])
+
+    def test_profile_startup_in_a_fresh_interpreter(self):
+        """Test the startup profile times the imports before create_app"""
+        steps = profile_startup("testing", cwd=SERVER_DIR, dependencies=("flask",))
+
+        self.assertEqual([step["name"] for step in steps[:2]], ["flask", "app"])
+        self.assertEqual(steps[-2]["name"], "create_app")
+        self.assertEqual(steps[-1]["kind"], "total")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+import json
+import threading
+import unittest
+from unittest.mock import patch, MagicMock
+
+import fakeredis
+
+from app import redis_db
+from app.mod_auth.models import UserAccount, UserProfile
+from app.mod_tasks.ledger import task_ledger
+from app.mod_tasks.progress import task_progress
+from tests import BaseTestCase
+
+
+class TaskProgressTestCases(BaseTestCase):
+    """
+    Tests for the task status and progress stream endpoints
+    """
+
+    def setUp(self):
+        super(TaskProgressTestCases, self).setUp()
+        client = fakeredis.FakeStrictRedis()
+        client.flushall()
+        redis_db.init_app(self.app, client=client)
+        self.app.config["TASK_STREAM_TIMEOUT"] = 5
+        self.profile, self.other_profile = UserProfile.query.limit(2).all()
+        account = UserAccount(email="tasks@example.com", password="password", username="tasks")
+        account.user_profile_id = self.profile.id
+        self.db.session.add(account)
+        self.db.session.commit()
+        self.client.post("/auth/signup", data=dict(email="tasks@example.com", password="password"))
+
+    @staticmethod
+    def events(body):
+        return [json.loads(line[len("data: "):]) for line in body.decode("utf-8").splitlines()
+                if line.startswith("data: ")]
+
+    def test_status_is_the_last_published_event(self):
+        """Test the status of a task is read from its last event"""
+        task_progress.publish("task-1", "PROGRESS", dict(current=1, total=3))
+        task_progress.publish("task-1", "PROGRESS", dict(current=2, total=3))
+
+        response = self.client.get("/tasks/task-1")
+
+        self.assertEqual(response.json["state"], "PROGRESS")
+        self.assertEqual(response.json["meta"], dict(current=2, total=3))
+        self.assertEqual(response.json["seq"], 2)
+
+    @patch("app.mod_tasks.views.celery")
+    def test_status_falls_back_to_the_result_backend(self, celery):
+        """Test tasks that published nothing are looked up in the result backend"""
+        celery.AsyncResult.return_value = MagicMock(state="STARTED", info=None)
+
+        response = self.client.get("/tasks/task-2")
+
+        self.assertEqual(response.json["state"], "STARTED")
+        celery.AsyncResult.assert_called_once_with("task-2")
+
+    def test_status_without_a_result_backend_is_pending(self):
+        """Test tasks that published nothing are pending when there is no result backend"""
+        response = self.client.get("/tasks/task-7")
+
+        self.assertEqual(response.json["state"], "PENDING")
+
+    def test_stream_of_a_finished_task_ends_after_its_last_event(self):
+        """Test the stream of a finished task only sends its final event"""
+        task_progress.publish("task-3", "PROGRESS", dict(current=1, total=1))
+        task_progress.publish("task-3", "SUCCESS", dict(result=1))
+
+        response = self.client.get("/tasks/task-3/stream")
+
+        self.assertEqual(response.mimetype, "text/event-stream")
+        self.assertEqual([event["state"] for event in self.events(response.data)], ["SUCCESS"])
+
+    def test_stream_pushes_events_until_the_task_is_done(self):
+        """Test events published while a client is connected are pushed to it in order"""
+        task_progress.publish("task-4", "PROGRESS", dict(current=0, total=2))
+
+        def publish():
+            with self.app.app_context():
+                for current in (1, 2):
+                    task_progress.publish("task-4", "PROGRESS", dict(current=current, total=2))
+                task_progress.publish("task-4", "SUCCESS", dict(result=2))
+
+        timer = threading.Timer(0.2, publish)
+        timer.start()
+        try:
+            response = self.client.get("/tasks/task-4/stream")
+            events = self.events(response.data)
+        finally:
+            timer.join()
+
+        self.assertEqual([event["seq"] for event in events], [1, 2, 3, 4])
+        self.assertEqual(events[-1]["state"], "SUCCESS")
+
+    def test_stream_requires_login(self):
+        """Test anonymous clients can not hold a stream open"""
+        self.client.get("/auth/logout")
+
+        response = self.client.get("/tasks/task-5/stream")
+
+        self.assertNotEqual(response.mimetype, "text/event-stream")
+
+    def test_status_requires_login(self):
+        """Test anonymous clients can not read the status of a task"""
+        task_progress.publish("task-8", "PROGRESS", dict(current=1, total=3))
+        self.client.get("/auth/logout")
+
+        response = self.client.get("/tasks/task-8")
+
+        self.assertNotEqual(response.status_code, 200)
+
+    def test_tasks_of_other_users_are_hidden(self):
+        """Test the status and stream of a task sent for another user are not found"""
+        task_ledger.enqueued("task-9", "app.tasks.example", self.other_profile.id)
+        task_ledger.enqueued("task-10", "app.tasks.example", self.profile.id)
+        for task_id in ("task-9", "task-10"):
+            task_progress.publish(task_id, "SUCCESS", dict(result=1))
+
+        self.assertEqual(self.client.get("/tasks/task-9").status_code, 404)
+        self.assertEqual(self.client.get("/tasks/task-9/stream").status_code, 404)
+        self.assertEqual(self.client.get("/tasks/task-10").json["state"], "SUCCESS")
+        self.assertEqual(self.client.get("/tasks/task-10/stream").status_code, 200)
+
+    @patch("app.mod_tasks.views.celery")
+    def test_stream_ends_when_the_result_backend_has_the_result(self, celery):
+        """Test the stream of a task that published no events ends with its result"""
+        celery.AsyncResult.return_value = MagicMock(state="SUCCESS", info=dict(result=1))
+
+        response = self.client.get("/tasks/task-6/stream")
+
+        self.assertEqual([event["state"] for event in self.events(response.data)], ["SUCCESS"])
+
+    def test_progress_increments_are_published(self):
+        """Test progress reported by a task is published on its channel"""
+        from app.mod_blog.blog_tasks import fetch_news
+
+        fetch_news.push_request(id="task-5")
+        try:
+            fetch_news.progress(1, 2, article=dict(url="http://a"))
+        finally:
+            fetch_news.pop_request()
+
+        event = task_progress.last_event("task-5")
+        self.assertEqual(event["meta"], dict(current=1, total=2, article=dict(url="http://a")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import fakeredis
+from jinja2 import Environment, FileSystemBytecodeCache
+
+from app import create_app, redis_db
+from app.template_cache import RedisBytecodeCache, compile_templates
+
+
+class TemplateCacheTestCases(unittest.TestCase):
+    """
+    Tests for the bounded template cache and the bytecode caches
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def create_app(self, backend, client=None):
+        app = create_app("testing")
+        app.config.update(JINJA_BYTECODE_CACHE=backend, JINJA_CACHE_SIZE=50,
+                          JINJA_BYTECODE_CACHE_DIR=os.path.join(self.directory, "jinja"))
+        if client is not None:
+            redis_db.init_app(app, client=client)
+        return app
+
+    def test_template_cache_is_bounded(self):
+        """Test compiled templates are kept in an LRU of JINJA_CACHE_SIZE templates"""
+        app = self.create_app(None)
+
+        self.assertEqual(app.jinja_env.cache.capacity, 50)
+        self.assertIsNone(app.jinja_env.bytecode_cache)
+
+    def test_compile_templates_covers_blueprint_templates(self):
+        """Test every global and blueprint template is compiled into the bytecode cache"""
+        app = self.create_app("filesystem")
+
+        compiled, failed = compile_templates(app)
+
+        self.assertIsInstance(app.jinja_env.bytecode_cache, FileSystemBytecodeCache)
+        self.assertIn("base.html", compiled)
+        self.assertIn("auth.confirm_email.html", compiled)
+        # templates with syntax errors are reported rather than stopping the build
+        self.assertNotIn("auth.confirm_email.html", [name for name, _ in failed])
+        self.assertEqual(len(os.listdir(os.path.join(self.directory, "jinja"))), len(compiled))
+
+    def test_new_process_loads_bytecode_instead_of_compiling(self):
+        """Test an application with a warm bytecode cache does not compile its templates"""
+        compile_templates(self.create_app("filesystem"))
+        app = self.create_app("filesystem")
+
+        with patch.object(Environment, "compile", side_effect=AssertionError("compiled")):
+            app.jinja_env.get_template("auth.confirm_email.html")
+
+    def test_redis_bytecode_cache(self):
+        """Test bytecode is shared through redis"""
+        client = fakeredis.FakeStrictRedis()
+        client.flushall()
+        compile_templates(self.create_app("redis", client))
+        app = self.create_app("redis", client)
+
+        self.assertIsInstance(app.jinja_env.bytecode_cache, RedisBytecodeCache)
+        self.assertTrue(client.keys("jinja:*"))
+        with patch.object(Environment, "compile", side_effect=AssertionError("compiled")):
+            app.jinja_env.get_template("auth.reset_email.html")
+
+    def test_unknown_backend_is_rejected(self):
+        """Test a misspelled JINJA_BYTECODE_CACHE fails loudly"""
+        app = self.create_app("memcached")
+
+        with self.assertRaises(ValueError):
+            app.jinja_env
+
+
+if __name__ == "__main__":
+    unittest.main()
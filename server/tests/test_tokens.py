@@ -0,0 +1,57 @@
+import unittest
+
+from itsdangerous import BadSignature
+
+from app.mod_auth.security import generate_confirmation_token, confirm_token
+from app.mod_auth.tokens import TokenService, token_service
+from tests import BaseTestCase
+
+
+class TokenServiceTestCases(BaseTestCase):
+    """
+    Tests for the token service
+    """
+
+    def test_confirmation_token_round_trip(self):
+        """Test an email can be read back from its confirmation token"""
+        token = generate_confirmation_token("croesus@example.com")
+        self.assertEqual(confirm_token(token), "croesus@example.com")
+
+    def test_serializers_are_built_once(self):
+        """Test the same serializers are reused for the same salt and expiration"""
+        self.assertIs(token_service.email_serializers()[0], token_service.email_serializers()[0])
+        self.assertIs(token_service.timed_serializers(60)[0],
+                      token_service.timed_serializers(60)[0])
+
+    def test_batch_tokens_match_single_tokens(self):
+        """Test tokens created in a batch can be verified like single tokens"""
+        emails = ["croesus@example.com", "midas@example.com"]
+        tokens = token_service.generate_email_tokens(emails)
+        self.assertEqual([token_service.load_email_token(token) for token in tokens], emails)
+
+    def test_auth_token_is_verified_without_database(self):
+        """Test an auth token yields the user id and a tampered token yields None"""
+        token = token_service.generate_auth_token(42)
+        self.assertEqual(token_service.verify_auth_token(token), 42)
+        self.assertIsNone(token_service.verify_auth_token(token + "x"))
+
+    def test_tokens_signed_with_fallback_key_are_accepted(self):
+        """Test tokens signed with a rotated out key are still accepted"""
+        old_service = TokenService()
+        old_service.secret_keys = ["old-secret"]
+        old_service.salt = token_service.salt
+        email_token = old_service.generate_email_token("croesus@example.com")
+        auth_token = old_service.generate_auth_token(42)
+
+        with self.assertRaises(BadSignature):
+            token_service.load_email_token(email_token)
+
+        self.app.config["SECRET_KEY_FALLBACKS"] = ["old-secret"]
+        token_service.init_app(self.app)
+
+        self.assertEqual(token_service.load_email_token(email_token), "croesus@example.com")
+        self.assertEqual(token_service.verify_auth_token(auth_token), 42)
+
+
+if __name__ == "__main__":
+    unittest.main()
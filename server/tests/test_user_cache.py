@@ -0,0 +1,109 @@
+import unittest
+
+from app import db
+from app.cache import LRUCache
+from app.mod_auth.models import UserAccount, UserProfile, load_user
+from app.mod_auth.user_cache import user_cache
+from tests import BaseTestCase
+
+
+class LRUCacheTestCases(unittest.TestCase):
+    """
+    Tests for the in process LRU cache
+    """
+
+    def setUp(self):
+        self.now = 0
+        self.cache = LRUCache(maxsize=2, ttl=10, timer=lambda: self.now)
+
+    def test_entries_expire_after_ttl(self):
+        """Test entries are no longer returned once their time to live has passed"""
+        self.cache.set("a", 1)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.now = 11
+        self.assertIsNone(self.cache.get("a"))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        """Test the least recently used entry is evicted when the cache is full"""
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+        self.assertIn("a", self.cache)
+        self.assertNotIn("b", self.cache)
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_hits_and_misses_are_counted(self):
+        """Test lookups are counted as hits and misses"""
+        self.cache.set("a", 1)
+        self.cache.get("a")
+        self.cache.get("b")
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+        self.assertEqual(stats["hit_ratio"], 0.5)
+
+
+class UserCacheTestCases(BaseTestCase):
+    """
+    Tests for the user cache in front of the login manager's user loader
+    """
+
+    def setUp(self):
+        super(UserCacheTestCases, self).setUp()
+        profile = UserProfile.query.filter_by(email="test1hadithi@hadithi.com").first()
+        user = UserAccount(email=profile.email, username="test1", password="password",
+                           user_profile_id=profile.id)
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+        user_cache.clear()
+        db.session.remove()
+
+    def test_second_load_is_a_cache_hit(self):
+        """Test loading the same user twice only misses the cache once"""
+        load_user(str(self.user_id))
+        db.session.remove()
+        user = load_user(str(self.user_id))
+
+        self.assertEqual(user.email, "test1hadithi@hadithi.com")
+        self.assertEqual((user_cache.hits, user_cache.misses), (1, 1))
+
+    def test_cached_user_is_attached_to_the_session(self):
+        """Test a user restored from the cache can be used and updated in the current session"""
+        load_user(str(self.user_id))
+        db.session.remove()
+        user = load_user(str(self.user_id))
+
+        self.assertIn(user, db.session)
+        self.assertNotIn(user, db.session.dirty)
+
+        user.confirmed = True
+        db.session.commit()
+        self.assertTrue(UserAccount.query.get(self.user_id).confirmed)
+
+    def test_updates_invalidate_the_cached_user(self):
+        """Test updating a user through the ORM removes them from the cache"""
+        load_user(str(self.user_id))
+        user = UserAccount.query.get(self.user_id)
+        user.confirmed = True
+        db.session.commit()
+        db.session.remove()
+
+        user = load_user(str(self.user_id))
+        self.assertTrue(user.confirmed)
+        self.assertEqual(user_cache.misses, 2)
+
+    def test_cached_user_is_invalidated_on_commit(self):
+        """Test a flushed change only removes the user from the cache once it is committed"""
+        load_user(str(self.user_id))
+        user = UserAccount.query.get(self.user_id)
+        user.confirmed = True
+        db.session.flush()
+
+        self.assertIsNotNone(user_cache.backend.get(self.user_id))
+        db.session.commit()
+        self.assertIsNone(user_cache.backend.get(self.user_id))
+
+
+if __name__ == "__main__":
+    unittest.main()